@@ -0,0 +1,75 @@
+"""Benchmark suite for parsers, page rendering, API throughput and the
+serving modes.
+
+Run from the repository root:
+
+    python -m benchmarks [-o results.json] [--baseline old.json]
+
+Results are written as JSON. With --baseline, benchmarks whose median got
+slower by more than --threshold are reported and the exit status is 1.
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import sys
+from benchmarks import bench_api, bench_parsers, bench_recommend, bench_render, bench_serving
+
+SUITES = {
+    "parsers": bench_parsers.run,
+    "render": bench_render.run,
+    "api": bench_api.run,
+    "serving": bench_serving.run,
+    "recommend": bench_recommend.run,
+}
+
+def compare(results, baseline, threshold):
+    """Find benchmarks that regressed against a baseline result file"""
+    previous = { r["name"]: r for r in baseline["results"] }
+    regressions = []
+    for result in results:
+        old = previous.get(result["name"])
+        if old is None:
+            continue
+        ratio = result["p50_s"] / old["p50_s"]
+        if ratio > threshold:
+            regressions.append({"name": result["name"], "p50_s": result["p50_s"],
+                "baseline_p50_s": old["p50_s"], "ratio": ratio})
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="mittagv2 benchmarks")
+    parser.add_argument("suites", nargs="*", choices=[[]] + list(SUITES.keys()),
+        help="suites to run (default: all)")
+    parser.add_argument("--iterations", "-n", type=int, default=20, help="base iteration count")
+    parser.add_argument("--output", "-o", help="write JSON results to file (default: stdout)")
+    parser.add_argument("--baseline", "-b", help="JSON results to compare against")
+    parser.add_argument("--threshold", "-t", type=float, default=1.25,
+        help="slowdown factor of the median considered a regression")
+    args = parser.parse_args()
+
+    results = []
+    for name in args.suites or SUITES.keys():
+        results.extend(SUITES[name](args.iterations))
+    report = {
+        "timestamp": datetime.datetime.utcnow().isoformat("T") + "Z",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as fp:
+            report["regressions"] = compare(results, json.load(fp), args.threshold)
+        status = 1 if len(report["regressions"]) > 0 else 0
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(output)
+    else:
+        print(output)
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
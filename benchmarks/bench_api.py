@@ -0,0 +1,77 @@
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cherrypy
+import requests
+import mittagv2.ratelimit as ratelimit
+import mittagv2.web as web
+from benchmarks.common import summarize
+from benchmarks.fixtures import populated_storage
+
+def unlimited():
+    """Admission control that admits everything: load tests come from a
+    single client and would mostly measure the rate limits"""
+    return ratelimit.Admission(client_rate=1e9, client_burst=1e9, endpoint_rate=1e9, endpoint_burst=1e9,
+        heavy_concurrency=1000)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class Server:
+    """CherryPy app on a local port, backed by in-memory storage"""
+
+    def __init__(self, backend, threads=10):
+        self.port = free_port()
+        self.url = "http://127.0.0.1:{}".format(self.port)
+        cherrypy.config.update({
+            "server.socket_host": "127.0.0.1",
+            "server.socket_port": self.port,
+            "server.thread_pool": threads,
+            "log.screen": False,
+            "environment": "production",
+        })
+        cherrypy.log.access_log.propagate = False
+        cherrypy.log.error_log.propagate = False
+        cherrypy.tree.mount(web.Root(backend), "/", {})
+        cherrypy.tools.rate_limit.admission = unlimited()
+
+    def __enter__(self):
+        cherrypy.engine.start()
+        cherrypy.engine.wait(cherrypy.engine.states.STARTED)
+        return self
+
+    def __exit__(self, *args):
+        cherrypy.engine.exit()
+        cherrypy.tree.apps.clear()
+
+def load(name, url, requests_total, concurrency):
+    """Issue requests from a number of concurrent clients, return result
+    with throughput and latency percentiles"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    def timed_get(_):
+        start = time.perf_counter()
+        response = session.get(url)
+        response.raise_for_status()
+        return time.perf_counter() - start
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(timed_get, range(requests_total)))
+    elapsed = time.perf_counter() - start
+    return summarize(name, samples, concurrency=concurrency,
+        requests_per_second=requests_total / elapsed)
+
+def run(iterations, concurrency=8):
+    backend = populated_storage()
+    menu_id = backend.weekly_menu_ids()[0]
+    requests_total = iterations * 20
+    with Server(backend) as server:
+        return [
+            load("api.index", server.url + "/?day=0", requests_total, concurrency),
+            load("api.menus", server.url + "/api/v1/menus/", requests_total, concurrency),
+            load("api.menu", server.url + "/api/v1/menus/" + menu_id, requests_total, concurrency),
+            load("api.scrapings", server.url + "/api/v1/scrapings/", requests_total, concurrency),
+        ]
@@ -0,0 +1,25 @@
+import io
+from benchmarks.common import measure
+from mittagv2.marli_parser import MarliParser
+from mittagv2.mensa_parser import MensaParser
+from mittagv2.uksh_parser import BistroParser, MfcParser
+
+RESOURCES = "tests/resources/"
+
+def read_resource(name):
+    with open(RESOURCES + name, "rb") as fp:
+        return fp.read()
+
+def run(iterations):
+    bistro_pdf = read_resource("Speiseplan Bistro KW 50.pdf")
+    mfc_pdf = read_resource("Speiseplan Cafeteria MFC KW 49.pdf")
+    mensa_html = read_resource("Studentenwerk SH.html").decode("UTF-8")
+    marli_html = read_resource("marli.html").decode("UTF-8")
+    return [
+        measure("parser.bistro", lambda: BistroParser(50, io.BytesIO(bistro_pdf)).parse(),
+            iterations=max(1, iterations // 4)),
+        measure("parser.mfc", lambda: MfcParser(49, io.BytesIO(mfc_pdf)).parse(),
+            iterations=max(1, iterations // 4)),
+        measure("parser.mensa", lambda: MensaParser(1).parse(mensa_html), iterations=iterations),
+        measure("parser.marli", lambda: MarliParser(1).parse(marli_html), iterations=iterations),
+    ]
@@ -0,0 +1,23 @@
+import mittagv2.recommend as recommend
+import mittagv2.utils as utils
+from benchmarks.common import measure
+from benchmarks.fixtures import populated_storage
+
+def profiles(count):
+    """Profiles with a mix of all preferences"""
+    keywords = ["fisch", "nudel", "curry", "schwein", "salat", "suppe"]
+    return [ recommend.Profile(id=i, vegetarian=i % 4 == 0, max_price=3 + i % 3, calories=600 + 10 * (i % 20),
+        likes=keywords[i % 3:i % 3 + 2], dislikes=keywords[3 + i % 3:4 + i % 3],
+        history=["Schweineschnitzel mit Pommes", "Gemüsecurry mit Reis"][:i % 3]) for i in range(count) ]
+
+def run(iterations):
+    recommender = recommend.Recommender(populated_storage())
+    year_week = utils.current_year_week()
+    batch = profiles(500)
+    recommender.recommend(year_week, 0, batch)
+    return [
+        measure("recommend.single", lambda: recommender.recommend(year_week, 0, batch[:1]),
+            iterations=iterations * 10, memory=False),
+        measure("recommend.batch_500", lambda: recommender.recommend(year_week, 0, batch),
+            iterations=iterations * 5),
+    ]
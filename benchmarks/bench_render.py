@@ -0,0 +1,17 @@
+import mittagv2.utils as utils
+import mittagv2.web as web
+from benchmarks.common import measure
+from benchmarks.fixtures import populated_storage
+
+def run(iterations):
+    backend = populated_storage()
+    root = web.Root(backend)
+    menus = [ m for d in backend.weekly_menus(utils.current_year_week())
+        for day in d["menus"]["days"] for m in day["menus"] ]
+    def render_menus():
+        for menu in menus:
+            root._renderer.menu_to_html(menu)
+    return [
+        measure("render.get_all", lambda: root._get_all("0"), iterations=iterations * 5),
+        measure("render.menu_to_html", render_menus, iterations=iterations * 5),
+    ]
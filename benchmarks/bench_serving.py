@@ -0,0 +1,73 @@
+"""Load test comparing the CherryPy (mittagv2.web) and asyncio
+(mittagv2.asgi) serving modes on the same requests. Storage calls are
+delayed by STORAGE_LATENCY to stand in for the CouchDB round-trip, which
+is what ties up CherryPy's request threads."""
+
+import asyncio
+import threading
+import time
+import mittagv2.asgi as asgi
+from benchmarks.bench_api import Server, free_port, load, unlimited
+from benchmarks.fixtures import populated_storage
+
+STORAGE_LATENCY = 0.005 #: Simulated time in seconds per storage call
+
+class SlowStorage:
+    """Blocking storage wrapper that sleeps before each call"""
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def __getattr__(self, name):
+        method = getattr(self._backend, name)
+        def call(*args, **kwargs):
+            time.sleep(STORAGE_LATENCY)
+            return method(*args, **kwargs)
+        return call
+
+class AsyncSlowStorage(asgi.ThreadedStorage):
+    """Async storage that waits on the event loop before each call, like
+    a request to CouchDB would"""
+
+    def _run(self, function, *args):
+        async def call():
+            await asyncio.sleep(STORAGE_LATENCY)
+            return function(*args)
+        return call()
+
+class AsgiServer:
+    """ASGI app served by uvicorn on a local port, in a background thread"""
+
+    def __init__(self, backend):
+        import uvicorn
+        self.port = free_port()
+        self.url = "http://127.0.0.1:{}".format(self.port)
+        config = uvicorn.Config(asgi.App(AsyncSlowStorage(backend), admission=unlimited()), host="127.0.0.1",
+            port=self.port, log_level="warning", access_log=False, lifespan="on")
+        self._server = uvicorn.Server(config)
+        self._server.install_signal_handlers = lambda: None
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *args):
+        self._server.should_exit = True
+        self._thread.join()
+
+def run(iterations, concurrency=32):
+    backend = populated_storage()
+    menu_id = backend.weekly_menu_ids()[0]
+    requests_total = iterations * 20
+    paths = [("index", "/?day=0"), ("menus", "/api/v1/menus/"), ("menu", "/api/v1/menus/" + menu_id),
+        ("scrapings", "/api/v1/scrapings/")]
+    results = []
+    for mode, server in (("cherrypy", lambda: Server(SlowStorage(backend))), ("asgi", lambda: AsgiServer(backend))):
+        with server() as running:
+            for name, path in paths:
+                results.append(load("serving.{}.{}".format(mode, name), running.url + path,
+                    requests_total, concurrency))
+    return results
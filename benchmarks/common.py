@@ -0,0 +1,49 @@
+import gc
+import statistics
+import time
+import tracemalloc
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a list of samples"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def summarize(name, samples, **extra):
+    """Build result record from a list of durations in seconds"""
+    result = {
+        "name": name,
+        "iterations": len(samples),
+        "mean_s": statistics.mean(samples),
+        "min_s": min(samples),
+        "p50_s": percentile(samples, 0.5),
+        "p95_s": percentile(samples, 0.95),
+        "p99_s": percentile(samples, 0.99),
+    }
+    result.update(extra)
+    return result
+
+def peak_memory(fn):
+    """Peak memory allocated by Python while running fn once, in bytes"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def measure(name, fn, iterations=20, warmup=2, memory=True):
+    """Time fn over a number of iterations and optionally record its peak
+    memory usage (measured in a separate run, tracing skews timings)"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    extra = {}
+    if memory:
+        extra["peak_memory_bytes"] = peak_memory(fn)
+    return summarize(name, samples, **extra)
@@ -0,0 +1,33 @@
+import io
+import logging
+import mittagv2.scraper
+import mittagv2.storage as storage
+from benchmarks.bench_parsers import read_resource
+from mittagv2.marli_parser import MarliParser
+from mittagv2.mensa_parser import MensaParser
+from mittagv2.uksh_parser import BistroParser, MfcParser
+
+def parsed_menus():
+    """Parse all test fixtures, returns (source_name, menu, blob) tuples"""
+    bistro_pdf = read_resource("Speiseplan Bistro KW 50.pdf")
+    mfc_pdf = read_resource("Speiseplan Cafeteria MFC KW 49.pdf")
+    mensa_html = read_resource("Studentenwerk SH.html")
+    marli_html = read_resource("marli.html")
+    return [
+        ("uksh-bistro", BistroParser(50, io.BytesIO(bistro_pdf)).parse(), bistro_pdf),
+        ("uksh-cafeteria", MfcParser(49, io.BytesIO(mfc_pdf)).parse(), mfc_pdf),
+        ("swsh-mensa", MensaParser(1).parse(mensa_html.decode("UTF-8")), mensa_html),
+        ("marli-sb", MarliParser(1).parse(marli_html.decode("UTF-8")), marli_html),
+    ]
+
+def populated_storage():
+    """In-memory storage holding the fixture menus as current week"""
+    backend = storage.SqliteStorage(":memory:")
+    scraper = mittagv2.scraper.StorageScraper(backend)
+    logging.disable(logging.INFO)
+    try:
+        for name, menu, blob in parsed_menus():
+            scraper._scrape_single(lambda: (menu, blob), name)
+    finally:
+        logging.disable(logging.NOTSET)
+    return backend
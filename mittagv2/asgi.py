@@ -0,0 +1,541 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+"""Asyncio serving mode: an ASGI application for the menu page and the
+read-only /api/v1 tree (menus, scrapings and week bundles), sharing its
+handlers with mittagv2.web. A single event loop serves many concurrent
+clients instead of one thread per request, and CouchDB is queried over a
+pool of keep-alive connections owned by the loop.
+
+Run with "python -m mittagv2.asgi" (needs uvicorn) behind a proxy that
+routes / and /api/v1/ here and everything else (static files, admin) to
+mittagv2.web. The /api/v1 endpoints not served here (events, menu changes
+and revisions, recommendations, dishes) are passed on to mittagv2.web,
+given with --upstream or MITTAG_WEB_URL; without it they are not found.
+Requests served here are subject to the same admission control as in
+mittagv2.web (see mittagv2.ratelimit). /metrics has the Prometheus
+metrics of this process, to be scraped from each process directly."""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import time
+from http import HTTPStatus
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlsplit
+import httpx
+import mittagv2.cache as cache
+import mittagv2.handlers as handlers
+import mittagv2.metrics as metrics
+import mittagv2.ratelimit as ratelimit
+import mittagv2.readmodels as readmodels
+import mittagv2.retention as retention
+import mittagv2.storage as storage
+import mittagv2.utils as utils
+from mittagv2.db import doc_path
+
+REQUEST_LATENCY = metrics.REGISTRY.histogram("mittag_asgi_request_duration_seconds",
+    "ASGI request latency by handler and status", ("handler", "status"))
+
+class StorageError(Exception):
+    """Failed CouchDB request"""
+
+    def __init__(self, status, body):
+        super().__init__("HTTP {}: {}".format(status, body[:200]))
+        self.status = status
+
+class ConnectionPool:
+    """Keep-alive HTTP connections to a single server for asyncio, through
+    an httpx.AsyncClient. At most size requests are in flight, further
+    requests wait for a free connection."""
+
+    DEFAULT_SIZE = 20
+    TIMEOUT = 30 #: Time in seconds a request may take
+
+    def __init__(self, url, size=None, timeout=None, auth=None):
+        parts = urlsplit(url)
+        self.size = size if size else ConnectionPool.DEFAULT_SIZE
+        self.timeout = timeout if timeout else ConnectionPool.TIMEOUT
+        if auth is None and parts.username:
+            auth = (unquote(parts.username), unquote(parts.password or ""))
+        self._auth = auth
+        self._base = "{}://{}{}".format(parts.scheme, parts.netloc.rpartition("@")[2], parts.path.rstrip("/"))
+        self._client = None # created on first use, within the event loop
+
+    def _connect(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(auth=self._auth, timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.size, max_keepalive_connections=self.size))
+        return self._client
+
+    async def request(self, method, path, body=None, headers=None):
+        """Issue a request and return (status, headers, body), with header
+        names in lower case"""
+        request_headers = {"Content-Type": "application/json"} if body is not None else {}
+        if headers:
+            request_headers.update(headers)
+        response = await self._connect().request(method, self._base + path, content=body,
+            headers=request_headers)
+        return response.status_code, { k.lower(): v for k, v in response.headers.items() }, response.content
+
+    def stream(self, method, path, body=None, headers=None):
+        """Issue a request whose response is read incrementally, without
+        read timeout (event streams). Returns an async context manager
+        yielding the httpx.Response."""
+        return self._connect().stream(method, self._base + path, content=body, headers=headers,
+            timeout=httpx.Timeout(self.timeout, read=None))
+
+    async def close(self):
+        """Close idle connections"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+class AsyncCouchStorage:
+    """Async reads from CouchDB, with the collections and views of
+    mittagv2.storage.CouchStorage. Configured via the COUCHDB_* environment
+    variables like mittagv2.utils.couch_connect."""
+
+    def __init__(self, url=None, user=None, auth=None, pool_size=None):
+        if not url:
+            url = os.getenv("COUCHDB_URL", "http://127.0.0.1:5984")
+        if not user:
+            user = os.getenv("COUCHDB_USER", "admin")
+        if not auth:
+            auth = os.getenv("COUCHDB_PASSWORD", "admin")
+        self.pool = ConnectionPool(url, size=pool_size, auth=(user, auth))
+
+    def _database(self, collection):
+        return "mv2_" + collection
+
+    async def _request(self, method, collection, path="", params=None, document=None):
+        url = "/" + quote(self._database(collection), safe="")
+        if path:
+            url += "/" + path
+        if params:
+            url += "?" + urlencode(params)
+        body = json.dumps(document).encode("utf-8") if document is not None else None
+        status, _, data = await self.pool.request(method, url, body=body)
+        if status == 404:
+            raise KeyError(path or collection)
+        if status >= 400:
+            raise StorageError(status, data)
+        return data
+
+    async def _json(self, method, collection, path="", params=None, document=None):
+        return json.loads((await self._request(method, collection, path, params, document)).decode("utf-8"))
+
+    async def get(self, collection, doc_id):
+        return await self._json("GET", collection, doc_path(doc_id))
+
+    async def get_many(self, collection, doc_ids):
+        res = await self._json("POST", collection, "_all_docs", params={"include_docs": "true"},
+            document={"keys": list(doc_ids)})
+        return [ row.get("doc") for row in res["rows"] ]
+
+    async def ids(self, collection):
+        res = await self._json("GET", collection, "_all_docs")
+        return [ row["id"] for row in res["rows"] if not row["id"].startswith("_design/") ]
+
+    async def weekly_menu_ids(self):
+        res = await self._json("GET", storage.MENUS, "_design/views/_view/byYearWeek")
+        return [ row["id"] for row in res["rows"] ]
+
+    async def get_blob(self, collection, doc_id, name=None):
+        document = await self.get(collection, doc_id)
+        attachments = document.get("_attachments", {})
+        if name is None:
+            if len(attachments) == 0:
+                raise KeyError(doc_id)
+            name = list(attachments.keys())[0]
+        if name not in attachments:
+            raise KeyError(name)
+        data = await self._request("GET", collection, "{}/{}".format(doc_path(doc_id), quote(name, safe="")))
+        return name, attachments[name]["content_type"], data
+
+    async def close(self):
+        await self.pool.close()
+
+class ThreadedStorage:
+    """Async reads from a blocking storage backend (see mittagv2.storage),
+    run in a thread pool"""
+
+    def __init__(self, backend, executor=None):
+        self.backend = backend
+        self._executor = executor
+
+    def _run(self, function, *args):
+        return asyncio.get_event_loop().run_in_executor(self._executor, function, *args)
+
+    async def get(self, collection, doc_id):
+        return await self._run(self.backend.get, collection, doc_id)
+
+    async def get_many(self, collection, doc_ids):
+        return await self._run(self.backend.get_many, collection, doc_ids)
+
+    async def ids(self, collection):
+        return await self._run(self.backend.ids, collection)
+
+    async def weekly_menu_ids(self):
+        return await self._run(self.backend.weekly_menu_ids)
+
+    async def get_blob(self, collection, doc_id, name=None):
+        return await self._run(self.backend.get_blob, collection, doc_id, name)
+
+    async def close(self):
+        pass
+
+def open_async_storage(url=None, pool_size=None):
+    """Open async storage by URL like mittagv2.storage.open_storage: CouchDB
+    directly, other backends in a thread pool"""
+    if not url:
+        url = os.getenv("MITTAG_STORAGE", "couchdb")
+    if url == "couchdb":
+        return AsyncCouchStorage(pool_size=pool_size)
+    return ThreadedStorage(storage.open_storage(url))
+
+class Response:
+    def __init__(self, status=200, body=b"", content_type=None, headers=None):
+        self.status = status
+        self.body = body
+        self.headers = dict(headers) if headers else {}
+        if content_type:
+            self.headers["Content-Type"] = content_type
+
+#: Headers of a single connection, not passed on when forwarding
+HOP_HEADERS = frozenset(["connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te",
+    "trailer", "transfer-encoding", "upgrade"])
+
+def json_response(value):
+    return Response(body=json.dumps(value).encode("utf-8"), content_type="application/json")
+
+def error_response(status, message=None):
+    phrase = HTTPStatus(status).phrase
+    body = "{} {}\n{}".format(status, phrase, message or "").strip() + "\n"
+    return Response(status, body.encode("utf-8"), "text/plain; charset=utf-8")
+
+class App:
+    """ASGI application with the handlers of mittagv2.web.Root (index),
+    Menus, Scrapings and Bundle. Other requests are passed on to
+    mittagv2.web if its URL is given (upstream), so a proxy can route all
+    of / and /api/v1/ here."""
+
+    MENUS_CACHE_TTL = 60 #: Time in seconds current menus are cached
+    BUNDLE_CACHE_TTL = 60 #: Time in seconds bundles are cached
+    PAGES_CACHE_TTL = 600 #: Time in seconds pages rendered from day read models are kept
+    MAX_BODY = 65536 #: Maximum size of request bodies in bytes
+    #: Admission cost and whether it is heavy by handler, as in mittagv2.web
+    COSTS = {
+        "index": (1, False),
+        "menus": (1, False),
+        "menus_batch": (5, False),
+        "scrapings": (10, True),
+        "scrapings_batch": (5, False),
+        "bundle": (1, False),
+        "metrics": (1, False),
+    }
+
+    def __init__(self, backend, archive=None, upstream=None, admission=None):
+        self._storage = backend
+        self._archive = archive
+        self._upstream = upstream
+        # heavy requests do not wait for a slot, that would block the loop
+        self._admission = admission if admission else ratelimit.Admission(heavy_timeout=0)
+        self._renderer = handlers.PageRenderer()
+        self._menus_cache = cache.TTLCache("asgi_weekly_menus", App.MENUS_CACHE_TTL)
+        self._bundles = cache.TTLCache("asgi_week_bundles", App.BUNDLE_CACHE_TTL)
+        self._pages = cache.TTLCache("asgi_day_pages", App.PAGES_CACHE_TTL, max_entries=32)
+        self._api = {
+            "menus": self._menus,
+            "scrapings": self._scrapings,
+            "bundle": self._bundle,
+        }
+        self._collections = {
+            "menus": storage.MENUS,
+            "scrapings": storage.SCRAPINGS,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self._storage.close()
+                if self._upstream is not None:
+                    await self._upstream.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _route(self, segments):
+        """Handler and arguments of a path, or (None, None) if it is not
+        served here"""
+        if len(segments) == 0:
+            return self._index, []
+        if segments == ["metrics"]:
+            return self._metrics, []
+        if segments[:2] != ["api", "v1"] or len(segments) < 3 or segments[2] not in self._api:
+            return None, None
+        name, args = segments[2], segments[3:]
+        if name == "menus":
+            # changes and revisions are served by mittagv2.web
+            known = len(args) <= 2 and "changes" not in args and "revision" not in args
+        elif name == "scrapings":
+            known = len(args) <= 1 or (len(args) == 2 and args[1] == "attachment")
+        else:
+            known = len(args) <= 1
+        return (self._api[name], args) if known else (None, None)
+
+    async def _http(self, scope, receive, send):
+        start = time.perf_counter()
+        segments = [ s for s in scope["path"].split("/") if s ]
+        query = { k: v[0] for k, v in parse_qs(scope["query_string"].decode("latin-1")).items() }
+        request_headers = { k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"] }
+        handler, args = self._route(segments)
+        if handler is None and self._upstream is not None:
+            status = await self._forward(scope, receive, send)
+            REQUEST_LATENCY.observe(time.perf_counter() - start, handler="forward", status=str(status))
+            return
+        handler_name = "other"
+        heavy = False
+        try:
+            if handler is None:
+                raise handlers.HTTPError(404)
+            handler_name = handler.__name__.lstrip("_")
+            if args == ["_batch"] and segments[2] in self._collections:
+                handler_name += "_batch"
+            cost, heavy = App.COSTS[handler_name]
+            shed = self._admission.admit((scope.get("client") or ("",))[0], handler_name, cost, heavy)
+            if shed is not None:
+                heavy = False
+                reason, wait = shed
+                response = error_response(429, "too many requests ({} limit)".format(reason))
+                response.headers["Retry-After"] = ratelimit.retry_after(wait)
+            elif handler_name.endswith("_batch"):
+                if scope["method"] != "POST":
+                    raise handlers.HTTPError(405)
+                response = await self._batch(segments[2], await self._read_json(receive))
+            elif scope["method"] not in ("GET", "HEAD"):
+                raise handlers.HTTPError(405)
+            else:
+                response = await handler(args, query, request_headers)
+        except handlers.HTTPError as ex:
+            response = error_response(ex.status, ex.message)
+        except Exception:
+            logging.exception("request %s failed", scope["path"])
+            response = error_response(500)
+        finally:
+            if heavy:
+                self._admission.release()
+        await self._send(send, scope["method"], response)
+        REQUEST_LATENCY.observe(time.perf_counter() - start, handler=handler_name,
+            status=str(response.status))
+
+    async def _send(self, send, method, response):
+        headers = [ (k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in response.headers.items() ]
+        headers.append((b"content-length", str(len(response.body)).encode("latin-1")))
+        await send({"type": "http.response.start", "status": response.status, "headers": headers})
+        await send({"type": "http.response.body", "body": b"" if method == "HEAD" else response.body})
+
+    async def _forward(self, scope, receive, send):
+        """Pass a request on to mittagv2.web, streaming the response (event
+        streams). Returns the status."""
+        path = (scope.get("raw_path") or quote(scope["path"]).encode("latin-1")).decode("latin-1")
+        if scope["query_string"]:
+            path += "?" + scope["query_string"].decode("latin-1")
+        headers = [ (k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]
+            if k.decode("latin-1").lower() not in HOP_HEADERS and k.lower() != b"x-forwarded-for" ]
+        if scope.get("client"):
+            # client address for the rate limits of mittagv2.web (tools.proxy)
+            headers.append(("X-Forwarded-For", scope["client"][0]))
+        started = False
+        try:
+            body = await self._read_body(receive)
+            async with self._upstream.stream(scope["method"], path, body, headers) as response:
+                await send({"type": "http.response.start", "status": response.status_code, "headers": [
+                    (k.lower(), v) for k, v in response.headers.raw if k.lower().decode("latin-1") not in HOP_HEADERS ]})
+                started = True
+                async for chunk in response.aiter_raw():
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            status = response.status_code
+        except handlers.HTTPError as ex:
+            await self._send(send, scope["method"], error_response(ex.status, ex.message))
+            return ex.status
+        except httpx.HTTPError as ex:
+            if started:
+                logging.info("forwarding %s interrupted: %s", scope["path"], ex)
+                status = response.status_code
+            else:
+                logging.warning("forwarding %s failed: %s", scope["path"], ex)
+                await self._send(send, scope["method"], error_response(502))
+                return 502
+        await send({"type": "http.response.body", "body": b""})
+        return status
+
+    async def _read_body(self, receive):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if len(body) > App.MAX_BODY:
+                raise handlers.HTTPError(413)
+            if not message.get("more_body", False):
+                return body
+
+    async def _read_json(self, receive):
+        body = await self._read_body(receive)
+        try:
+            return json.loads(body.decode("utf-8"))
+        except ValueError:
+            raise handlers.HTTPError(400, "invalid JSON")
+
+    async def _batch(self, name, request):
+        """Several documents at once (see mittagv2.web.Menus.batch)"""
+        collection = self._collections[name]
+        doc_ids, fields = handlers.parse_batch(request, keyed=collection == storage.MENUS)
+        return json_response(handlers.batch_rows(doc_ids, await self._storage.get_many(collection, doc_ids),
+            fields))
+
+    async def _metrics(self, args, query, request_headers):
+        """Prometheus metrics of this process"""
+        return Response(body=metrics.REGISTRY.render().encode("utf-8"), content_type=metrics.Registry.CONTENT_TYPE)
+
+    async def _index(self, args, query, request_headers):
+        day_number = handlers.parse_day(query.get("day"))
+        date = datetime.date.today() + datetime.timedelta(days=day_number - utils.current_day())
+        document = await self._read_model(readmodels.day_id(date))
+        if document is not None:
+            etag = "\"{}-{}\"".format(document["_rev"], self._renderer.version)
+            if handlers.etag_matches(etag, request_headers.get("if-none-match")):
+                return Response(304, headers={"ETag": etag})
+            key = (document["_id"], document["_rev"])
+            page = self._pages.lookup(key)
+            if page is None:
+                page = self._renderer.render_day(document["sources"], date).encode("utf-8")
+                self._pages.store(key, page)
+            return Response(body=page, content_type="text/html; charset=UTF-8", headers={"ETag": etag})
+        year_week = utils.current_year_week()
+        menus = self._menus_cache.lookup(year_week)
+        if menus is None:
+            menus = handlers.menus_by_source(
+                await self._storage.get_many(storage.MENUS, handlers.week_menu_ids(year_week)))
+            self._menus_cache.store(year_week, menus)
+        return Response(body=self._renderer.render(menus, day_number).encode("utf-8"),
+            content_type="text/html; charset=UTF-8")
+
+    async def _read_model(self, doc_id):
+        """Read model (see mittagv2.readmodels) or None"""
+        try:
+            return await self._storage.get(storage.READ_MODELS, doc_id)
+        except KeyError:
+            return None
+
+    async def _menus(self, args, query, request_headers):
+        if len(args) == 0:
+            return json_response(await self._storage.weekly_menu_ids())
+        if len(args) > 2:
+            raise handlers.HTTPError(404)
+        # ids look like swsh-mensa/2019-07 and span two path segments
+        return json_response(await self._public(storage.MENUS, "/".join(args)))
+
+    async def _scrapings(self, args, query, request_headers):
+        if len(args) == 0:
+            return json_response(await self._storage.ids(storage.SCRAPINGS))
+        if len(args) == 1:
+            return json_response(await self._public(storage.SCRAPINGS, args[0]))
+        if len(args) == 2 and args[1] == "attachment":
+            return await self._attachment(args[0])
+        raise handlers.HTTPError(404)
+
+    async def _public(self, collection, doc_id):
+        try:
+            return handlers.public(await self._storage.get(collection, doc_id))
+        except KeyError:
+            raise handlers.HTTPError(404)
+
+    async def _attachment(self, scraping):
+        try:
+            try:
+                attachment_name, content_type, data = await self._storage.get_blob(storage.SCRAPINGS, scraping)
+            except KeyError:
+                if self._archive is None:
+                    raise
+                # moved to the archive (see mittagv2.retention)
+                attachment_name, location = retention.archived_blob(
+                    await self._storage.get(storage.SCRAPINGS, scraping))
+                content_type = location["content_type"]
+                data = await asyncio.get_event_loop().run_in_executor(None, self._archive.load, location)
+        except KeyError:
+            raise handlers.HTTPError(404)
+        return Response(body=data, content_type=content_type, headers={
+            "Content-Disposition": "attachment; filename=\"{}\"".format(attachment_name)})
+
+    async def _bundle(self, args, query, request_headers):
+        if len(args) > 1:
+            raise handlers.HTTPError(404)
+        year_week = handlers.parse_year_week(args[0] if args else None)
+        bundle = self._bundles.lookup(year_week)
+        if bundle is None:
+            week = await self._read_model(readmodels.week_id(year_week))
+            if week is not None:
+                bundle = handlers.week_bundle(week)
+            else:
+                bundle = handlers.build_bundle(year_week,
+                    await self._storage.get_many(storage.MENUS, handlers.week_menu_ids(year_week)))
+            self._bundles.store(year_week, bundle)
+        version, body = bundle
+        headers = handlers.bundle_headers(version, query.get("v"))
+        if handlers.etag_matches(headers["ETag"], request_headers.get("if-none-match")):
+            del headers["Content-Type"]
+            return Response(304, headers=headers)
+        return Response(body=body, headers=headers)
+
+def main():
+    parser = argparse.ArgumentParser(description="mittagv2 asyncio server")
+    parser.add_argument("--host", default="0.0.0.0", help="listen address")
+    parser.add_argument("--port", type=int, default=1235, help="listen port")
+    parser.add_argument("--pool-size", type=int, default=ConnectionPool.DEFAULT_SIZE,
+        help="CouchDB connections")
+    parser.add_argument("--upstream", default=os.getenv("MITTAG_WEB_URL"),
+        help="URL of mittagv2.web, which serves all other requests (default: $MITTAG_WEB_URL)")
+    parser.add_argument("--debug", "-d", action="store_true", help="debug mode")
+    args = parser.parse_args()
+    try:
+        import uvicorn
+    except ImportError:
+        parser.error("the asyncio server needs uvicorn (pip install uvicorn)")
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    app = App(open_async_storage(pool_size=args.pool_size), retention.open_archive(),
+        ConnectionPool(args.upstream) if args.upstream else None)
+    uvicorn.run(app, host=args.host, port=args.port, lifespan="on",
+        log_level="debug" if args.debug else "warning", proxy_headers=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,475 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import hashlib
+import json
+import logging
+import os
+import queue
+import socket
+import struct
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from urllib.parse import urlsplit
+import mittagv2.metrics as metrics
+import mittagv2.storage as storage
+
+CACHE_REQUESTS = metrics.REGISTRY.counter("mittag_cache_requests",
+    "Cache lookups by cache and result (hit or miss)", ("cache", "result"))
+SHARED_REQUESTS = metrics.REGISTRY.counter("mittag_shared_cache_requests",
+    "Shared cache tier lookups by cache and result (hit, miss, coalesced or error)", ("cache", "result"))
+
+_MISSING = object()
+
+class TTLCache:
+    """Small thread-safe cache whose entries expire after a fixed time"""
+
+    def __init__(self, name, ttl, max_entries=128):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """Get cached value for key, calling compute() on a miss"""
+        value = self.lookup(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.store(key, value)
+        return value
+
+    def lookup(self, key, default=None):
+        """Get cached value for key, or default on a miss. Together with
+        store() for callers that compute values asynchronously."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            CACHE_REQUESTS.inc(cache=self.name, result="hit")
+            return entry[1]
+        CACHE_REQUESTS.inc(cache=self.name, result="miss")
+        return default
+
+    def store(self, key, value):
+        """Cache value for key"""
+        now = time.monotonic()
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries = { k: e for k, e in self._entries.items() if e[0] > now }
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+            self._entries[key] = (now + self.ttl, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class StoreError(Exception):
+    """Failed request to a shared cache store"""
+
+STORE_ERRORS = (StoreError, OSError) #: Errors of shared cache stores
+
+class SharedStore(ABC):
+    """Byte values with expiry, shared by processes"""
+
+    @abstractmethod
+    def get_many(self, keys):
+        """Get values of keys, None for missing ones"""
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    @abstractmethod
+    def set(self, key, value, ttl):
+        """Store value for ttl seconds"""
+
+    @abstractmethod
+    def add(self, key, value, ttl):
+        """Store value only if key is missing, returns whether it was stored"""
+
+    @abstractmethod
+    def delete(self, key):
+        """Remove key"""
+
+class DiskStore(SharedStore):
+    """Store with a file per key in a directory, e.g. on a tmpfs such as
+    /dev/shm to share memory between the processes of a host. Files start
+    with their expiry time and are replaced atomically."""
+
+    HEADER = struct.Struct("!d")
+    PURGE_INTERVAL = 600 #: Time in seconds between removals of expired files
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._purged = time.monotonic()
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def get_many(self, keys):
+        return [ self._read(self._path(key)) for key in keys ]
+
+    def _read(self, path):
+        try:
+            with open(path, "rb") as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            return None
+        if len(data) < DiskStore.HEADER.size or DiskStore.HEADER.unpack_from(data)[0] < time.time():
+            return None
+        return data[DiskStore.HEADER.size:]
+
+    def set(self, key, value, ttl):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(DiskStore.HEADER.pack(time.time() + ttl) + value)
+            os.replace(temp_path, self._path(key))
+        except:
+            os.unlink(temp_path)
+            raise
+        if time.monotonic() - self._purged > DiskStore.PURGE_INTERVAL:
+            self.purge()
+
+    def add(self, key, value, ttl):
+        path = self._path(key)
+        for attempt in range(2):
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            except FileExistsError:
+                if self._read(path) is not None:
+                    return False
+                # expired, remove and try again
+                self._unlink(path)
+                continue
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(DiskStore.HEADER.pack(time.time() + ttl) + value)
+            return True
+        return False
+
+    def delete(self, key):
+        self._unlink(self._path(key))
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def purge(self):
+        """Remove expired files"""
+        self._purged = time.monotonic()
+        for name in os.listdir(self.directory):
+            if not name.startswith(".") and self._read(os.path.join(self.directory, name)) is None:
+                self._unlink(os.path.join(self.directory, name))
+
+class RedisStore(SharedStore):
+    """Store on a Redis server (or anything speaking its protocol, RESP),
+    with a pool of connections"""
+
+    TIMEOUT = 2 #: Socket timeout in seconds
+    POOL_SIZE = 8 #: Maximum number of idle connections kept
+
+    def __init__(self, host="127.0.0.1", port=6379, db=0, password=None, timeout=None):
+        self.address = (host, port)
+        self.db = db
+        self.password = password
+        self.timeout = timeout if timeout else RedisStore.TIMEOUT
+        self._idle = queue.LifoQueue(RedisStore.POOL_SIZE)
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, self.timeout)
+        connection = (sock, sock.makefile("rb"))
+        if self.password:
+            self._call(connection, "AUTH", self.password)
+        if self.db:
+            self._call(connection, "SELECT", str(self.db))
+        return connection
+
+    def execute(self, *args):
+        """Run a command, returns its reply"""
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            connection = None
+        try:
+            if connection is None:
+                connection = self._connect()
+            reply = self._call(connection, *args)
+        except (OSError, StoreError) as ex:
+            if connection is not None:
+                connection[0].close()
+            raise StoreError(str(ex))
+        try:
+            self._idle.put_nowait(connection)
+        except queue.Full:
+            connection[0].close()
+        return reply
+
+    def _call(self, connection, *args):
+        sock, reader = connection
+        command = [ a if isinstance(a, bytes) else str(a).encode("utf-8") for a in args ]
+        sock.sendall(b"*%d\r\n" % len(command) + b"".join(
+            b"$%d\r\n%s\r\n" % (len(a), a) for a in command))
+        return self._reply(reader)
+
+    def _reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise StoreError("connection closed")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode("utf-8")
+        if kind == b"-":
+            raise StoreError(payload.decode("utf-8"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(payload)
+            return None if length < 0 else [ self._reply(reader) for _ in range(length) ]
+        raise StoreError("unexpected reply {!r}".format(line))
+
+    def get_many(self, keys):
+        return self.execute("MGET", *keys) if keys else []
+
+    def set(self, key, value, ttl):
+        self.execute("SET", key, value, "EX", max(1, int(ttl)))
+
+    def add(self, key, value, ttl):
+        return self.execute("SET", key, value, "EX", max(1, int(ttl)), "NX") is not None
+
+    def delete(self, key):
+        self.execute("DEL", key)
+
+def open_shared_store(url=None):
+    """Open a shared cache store from a URL, "redis://[:password@]host[:port][/db]"
+    or "file:///path/to/directory", defaulting to the MITTAG_CACHE environment
+    variable. Returns None without URL, so that caches stay process-local."""
+    url = url if url is not None else os.getenv("MITTAG_CACHE", "")
+    if not url:
+        return None
+    parts = urlsplit(url)
+    if parts.scheme == "redis":
+        db = int(parts.path.strip("/")) if parts.path.strip("/") else 0
+        return RedisStore(parts.hostname or "127.0.0.1", parts.port or 6379, db, parts.password)
+    if parts.scheme == "file":
+        return DiskStore(parts.path)
+    raise ValueError("unknown cache store {}".format(url))
+
+_shared_store = _MISSING
+_shared_store_lock = threading.Lock()
+
+def shared_store():
+    """Get the process-wide shared cache store (or None), opened on first use"""
+    global _shared_store
+    if _shared_store is _MISSING:
+        with _shared_store_lock:
+            if _shared_store is _MISSING:
+                _shared_store = open_shared_store()
+    return _shared_store
+
+def dependency(collection, doc_id):
+    """Name of a stored document that cached values depend on, see
+    SharedCache and CacheInvalidator"""
+    return "{}:{}".format(collection, doc_id)
+
+class Versions:
+    """Versions of the documents cached values depend on, kept in the shared
+    store: the revision last seen in the change feed (see CacheInvalidator),
+    or "0". Versions are cached in the process for a moment."""
+
+    TTL = 7 * 24 * 3600 #: Time in seconds versions are kept in the store
+    LOCAL_TTL = 1 #: Time in seconds versions are cached in the process
+
+    def __init__(self, store):
+        self.store = store
+        self._local = TTLCache("cache_versions", Versions.LOCAL_TTL, max_entries=1024)
+
+    def get_many(self, names):
+        versions = [ self._local.lookup(name) for name in names ]
+        missing = [ name for name, version in zip(names, versions) if version is None ]
+        if missing:
+            fetched = dict(zip(missing, self.store.get_many([ "version:" + n for n in missing ])))
+            for i, name in enumerate(names):
+                if versions[i] is None:
+                    value = fetched[name]
+                    versions[i] = value.decode("utf-8") if value is not None else "0"
+                    self._local.store(name, versions[i])
+        return versions
+
+    def set(self, name, version):
+        self.store.set("version:" + name, version.encode("utf-8"), Versions.TTL)
+        self._local.store(name, version)
+
+def json_encode(value):
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+def json_decode(data):
+    return json.loads(data.decode("utf-8"))
+
+class SharedCache:
+    """Cache shared by the processes of a deployment (e.g. several web
+    replicas): a TTLCache in each process in front of a shared store (see
+    open_shared_store). Keys are versioned by the documents the values
+    depend on (see dependency()), so that changed documents invalidate them
+    everywhere at once. Computations of a missing value are coalesced, in
+    the process and across processes, so that a popular key does not hit
+    the database once per request or replica when it expires.
+
+    Without a shared store, this is a plain TTLCache."""
+
+    LOCK_TTL = 10 #: Time in seconds a computation holds the lock of its key
+    LOCK_WAIT = 2 #: Time in seconds to wait for another process computing a value
+    POLL_INTERVAL = 0.05 #: Interval in seconds of checks for a value computed elsewhere
+
+    def __init__(self, name, ttl, store=_MISSING, encode=json_encode, decode=json_decode, max_entries=128):
+        self.name = name
+        self.ttl = ttl
+        self.store = shared_store() if store is _MISSING else store
+        self.encode = encode
+        self.decode = decode
+        self._local = TTLCache(name, ttl, max_entries)
+        self._versions = Versions(self.store) if self.store is not None else None
+        self._computing = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, compute, depends=()):
+        """Get cached value for key, calling compute() on a miss. The value
+        is invalidated when a document in depends changes."""
+        if self.store is None:
+            return self._local.get(key, compute)
+        try:
+            versions = self._versions.get_many(list(depends))
+        except STORE_ERRORS:
+            logging.warning("shared cache {} unavailable".format(self.name), exc_info=True)
+            SHARED_REQUESTS.inc(cache=self.name, result="error")
+            return self._local.get(key, compute)
+        versioned = "{}:{}@{}".format(self.name, key, ",".join(versions))
+        value = self._local.lookup(versioned, _MISSING)
+        if value is not _MISSING:
+            return value
+        with self._lock:
+            computing = self._computing.get(versioned)
+            leader = computing is None
+            if leader:
+                computing = self._computing[versioned] = threading.Event()
+        if not leader:
+            computing.wait(SharedCache.LOCK_TTL)
+            value = self._local.lookup(versioned, _MISSING)
+            if value is not _MISSING:
+                SHARED_REQUESTS.inc(cache=self.name, result="coalesced")
+                return value
+            return compute()
+        try:
+            value = self._load(versioned, compute)
+            self._local.store(versioned, value)
+            return value
+        finally:
+            with self._lock:
+                del self._computing[versioned]
+            computing.set()
+
+    def _load(self, versioned, compute):
+        """Get value from the shared store, or compute and store it, unless
+        another process is computing it already"""
+        try:
+            data = self.store.get(versioned)
+            if data is not None:
+                SHARED_REQUESTS.inc(cache=self.name, result="hit")
+                return self.decode(data)
+            SHARED_REQUESTS.inc(cache=self.name, result="miss")
+            lock = "lock:" + versioned
+            if not self.store.add(lock, b"1", SharedCache.LOCK_TTL):
+                deadline = time.monotonic() + SharedCache.LOCK_WAIT
+                while time.monotonic() < deadline:
+                    time.sleep(SharedCache.POLL_INTERVAL)
+                    data = self.store.get(versioned)
+                    if data is not None:
+                        SHARED_REQUESTS.inc(cache=self.name, result="coalesced")
+                        return self.decode(data)
+                lock = None
+            try:
+                value = compute()
+                self.store.set(versioned, self.encode(value), self.ttl)
+            finally:
+                if lock is not None:
+                    self.store.delete(lock)
+            return value
+        except STORE_ERRORS:
+            logging.warning("shared cache {} unavailable".format(self.name), exc_info=True)
+            SHARED_REQUESTS.inc(cache=self.name, result="error")
+            return compute()
+
+class CacheInvalidator:
+    """Follows the change feeds of the collections cached values depend on
+    and records the new revisions as versions (see SharedCache). Every
+    process with shared caches runs one; they all write the same versions.
+    Values depending on documents changed while no process followed the
+    feeds are stale until they expire."""
+
+    COLLECTIONS = (storage.MENUS, storage.READ_MODELS) #: Followed collections
+    POLL_TIMEOUT = 30 #: Timeout in seconds of a change feed long poll
+    ERROR_WAIT_TIME = 5 #: Wait time in seconds after a failed feed request
+
+    def __init__(self, backend, store):
+        self.storage = backend
+        self.versions = Versions(store)
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start following the change feeds (once)"""
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+        for collection in CacheInvalidator.COLLECTIONS:
+            since = self.storage.changes(collection, since="now")[0]
+            t = threading.Thread(target=self._follow, args=(collection, since), daemon=True)
+            t.start()
+
+    def _follow(self, collection, since):
+        while True:
+            try:
+                since = self.poll(collection, since, CacheInvalidator.POLL_TIMEOUT)
+            except Exception:
+                logging.exception("following {} changes for cache invalidation failed".format(collection))
+                time.sleep(CacheInvalidator.ERROR_WAIT_TIME)
+
+    def poll(self, collection, since, timeout=0):
+        """Record versions of the changes after since, returns the new
+        feed position"""
+        since, changes = self.storage.changes(collection, since=since, timeout=timeout)
+        for change in changes:
+            self.versions.set(dependency(collection, change["id"]), change["rev"])
+        return since
@@ -0,0 +1,194 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import json
+import threading
+import time
+from urllib.parse import quote
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import mittagv2.metrics as metrics
+import mittagv2.utils as utils
+
+POOL_WAIT = metrics.REGISTRY.histogram("mittag_couch_pool_wait_seconds",
+    "Time spent waiting for a free CouchDB connection",
+    buckets=(.0001, .001, .005, .01, .05, .1, .5, 1, 5))
+POOL_IN_USE = metrics.REGISTRY.gauge("mittag_couch_pool_in_use",
+    "CouchDB connections currently in use")
+
+class PoolStats:
+    """Thread-safe counters for connection pool usage"""
+
+    def __init__(self, size):
+        self.size = size
+        self.in_use = 0
+        self.requests = 0
+        self.wait_count = 0 #: Requests that had to wait for a free connection
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def acquired(self, wait_time):
+        with self._lock:
+            self.in_use += 1
+            self.requests += 1
+            self.wait_seconds += wait_time
+            if wait_time > 0.001:
+                self.wait_count += 1
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_time)
+
+    def released(self):
+        with self._lock:
+            self.in_use -= 1
+
+    def snapshot(self):
+        """Get consistent copy of all counters"""
+        with self._lock:
+            return {
+                "size": self.size,
+                "in_use": self.in_use,
+                "requests": self.requests,
+                "wait_count": self.wait_count,
+                "wait_seconds": self.wait_seconds,
+                "max_wait_seconds": self.max_wait_seconds,
+            }
+
+class PoolAdapter(HTTPAdapter):
+    """HTTP adapter with a bounded, blocking connection pool. Requests wait
+    for a free connection instead of opening unbounded extra ones, and the
+    wait time is recorded in stats"""
+
+    def __init__(self, pool_size, max_retries=None):
+        self.stats = PoolStats(pool_size)
+        self._slots = threading.BoundedSemaphore(pool_size)
+        if max_retries is None:
+            # retry idempotent requests on connection errors, e.g. while
+            # CouchDB restarts
+            max_retries = Retry(total=3, read=False, backoff_factor=0.5)
+        super().__init__(pool_connections=1, pool_maxsize=pool_size,
+            pool_block=True, max_retries=max_retries)
+
+    def send(self, request, **kwargs):
+        start = time.perf_counter()
+        self._slots.acquire()
+        wait_time = time.perf_counter() - start
+        self.stats.acquired(wait_time)
+        POOL_WAIT.observe(wait_time)
+        POOL_IN_USE.set(self.stats.in_use)
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            self._slots.release()
+            self.stats.released()
+            POOL_IN_USE.set(self.stats.in_use)
+
+class CouchClient:
+    """Thread-safe CouchDB client shared by all threads of a process. Reads
+    use plain HTTP requests through a bounded connection pool instead of the
+    unsynchronized document caches of cloudant's database objects. The
+    session is opened on first use and renewed automatically once the
+    cookie expires."""
+
+    DEFAULT_POOL_SIZE = 10 #: Matches CherryPy's default server.thread_pool
+    DEFAULT_TIMEOUT = (5, 30) #: Connect and read timeout in seconds
+
+    def __init__(self, user=None, auth=None, url=None, pool_size=None, timeout=None):
+        self._user = user
+        self._auth = auth
+        self._url = url
+        self.timeout = timeout if timeout else CouchClient.DEFAULT_TIMEOUT
+        self.adapter = PoolAdapter(pool_size if pool_size else CouchClient.DEFAULT_POOL_SIZE)
+        self._couch = None
+        self._lock = threading.Lock()
+
+    @property
+    def couch(self):
+        """Underlying cloudant client, connected on first access"""
+        if self._couch is None:
+            with self._lock:
+                if self._couch is None:
+                    self._couch = utils.couch_connect(self._user, self._auth, self._url,
+                        adapter=self.adapter, timeout=self.timeout, auto_renew=True)
+        return self._couch
+
+    def pool_stats(self):
+        """Get connection pool statistics"""
+        return self.adapter.stats.snapshot()
+
+    def database(self, name):
+        """Get cloudant database object, e.g. for writes"""
+        return self.couch[name]
+
+    def request(self, method, database, path="", **kwargs):
+        """Issue a request relative to a database URL and return the
+        response. Raises KeyError for missing documents and HTTPError for
+        any other failure."""
+        url = "{}/{}".format(self.couch.server_url, quote(database, safe=""))
+        if path:
+            url += "/" + path
+        response = self.couch.r_session.request(method, url, **kwargs)
+        if response.status_code == 404:
+            raise KeyError(path or database)
+        response.raise_for_status()
+        return response
+
+    def get_document(self, database, doc_id):
+        """Fetch a single document as dict"""
+        return self.request("GET", database, doc_path(doc_id)).json()
+
+    def get_attachment(self, database, doc_id, name):
+        """Fetch raw attachment data"""
+        path = "{}/{}".format(doc_path(doc_id), quote(name, safe=""))
+        return self.request("GET", database, path).content
+
+    def all_docs(self, database, keys=None, **params):
+        """Query _all_docs, optionally restricted to a list of keys"""
+        params = _encode_params(params)
+        if keys is not None:
+            return self.request("POST", database, "_all_docs", params=params,
+                json={"keys": keys}).json()["rows"]
+        return self.request("GET", database, "_all_docs", params=params).json()["rows"]
+
+    def view(self, database, design, view, keys=None, **params):
+        """Query a view, optionally restricted to a list of keys"""
+        path = "_design/{}/_view/{}".format(quote(design, safe=""), quote(view, safe=""))
+        params = _encode_params(params)
+        if keys is not None:
+            return self.request("POST", database, path, params=params,
+                json={"keys": keys}).json()["rows"]
+        return self.request("GET", database, path, params=params).json()["rows"]
+
+def doc_path(doc_id):
+    """URL path component for a document id"""
+    if doc_id.startswith("_design/"):
+        return "_design/" + quote(doc_id[len("_design/"):], safe="")
+    return quote(doc_id, safe="")
+
+def _encode_params(params):
+    """Encode view query parameters the way CouchDB expects them (JSON)"""
+    encoded = {}
+    for name, value in params.items():
+        if name in ("key", "startkey", "endkey", "start_key", "end_key") or isinstance(value, bool):
+            encoded[name] = json.dumps(value)
+        else:
+            encoded[name] = value
+    return encoded
@@ -0,0 +1,273 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+"""Near-duplicate dish detection. Dish names and descriptions are spelled
+inconsistently across sources and weeks ("Schnitzel vom Schwein",
+"Schweineschnitzel"), so dishes are compared by the character trigrams of
+their words. Each dish gets a MinHash signature, which estimates the
+Jaccard similarity of two trigram sets, and signatures are bucketed by
+locality sensitive hashing (LSH): dishes sharing any band of their
+signature are candidates, so finding similar dishes only looks at a few
+buckets instead of the whole history. Similar dishes are merged into
+clusters, named after their most served dish.
+
+The index is built incrementally from the change feed of the weekly
+menus, so it follows menus as they are stored."""
+
+import hashlib
+import logging
+import re
+import threading
+import time
+import zlib
+import numpy as np
+import mittagv2.storage as storage
+
+NUM_PERM = 128 #: MinHash signature length
+BANDS = 32 #: LSH bands, of NUM_PERM / BANDS rows each
+THRESHOLD = 0.5 #: Estimated similarity from which dishes are clustered
+SHINGLE_SIZE = 3
+BATCH_SIZE = 100 #: Menus fetched per request while following changes
+STOPWORDS = {"mit", "und", "vom", "von", "der", "die", "das", "dem", "den", "des", "auf", "aus",
+    "in", "im", "an", "am", "zu", "dazu", "oder", "nach", "art", "ein", "eine", "einem", "einer"}
+UMLAUTS = {"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"}
+NON_WORD = re.compile(r"[^a-z0-9]+")
+
+_PRIME = (1 << 31) - 1
+_random = np.random.RandomState(20190107)
+_A = _random.randint(1, _PRIME, NUM_PERM).astype(np.uint64)
+_B = _random.randint(0, _PRIME, NUM_PERM).astype(np.uint64)
+
+def normalize(text):
+    """Significant words of a text, lower case with umlauts spelled out"""
+    text = text.lower()
+    for umlaut, replacement in UMLAUTS.items():
+        text = text.replace(umlaut, replacement)
+    return [ w for w in NON_WORD.split(text) if w and w not in STOPWORDS ]
+
+def shingles(text):
+    """Character trigrams of the words of a text"""
+    result = set()
+    for word in normalize(text):
+        if len(word) <= SHINGLE_SIZE:
+            result.add(word)
+        else:
+            result.update(word[i:i + SHINGLE_SIZE] for i in range(len(word) - SHINGLE_SIZE + 1))
+    return result
+
+def signature(shingle_set):
+    """MinHash signature of a set of shingles"""
+    if not shingle_set:
+        return np.full(NUM_PERM, _PRIME, dtype=np.uint64)
+    hashes = np.array([ zlib.crc32(s.encode("utf-8")) for s in shingle_set ], dtype=np.uint64)
+    return ((_A[:, None] * hashes[None, :] + _B[:, None]) % _PRIME).min(axis=1)
+
+def similarity(first, second):
+    """Estimated Jaccard similarity of two signatures"""
+    return float(np.mean(first == second))
+
+def dish_text(menu):
+    return " ".join(part for part in (menu.get("name", ""), menu.get("description", "")) if part)
+
+def dish_id(menu):
+    """Id of a dish: equal up to case, punctuation and filler words"""
+    return hashlib.sha1(" ".join(normalize(dish_text(menu))).encode("utf-8")).hexdigest()[:12]
+
+class Dish:
+    """A dish as spelled in some menus, and where it was served"""
+
+    def __init__(self, id, name, description, signature):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.signature = signature
+        self.occurrences = {} #: Lists of (source name, year+week, day number) by menu document id
+
+    def served(self):
+        """Occurrences as (source name, year+week, day number), latest first"""
+        return sorted(( o for days in self.occurrences.values() for o in days ), key=lambda o: o[1:], reverse=True)
+
+    def to_dict(self):
+        served = self.served()
+        return {
+            "id": self.id,
+            "name": self.name,
+            "description": self.description,
+            "served": len(served),
+            "last_served": { "source_name": served[0][0], "year_week": served[0][1], "day": served[0][2] }
+                if served else None,
+        }
+
+class DishIndex:
+    """MinHash/LSH index of dishes with clusters of similar ones"""
+
+    def __init__(self, threshold=THRESHOLD):
+        self.threshold = threshold
+        self.dishes = {} #: Dishes by id
+        self._buckets = [ {} for _ in range(BANDS) ]
+        self._parent = {}
+        self._members = {}
+        self._menus = {}
+        self._lock = threading.RLock()
+
+    def _bands(self, sig):
+        rows = NUM_PERM // BANDS
+        return [ sig[i * rows:(i + 1) * rows].tobytes() for i in range(BANDS) ]
+
+    def _candidates(self, sig):
+        found = set()
+        for band, key in zip(self._buckets, self._bands(sig)):
+            found.update(band.get(key, ()))
+        return found
+
+    def _root(self, dish_id):
+        root = dish_id
+        while self._parent[root] != root:
+            root = self._parent[root]
+        while self._parent[dish_id] != root:
+            self._parent[dish_id], dish_id = root, self._parent[dish_id]
+        return root
+
+    def _union(self, first, second):
+        first, second = self._root(first), self._root(second)
+        if first == second:
+            return
+        if len(self._members[first]) < len(self._members[second]):
+            first, second = second, first
+        self._parent[second] = first
+        self._members[first] |= self._members.pop(second)
+
+    def _dish(self, menu):
+        """Get or add the dish of a menu"""
+        key = dish_id(menu)
+        dish = self.dishes.get(key)
+        if dish is not None:
+            return dish
+        dish = Dish(key, menu.get("name", ""), menu.get("description"), signature(shingles(dish_text(menu))))
+        candidates = self._candidates(dish.signature)
+        self.dishes[key] = dish
+        self._parent[key] = key
+        self._members[key] = {key}
+        for band, band_key in zip(self._buckets, self._bands(dish.signature)):
+            band.setdefault(band_key, set()).add(key)
+        for other in candidates:
+            if similarity(dish.signature, self.dishes[other].signature) >= self.threshold:
+                self._union(key, other)
+        return dish
+
+    def add_menu(self, document):
+        """Add or update the dishes of a weekly_menu document"""
+        with self._lock:
+            self.remove_menu(document["_id"])
+            occurrences = {}
+            year_week = document["menus"].get("year_week")
+            for day in document["menus"].get("days", []):
+                for menu in day["menus"]:
+                    dish = self._dish(menu)
+                    occurrences.setdefault(dish.id, []).append((document.get("source_name"), year_week, day["day"]))
+            for key, days in occurrences.items():
+                self.dishes[key].occurrences[document["_id"]] = days
+            self._menus[document["_id"]] = list(occurrences.keys())
+
+    def remove_menu(self, menu_id):
+        """Forget where a weekly menu's dishes were served"""
+        with self._lock:
+            for key in self._menus.pop(menu_id, []):
+                self.dishes[key].occurrences.pop(menu_id, None)
+
+    def similar(self, dish_id, limit=10):
+        """Dishes similar to a dish, as (dish, estimated similarity), most
+        similar first. Raises KeyError for unknown dishes."""
+        with self._lock:
+            dish = self.dishes[dish_id]
+            scored = [ (self.dishes[other], similarity(dish.signature, self.dishes[other].signature))
+                for other in self._candidates(dish.signature) if other != dish_id ]
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return [ item for item in scored if item[1] >= self.threshold ][:limit]
+
+    def cluster(self, dish_id):
+        """Dishes clustered with a dish (including itself), canonical one
+        (most often served) first"""
+        with self._lock:
+            members = [ self.dishes[key] for key in self._members[self._root(dish_id)] ]
+        members.sort(key=lambda dish: (-len(dish.served()), dish.name))
+        return members
+
+    def clusters(self):
+        """All clusters as lists of dishes, canonical one first, largest
+        clusters first"""
+        with self._lock:
+            roots = list(self._members.keys())
+        clusters = [ self.cluster(root) for root in roots ]
+        clusters.sort(key=lambda members: (-len(members), members[0].name))
+        return clusters
+
+class MenuDishIndex(DishIndex):
+    """Dish index following the weekly menus of a storage backend"""
+
+    POLL_TIMEOUT = 30 #: Timeout in seconds of a change feed long poll
+    ERROR_WAIT_TIME = 5 #: Wait time in seconds after a failed feed request
+
+    def __init__(self, backend, threshold=THRESHOLD):
+        super().__init__(threshold)
+        self.storage = backend
+        self.ready = threading.Event() #: Set once the whole history is indexed
+        self._since = None
+        self._refresh_lock = threading.Lock()
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Build the index and follow the change feed in the background
+        (once)"""
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._follow, daemon=True).start()
+
+    def _follow(self):
+        while True:
+            try:
+                self.refresh(MenuDishIndex.POLL_TIMEOUT if self.ready.is_set() else 0)
+                self.ready.set()
+            except Exception:
+                logging.exception("following weekly menu changes for the dish index failed")
+                time.sleep(MenuDishIndex.ERROR_WAIT_TIME)
+
+    def refresh(self, timeout=0):
+        """Apply weekly menus stored or removed since the last refresh,
+        waiting up to timeout seconds for the first change"""
+        with self._refresh_lock:
+            last_seq, changes = self.storage.changes(storage.MENUS, since=self._since, timeout=timeout)
+            latest = {}
+            for change in changes:
+                latest[change["id"]] = change["deleted"]
+            ids = [ doc_id for doc_id, deleted in latest.items() if not deleted ]
+            for doc_id, deleted in latest.items():
+                if deleted:
+                    self.remove_menu(doc_id)
+            for i in range(0, len(ids), BATCH_SIZE):
+                for document in self.storage.get_many(storage.MENUS, ids[i:i + BATCH_SIZE]):
+                    if document is not None and document.get("type") == "weekly_menu":
+                        self.add_menu(document)
+            self._since = last_seq
@@ -0,0 +1,169 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import collections
+import json
+import logging
+import threading
+import time
+import uuid
+import mittagv2.metrics as metrics
+import mittagv2.storage as storage
+
+SUBSCRIBERS = metrics.REGISTRY.gauge("mittag_event_subscribers",
+    "Clients connected to the event stream")
+EVENTS = metrics.REGISTRY.counter("mittag_events", "Published events by kind", ("kind",))
+
+class Event:
+    """Published event. Ids are <epoch>-<number>, the epoch changes with
+    every process start so that stale ids from clients are detected."""
+
+    def __init__(self, number, event_id, kind, data):
+        self.number = number
+        self.id = event_id
+        self.kind = kind
+        self.data = data
+
+    def encode(self):
+        """Encode as Server-Sent Events message"""
+        return "id: {}\nevent: {}\ndata: {}\n\n".format(self.id, self.kind,
+            json.dumps(self.data, separators=(",", ":"))).encode("utf-8")
+
+class EventHub:
+    """Follows the menus and scrapings change feeds and fans out compact
+    events ("menu" on every stored weekly menu, "scrape" once per scrape
+    log) to any number of subscribers. There is a single consumer per feed
+    and process, however many clients are connected. The latest events are
+    kept so that reconnecting clients can resume where they left off."""
+
+    BACKLOG = 256 #: Number of events kept for resuming clients
+    POLL_TIMEOUT = 30 #: Timeout in seconds of a change feed long poll
+    ERROR_WAIT_TIME = 5 #: Wait time in seconds after a failed feed request
+    KEEPALIVE = 15 #: Interval in seconds of keep-alive messages to subscribers
+
+    def __init__(self, backend):
+        self.storage = backend
+        self.epoch = uuid.uuid4().hex[:8]
+        self._events = collections.deque(maxlen=EventHub.BACKLOG)
+        self._number = 0
+        self._condition = threading.Condition()
+        self._scrapes_seen = collections.OrderedDict()
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start following the change feeds (once)"""
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+        for collection, handler in ((storage.MENUS, self._menu_changed),
+                (storage.SCRAPINGS, self._scraping_changed)):
+            since = self.storage.changes(collection, since="now")[0]
+            t = threading.Thread(target=self._follow, args=(collection, handler, since), daemon=True)
+            t.start()
+
+    def publish(self, kind, data):
+        with self._condition:
+            self._number += 1
+            event = Event(self._number, "{}-{}".format(self.epoch, self._number), kind, data)
+            self._events.append(event)
+            self._condition.notify_all()
+        EVENTS.inc(kind=kind)
+        return event
+
+    def events_after(self, event_id):
+        """Get the events after the given one, or None if it is unknown or
+        no longer in the backlog"""
+        epoch, _, number = (event_id or "").partition("-")
+        if epoch != self.epoch or not number.isdigit():
+            return None
+        number = int(number)
+        with self._condition:
+            if number > self._number or (self._events and number < self._events[0].number - 1):
+                return None
+            return [ e for e in self._events if e.number > number ]
+
+    def subscribe(self, last_event_id=None, duration=None):
+        """Generate events for a subscriber, resuming after last_event_id if
+        given. A "reset" event tells the client that events were missed.
+        None is generated every KEEPALIVE seconds without events. Ends
+        after duration seconds, if given."""
+        self.start()
+        SUBSCRIBERS.inc()
+        try:
+            with self._condition:
+                number = self._number
+            if last_event_id:
+                missed = self.events_after(last_event_id)
+                if missed is None:
+                    yield Event(number, "{}-{}".format(self.epoch, number), "reset", {})
+                else:
+                    for event in missed:
+                        number = event.number
+                        yield event
+            deadline = time.monotonic() + duration if duration is not None else None
+            while deadline is None or time.monotonic() < deadline:
+                with self._condition:
+                    self._condition.wait_for(lambda: self._number > number, EventHub.KEEPALIVE)
+                    pending = [ e for e in self._events if e.number > number ]
+                if len(pending) == 0:
+                    yield None
+                for event in pending:
+                    number = event.number
+                    yield event
+        finally:
+            SUBSCRIBERS.dec()
+
+    def _follow(self, collection, handler, since):
+        while True:
+            try:
+                since, changes = self.storage.changes(collection, since=since,
+                    timeout=EventHub.POLL_TIMEOUT)
+                for change in changes:
+                    handler(change)
+            except Exception:
+                logging.exception("following {} changes failed".format(collection))
+                time.sleep(EventHub.ERROR_WAIT_TIME)
+
+    def _menu_changed(self, change):
+        if change["deleted"] or "/" not in change["id"]:
+            return
+        source_name, year_week = change["id"].split("/", 1)
+        self.publish("menu", {"id": change["id"], "source_name": source_name,
+            "year_week": year_week, "rev": change["rev"]})
+
+    def _scraping_changed(self, change):
+        # scrape logs are updated with their blob and timings after creation
+        if change["deleted"] or change["id"] in self._scrapes_seen:
+            return
+        try:
+            document = self.storage.get(storage.SCRAPINGS, change["id"])
+        except KeyError:
+            return
+        if document.get("type") != "scrape_log":
+            return
+        self._scrapes_seen[change["id"]] = True
+        if len(self._scrapes_seen) > EventHub.BACKLOG:
+            self._scrapes_seen.popitem(last=False)
+        self.publish("scrape", {"id": change["id"], "source_name": document.get("source_name"),
+            "year_week": document.get("year_week"), "success": document.get("success", False)})
@@ -0,0 +1,240 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from xml.sax.saxutils import escape
+import mittagv2.sources as sources
+import mittagv2.storage as storage
+import mittagv2.utils as utils
+
+DAY_NAMES = ["Montag", "Dienstag", "Mittwoch", "Donnerstag", "Freitag", "Samstag", "Sonntag"]
+
+def _price(value):
+    return "{:.2f} €".format(value).replace(".", ",")
+
+def menu_text(menu):
+    """Plain text line describing a menu"""
+    text = menu["name"]
+    if menu.get("menu_type"):
+        text = "{}: {}".format(menu["menu_type"], text)
+    if menu.get("description"):
+        text += " ({})".format(menu["description"].replace("\n", " "))
+    prices = [ _price(menu[k]) for k in ("student_price", "reduced_price", "normal_price") if menu.get(k) ]
+    if prices:
+        text += " – " + " / ".join(prices)
+    if menu.get("vegetarian"):
+        text += " – vegetarisch"
+    return text
+
+def day_items(source, document):
+    """Feed items of a weekly_menu document, one per day with menus"""
+    year_week = document["menus"]["year_week"]
+    start = utils.week_start(year_week)
+    items = []
+    for index, day in enumerate(document["menus"]["days"]):
+        if len(day["menus"]) == 0:
+            continue
+        day_number = day.get("day", index)
+        date = start + timedelta(days=day_number)
+        lines = [ menu_text(m) for m in day["menus"] ]
+        if document["menus"].get("notice"):
+            lines.append(document["menus"]["notice"])
+        items.append({
+            "id": "{}/{}/{}".format(source.name, year_week, day_number),
+            "source": source,
+            "date": date,
+            "title": "{}: {}, {}".format(source.title, DAY_NAMES[day_number], date.isoformat()),
+            "text": "\n".join(lines),
+        })
+    return items
+
+def json_feed(title, feed_url, home_url, items):
+    feed = {
+        "version": "https://jsonfeed.org/version/1",
+        "title": title,
+        "home_page_url": home_url,
+        "feed_url": feed_url,
+        "items": [ {
+            "id": item["id"],
+            "url": item["source"].link_for(item["date"].isocalendar()[1]),
+            "title": item["title"],
+            "content_text": item["text"],
+            "date_published": item["date"].isoformat() + "T00:00:00Z",
+            "tags": [item["source"].name],
+        } for item in items ],
+    }
+    return json.dumps(feed, ensure_ascii=False, indent=1, sort_keys=True).encode("utf-8")
+
+def rss_feed(title, feed_url, home_url, items):
+    lines = [
+        "<?xml version=\"1.0\" encoding=\"UTF-8\"?>",
+        "<rss version=\"2.0\">",
+        "<channel>",
+        "<title>{}</title>".format(escape(title)),
+        "<link>{}</link>".format(escape(home_url)),
+        "<description>{}</description>".format(escape(title)),
+    ]
+    for item in items:
+        published = datetime(item["date"].year, item["date"].month, item["date"].day, tzinfo=timezone.utc)
+        lines.extend([
+            "<item>",
+            "<title>{}</title>".format(escape(item["title"])),
+            "<link>{}</link>".format(escape(item["source"].link_for(item["date"].isocalendar()[1]))),
+            "<description>{}</description>".format(escape(item["text"]).replace("\n", "&lt;br&gt;")),
+            "<guid isPermaLink=\"false\">{}</guid>".format(escape(item["id"])),
+            "<pubDate>{}</pubDate>".format(format_datetime(published)),
+            "</item>",
+        ])
+    lines.extend(["</channel>", "</rss>", ""])
+    return "\n".join(lines).encode("utf-8")
+
+def _ical_text(value):
+    return value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+def _ical_fold(line):
+    """Fold content line to 75 octets (RFC 5545, 3.1)"""
+    data = line.encode("utf-8")
+    parts = []
+    while len(data) > 75:
+        cut = 75 if not parts else 74
+        while cut > 0 and (data[cut] & 0xC0) == 0x80:
+            cut -= 1 # do not split UTF-8 sequences
+        parts.append(data[:cut])
+        data = data[cut:]
+    parts.append(data)
+    return b"\r\n ".join(parts).decode("utf-8")
+
+def ical_feed(title, feed_url, home_url, items):
+    """iCalendar with one all-day event per day and source"""
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//mittagv2//Speiseplan//DE",
+        "X-WR-CALNAME:" + _ical_text(title),
+    ]
+    for item in items:
+        # stamped with the day itself, so unchanged menus give unchanged files
+        lines.extend([
+            "BEGIN:VEVENT",
+            "UID:{}@mittagv2".format(item["id"]),
+            "DTSTAMP:{}T000000Z".format(item["date"].strftime("%Y%m%d")),
+            "DTSTART;VALUE=DATE:{}".format(item["date"].strftime("%Y%m%d")),
+            "DTEND;VALUE=DATE:{}".format((item["date"] + timedelta(days=1)).strftime("%Y%m%d")),
+            "SUMMARY:" + _ical_text(item["source"].title),
+            "DESCRIPTION:" + _ical_text(item["text"]),
+            "URL:" + item["source"].link_for(item["date"].isocalendar()[1]),
+            "END:VEVENT",
+        ])
+    lines.append("END:VCALENDAR")
+    return ("\r\n".join(_ical_fold(l) for l in lines) + "\r\n").encode("utf-8")
+
+FORMATS = {
+    "json": json_feed,
+    "rss": rss_feed,
+    "ics": ical_feed,
+}
+
+class FeedGenerator:
+    """Writes static feeds (JSON Feed, RSS, iCalendar) of the stored menus,
+    to be served by the static tier:
+
+        <directory>/<year-week>/<source>.<format>  one source, one week
+        <directory>/<year-week>/all.<format>       all sources, one week
+        <directory>/<source>.<format>              one source, recent weeks
+        <directory>/all.<format>                   all sources, recent weeks
+
+    Files are replaced atomically and only if their content changed."""
+
+    RECENT_WEEKS = 2 #: Number of weeks in the rolling feeds
+
+    def __init__(self, backend, directory, base_url="/"):
+        self.storage = backend
+        self.directory = directory
+        self.base_url = base_url.rstrip("/") + "/"
+
+    def update(self, year_week):
+        """Regenerate the feeds of a week and, if it is recent, the rolling
+        feeds. Returns paths of the files that changed."""
+        recent = [ utils.year_week(year, week) for year, week in utils.recent_weeks(FeedGenerator.RECENT_WEEKS) ]
+        items = self._items(year_week)
+        changed = self._write_all(year_week + "/", "Speiseplan {}".format(year_week), items)
+        if year_week in recent:
+            rolling = []
+            for week in reversed(recent):
+                rolling.extend(items if week == year_week else self._items(week))
+            changed.extend(self._write_all("", "Speiseplan", rolling))
+        return changed
+
+    def _items(self, year_week):
+        ids = [ utils.menu_id(s.name, year_week) for s in sources.SOURCES ]
+        items = []
+        for source, document in zip(sources.SOURCES, self.storage.get_many(storage.MENUS, ids)):
+            if document is not None:
+                items.extend(day_items(source, document))
+        items.sort(key=lambda item: item["date"])
+        return items
+
+    def _write_all(self, prefix, title, items):
+        changed = []
+        feeds = [ ("all", title, items) ]
+        for source in sources.SOURCES:
+            feeds.append((source.name, "{} – {}".format(title, source.title),
+                [ i for i in items if i["source"] is source ]))
+        for name, feed_title, feed_items in feeds:
+            for extension, render in FORMATS.items():
+                path = "{}{}.{}".format(prefix, name, extension)
+                data = render(feed_title, self.base_url + "feeds/" + path, self.base_url, feed_items)
+                if self._write(path, data):
+                    changed.append(path)
+        return changed
+
+    def _write(self, path, data):
+        full_path = os.path.join(self.directory, path)
+        try:
+            with open(full_path, "rb") as fp:
+                if fp.read() == data:
+                    return False
+        except IOError:
+            pass
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(full_path), prefix=".feed")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(data)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, full_path)
+        except:
+            os.unlink(temp_path)
+            raise
+        return True
+
+def open_feeds(backend):
+    """Feed generator configured by MITTAG_FEEDS_DIR (and MITTAG_BASE_URL
+    for absolute links), or None"""
+    directory = os.getenv("MITTAG_FEEDS_DIR")
+    if not directory:
+        return None
+    return FeedGenerator(backend, directory, os.getenv("MITTAG_BASE_URL", "/"))
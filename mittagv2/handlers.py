@@ -0,0 +1,252 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+"""Request handling shared by the serving modes, CherryPy (mittagv2.web)
+and ASGI (mittagv2.asgi). Handlers are split into the documents to fetch
+and pure functions that build responses from them, so that each mode
+fetches in its own way, blocking or async."""
+
+import datetime
+import hashlib
+import json
+from html import escape
+from string import Template
+import mittagv2.readmodels as readmodels
+import mittagv2.sources as sources
+import mittagv2.utils as utils
+
+DAY_NAMES = ["Montag", "Dienstag", "Mittwoch", "Donnerstag", "Freitag", "Samstag", "Sonntag"]
+BATCH_LIMIT = 200 #: Maximum number of documents per batch request
+
+class HTTPError(Exception):
+    """Error response with HTTP status"""
+
+    def __init__(self, status, message=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+def public(document):
+    """Document without storage metadata, as served by the API"""
+    return { k: v for k, v in document.items() if k not in ("_id", "_rev") }
+
+def parse_year_week(value=None):
+    """Normalize year+week from a request (default: current week)"""
+    if value is None:
+        return utils.current_year_week()
+    try:
+        year_week = utils.normalize_year_week(value)
+        utils.week_start(year_week) # e.g. week 60
+    except ValueError:
+        raise HTTPError(404)
+    return year_week
+
+def parse_day(value=None):
+    """Day number from a request (default: today)"""
+    if not value:
+        return utils.current_day()
+    try:
+        day_number = int(value)
+    except (TypeError, ValueError):
+        raise HTTPError(400, "illegal day number")
+    if day_number < 0 or day_number > 6:
+        raise HTTPError(400, "illegal day number")
+    return day_number
+
+def parse_revision(value=None, default=0):
+    """Revision number of a weekly menu from a request"""
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise HTTPError(400, "illegal revision")
+    if number < 0:
+        raise HTTPError(400, "illegal revision")
+    return number
+
+def parse_batch(request, keyed=False):
+    """Document ids and fields of a batch request: an object with a list of
+    "keys" and optionally a list of "fields" to project the documents to
+    (names, or dotted paths into nested objects). Keys are document ids or,
+    if keyed, [source_name, year_week] pairs or objects with these names."""
+    if not isinstance(request, dict) or not isinstance(request.get("keys"), list):
+        raise HTTPError(400, "expected an object with a list of keys")
+    if len(request["keys"]) > BATCH_LIMIT:
+        raise HTTPError(400, "too many keys")
+    fields = request.get("fields")
+    if fields is not None and (not isinstance(fields, list)
+            or not all(isinstance(f, str) and f for f in fields)):
+        raise HTTPError(400, "fields must be a list of names")
+    return [ _batch_id(key, keyed) for key in request["keys"] ], fields
+
+def _batch_id(key, keyed):
+    if isinstance(key, str):
+        return key
+    if keyed and isinstance(key, dict):
+        key = [key.get("source_name"), key.get("year_week")]
+    if keyed and isinstance(key, list) and len(key) == 2 and all(isinstance(k, str) for k in key):
+        try:
+            return utils.menu_id(key[0], utils.normalize_year_week(key[1]))
+        except ValueError:
+            raise HTTPError(400, "illegal year_week")
+    raise HTTPError(400, "illegal key")
+
+def project(document, fields):
+    """Document reduced to the given fields (see parse_batch)"""
+    result = {}
+    for field in fields:
+        path = field.split(".")
+        value = document
+        for name in path:
+            if not isinstance(value, dict) or name not in value:
+                break
+            value = value[name]
+        else:
+            target = result
+            for name in path[:-1]:
+                target = target.setdefault(name, {})
+            target[path[-1]] = value
+    return result
+
+def batch_rows(doc_ids, documents, fields=None):
+    """Batch response, like the one of CouchDB's _all_docs: a row per key
+    in request order, with the public document or an error"""
+    rows = []
+    for doc_id, document in zip(doc_ids, documents):
+        if document is None:
+            rows.append({"id": doc_id, "error": "not_found"})
+        else:
+            document = public(document)
+            rows.append({"id": doc_id, "doc": project(document, fields) if fields is not None else document})
+    return {"rows": rows}
+
+week_menu_ids = readmodels.week_menu_ids
+
+def menus_by_source(documents):
+    """Weekly menus by source name, from the documents of week_menu_ids()"""
+    return { d["source_name"]: d["menus"] for d in documents if d is not None }
+
+def build_bundle(year_week, documents):
+    """Week bundle (see mittagv2.web.Bundle) from the documents of
+    week_menu_ids(year_week), returns its version and serialization"""
+    return _serialize_bundle(year_week, utils.week_start(year_week).isoformat(),
+        readmodels.week_sources(year_week, documents))
+
+def week_bundle(week):
+    """Week bundle from the week read model (see mittagv2.readmodels), same
+    as build_bundle()"""
+    return _serialize_bundle(week["year_week"], week["start"], week["sources"])
+
+def _serialize_bundle(year_week, start, entries):
+    bundle = {
+        "year_week": year_week,
+        "start": start,
+        "sources": entries
+    }
+    body = json.dumps(bundle, separators=(",", ":"), sort_keys=True).encode("utf-8")
+    return hashlib.sha1(body).hexdigest()[:16], body
+
+def bundle_headers(version, requested_version=None):
+    """Response headers of a week bundle"""
+    return {
+        "Content-Type": "application/json",
+        "ETag": "\"{}\"".format(version),
+        "Cache-Control": "public, max-age=31536000, immutable" if requested_version == version else "no-cache",
+    }
+
+def etag_matches(etag, if_none_match):
+    """Whether an If-None-Match request header matches an ETag"""
+    if not if_none_match:
+        return False
+    tags = [ t.strip() for t in if_none_match.split(",") ]
+    return "*" in tags or etag in tags or "W/" + etag in tags
+
+class PageRenderer:
+    """Renders the menu page of a day from the current week's menus"""
+
+    def __init__(self, template_path="mittagv2/resources/dynamic_template.html"):
+        with open(template_path) as fp:
+            text = fp.read()
+        self._template = Template(text)
+        #: Changes with the template, for validators of rendered pages
+        self.version = hashlib.sha1(text.encode("utf-8")).hexdigest()[:8]
+
+    def render(self, menus, day_number):
+        """Render page from weekly menus by source name"""
+        date = datetime.date.today() + datetime.timedelta(days=day_number - utils.current_day())
+        return self.render_day(readmodels.day_sources(menus, day_number), date)
+
+    def render_day(self, day, date):
+        """Render page of a date from its menus by source name, as in the
+        day read model (see mittagv2.readmodels)"""
+        week_number = date.isocalendar()[1]
+        header_cells = []
+        menu_cells = []
+        for source in sources.SOURCES:
+            header_cells.append("<th>\n<a href=\"{}\" target=\"_blank\">{}</a>\n</th>".format(
+                escape(source.link_for(week_number)), escape(source.title)))
+            entry = day.get(source.name)
+            if entry is not None:
+                html = self.day_to_html(entry, entry)
+            else:
+                html = "<p>Keine Daten vorhanden!</p>"
+            menu_cells.append("<td valign=\"top\">\n{}\n</td>".format(html))
+        date_string = "{}, {}".format(DAY_NAMES[date.weekday()], date.isoformat())
+        return self._template.substitute(HEADER_CELLS="\n".join(header_cells),
+            MENU_CELLS="\n".join(menu_cells), DATE_STRING=date_string)
+
+    def day_to_html(self, day, week):
+        html = ""
+        for menu in day["menus"]:
+            html += self.menu_to_html(menu)
+        if "notice" in week:
+            html += "<p>{}</p>".format(escape(week["notice"]).replace("\n", "<br>"))
+        return html
+
+    def menu_to_html(self, menu):
+        name = menu["name"]
+        if "menu_type" in menu and len(menu["menu_type"]) > 0:
+            name = "{}: {}".format(menu["menu_type"], menu["name"])
+        html = "<p><strong>{}</strong></p>".format(escape(name))
+        if "description" in menu:
+            html_description = escape(menu["description"]).replace("\n", "<br>")
+            html += "<p>{}</p>".format(html_description)
+        attributes = []
+        if "calories" in menu:
+            attributes.append("{:d} kcal".format(menu["calories"]))
+        if "vegetarian" in menu and menu["vegetarian"] == True:
+            attributes.append("vegetarisch")
+        if len(attributes) > 0:
+            html += """<p style="float: right; font-size: 90%; margin-top: 0;">"""
+            html += ", ".join(attributes)
+            html += "</p>"
+        html += """<p style="float: left; margin-top: 0;">"""
+        if "student_price" in menu and menu["student_price"]:
+            html += "{:.2f} € / ".format(menu["student_price"]).replace(".", ",")
+        if "reduced_price" in menu and menu["reduced_price"]:
+            html += "{:.2f} € / ".format(menu["reduced_price"]).replace(".", ",")
+        if "normal_price" in menu and menu["normal_price"]:
+            html += "{:.2f} €".format(menu["normal_price"]).replace(".", ",")
+        html += "</p>"
+        html += """<div style="clear: both;"></div>"""
+        return html
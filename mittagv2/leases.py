@@ -0,0 +1,152 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import mittagv2.storage as storage
+
+def completed_at(document, key):
+    """Time (epoch seconds) the given work was last completed under a
+    lease, by any owner, or None"""
+    return document.get("completed", {}).get(key)
+
+class Lease:
+    """Lease held by this process, kept alive by a heartbeat"""
+
+    def __init__(self, name, document):
+        self.name = name
+        self.document = document
+        self.lost = False #: Whether the lease expired and may be held by somebody else
+        self._completed = None
+
+    def complete(self, key):
+        """Record the given work as completed when the lease is released"""
+        self._completed = key
+
+class LeaseManager:
+    """Leases with expiry, stored as documents and taken over by revision
+    checked updates (compare-and-swap on "_rev"), so that only one of
+    several processes works on a thing at a time. Leases are renewed by a
+    heartbeat while held; leases of crashed processes expire after ttl
+    seconds and can be taken over by others."""
+
+    TTL = 120 #: Default lease duration in seconds
+    COMPLETED_KEPT = 16 #: Number of completed work keys kept per lease
+
+    def __init__(self, backend, owner=None, ttl=None):
+        self.storage = backend
+        self.owner = owner if owner else "{}-{}-{}".format(socket.gethostname(), os.getpid(),
+            uuid.uuid4().hex[:6])
+        self.ttl = ttl if ttl else LeaseManager.TTL
+
+    @property
+    def heartbeat(self):
+        """Interval of lease renewals in seconds"""
+        return self.ttl / 3
+
+    def get(self, name):
+        """Get lease document or None"""
+        try:
+            return self.storage.get(storage.LEASES, name)
+        except KeyError:
+            return None
+
+    def acquire(self, name):
+        """Take the lease if it is free or expired. Returns the lease
+        document or None if it is held, also by another thread of this
+        process. Every acquisition gets its own token."""
+        now = time.time()
+        document = self.get(name)
+        if document is None:
+            document = {"_id": name, "type": "lease"}
+        elif document.get("owner") is not None and document.get("expires", 0) > now:
+            return None
+        document.update(owner=self.owner, token=uuid.uuid4().hex, acquired=now, expires=now + self.ttl)
+        try:
+            self.storage.put(storage.LEASES, document)
+        except storage.Conflict:
+            return None # taken concurrently
+        return document
+
+    def renew(self, document):
+        """Extend a held lease, returns False if it was lost"""
+        document["expires"] = time.time() + self.ttl
+        try:
+            self.storage.put(storage.LEASES, document)
+            return True
+        except storage.Conflict:
+            return False
+
+    def release(self, document, completed=None):
+        """Give up a held lease, optionally recording completed work"""
+        document.update(owner=None, token=None, expires=0)
+        if completed is not None:
+            done = document.setdefault("completed", {})
+            done[completed] = time.time()
+            for key in sorted(done, key=done.get)[:-LeaseManager.COMPLETED_KEPT]:
+                del done[key]
+        try:
+            self.storage.put(storage.LEASES, document)
+        except storage.Conflict:
+            pass # expired and taken over meanwhile
+
+    @contextmanager
+    def hold(self, name):
+        """Hold a lease while in context, yields the Lease or None if it is
+        held by somebody else"""
+        document = self.acquire(name)
+        if document is None:
+            yield None
+            return
+        lease = Lease(name, document)
+        stop = threading.Event()
+
+        def beat():
+            expires = document["expires"]
+            while not stop.wait(self.heartbeat):
+                try:
+                    renewed = self.renew(document)
+                except Exception:
+                    # retried until the last stored expiry has passed
+                    logging.exception("renewing lease {} failed".format(name))
+                    renewed = None if time.time() < expires else False
+                if renewed is False:
+                    logging.warning("lost lease {}".format(name))
+                    lease.lost = True
+                    return
+                if renewed:
+                    expires = document["expires"]
+
+        heartbeat = threading.Thread(target=beat, daemon=True)
+        heartbeat.start()
+        try:
+            yield lease
+        finally:
+            stop.set()
+            heartbeat.join()
+            if not lease.lost:
+                self.release(document, lease._completed)
@@ -0,0 +1,302 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import bisect
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+def _format_labels(names, values):
+    if len(names) == 0:
+        return ""
+    pairs = [ '{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for n, v in zip(names, values) ]
+    return "{" + ",".join(pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Metric(ABC):
+    """Base class for labelled metrics"""
+
+    TYPE = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels.keys()) != set(self.label_names):
+            raise ValueError("{} expects labels {}".format(self.name, self.label_names))
+        return tuple(str(labels[n]) for n in self.label_names)
+
+    @abstractmethod
+    def samples(self):
+        """Get list of (suffix, label names, label values, value)"""
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.TYPE),
+        ]
+        for suffix, names, values, value in self.samples():
+            lines.append("{}{}{} {}".format(self.name, suffix, _format_labels(names, values), _format_value(value)))
+        return "\n".join(lines)
+
+class Counter(Metric):
+    """Monotonically increasing counter"""
+
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [ ("_total", self.label_names, k, v) for k, v in sorted(self._values.items()) ]
+
+class Gauge(Metric):
+    """Value that can go up and down"""
+
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [ ("", self.label_names, k, v) for k, v in sorted(self._values.items()) ]
+
+class Histogram(Metric):
+    """Distribution of observations in cumulative buckets"""
+
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts, _, _ = entry = self._values[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, **labels):
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return entry[2] if entry else 0
+
+    def samples(self):
+        samples = []
+        names = self.label_names + ("le",)
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append(("_bucket", names, key + (_format_value(float(bound)),), cumulative))
+                samples.append(("_sum", self.label_names, key, total))
+                samples.append(("_count", self.label_names, key, count))
+        return samples
+
+class Registry:
+    """Collection of metrics, rendered in Prometheus text format. Collectors
+    are callables run before rendering, e.g. to refresh gauges."""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                existing = self._metrics[metric.name]
+                if type(existing) is not type(metric) or existing.label_names != metric.label_names:
+                    raise ValueError("metric {} already registered".format(metric.name))
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def add_collector(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        with self._lock:
+            collectors = list(self._collectors)
+        for collector in collectors:
+            collector()
+        with self._lock:
+            metrics = [ self._metrics[name] for name in sorted(self._metrics.keys()) ]
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+REGISTRY = Registry() #: Default process-wide registry
+
+class Timings:
+    """Durations of named stages of a single operation, plus free-form
+    measurements like transferred bytes"""
+
+    def __init__(self):
+        self.values = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, value):
+        self.values[name] = self.values.get(name, 0) + value
+
+_current = threading.local()
+
+@contextmanager
+def timed(timings=None):
+    """Make timings the current thread's collection target for stage()"""
+    timings = timings if timings is not None else Timings()
+    previous = getattr(_current, "timings", None)
+    _current.timings = timings
+    try:
+        yield timings
+    finally:
+        _current.timings = previous
+
+@contextmanager
+def stage(name):
+    """Time a stage of the operation being timed in this thread, if any"""
+    timings = getattr(_current, "timings", None)
+    if timings is None:
+        yield
+        return
+    with timings.stage(name):
+        yield
+
+def record(name, value):
+    """Record a measurement for the operation being timed, if any"""
+    timings = getattr(_current, "timings", None)
+    if timings is not None:
+        timings.add(name, value)
+
+class ScrapeLogCollector:
+    """Feeds scrape stage timings from stored scrape_log documents into
+    histograms. Scrapes happen in the scraper process, so the web process
+    follows the scrape log change feed instead of sharing memory, from the
+    time it was created on. Timings are the last write of a scrape log, later
+    updates (e.g. by mittagv2.retention) of logs older than MAX_AGE are not
+    accounted again."""
+
+    BATCH_SIZE = 100
+    MAX_AGE = 3600 #: Age in seconds of scrape logs that are no longer accounted
+
+    def __init__(self, backend, registry=REGISTRY):
+        from mittagv2.storage import SCRAPINGS
+        self.storage = backend
+        self.stages = registry.histogram("mittag_scrape_stage_seconds",
+            "Duration of scrape stages (fetch, parse, serialize, store)", ("source", "stage"))
+        self.ttfb = registry.histogram("mittag_scrape_fetch_ttfb_seconds",
+            "Time until upstream response headers arrived", ("source",))
+        self.bytes = registry.histogram("mittag_scrape_fetch_bytes",
+            "Size of downloaded upstream data", ("source",), buckets=BYTES_BUCKETS)
+        self.scrapes = registry.counter("mittag_scrapes",
+            "Scrape attempts by outcome", ("source", "success"))
+        self._since = backend.changes(SCRAPINGS, since="now")[0]
+        self._lock = threading.Lock()
+
+    def observe(self, document):
+        """Account a single scrape_log document"""
+        source = document.get("source_name", "unknown")
+        self.scrapes.inc(source=source, success=str(document.get("success", False)).lower())
+        timings = document.get("timings", {})
+        for stage in ("fetch", "parse", "serialize", "store"):
+            if stage in timings:
+                self.stages.observe(timings[stage], source=source, stage=stage)
+        if "fetch_ttfb" in timings:
+            self.ttfb.observe(timings["fetch_ttfb"], source=source)
+        if "fetch_bytes" in timings:
+            self.bytes.observe(timings["fetch_bytes"], source=source)
+
+    def __call__(self, now=None):
+        from mittagv2.storage import SCRAPINGS
+        oldest = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime((now or time.time()) - self.MAX_AGE))
+        with self._lock:
+            last_seq, changes = self.storage.changes(SCRAPINGS, since=self._since)
+            # scrape logs get their timings in a final update, documents
+            # without timings are still in progress and will show up again
+            # once complete
+            ids = list(dict.fromkeys(c["id"] for c in changes if not c["deleted"]))
+            for i in range(0, len(ids), ScrapeLogCollector.BATCH_SIZE):
+                documents = self.storage.get_many(SCRAPINGS, ids[i:i + ScrapeLogCollector.BATCH_SIZE])
+                for document in documents:
+                    if (document and document.get("type") == "scrape_log" and "timings" in document
+                            and document.get("at", "") >= oldest):
+                        self.observe(document)
+            self._since = last_seq
@@ -0,0 +1,233 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+"""Adaptive polling of the menu sources. Instead of scraping once at a
+fixed time, each source is polled densely around the time it usually
+publishes a week's menu, learned from the first successful scrape of past
+weeks. Once the menu is stored, the source is only checked every few hours
+with conditional requests (see mittagv2.scraper.Scraper.fetch_if_changed),
+and only content that actually differs is parsed and stored, which picks
+up corrections published mid-week.
+
+Only sources with the week in their URL (see Source.weekly) are learned
+and polled densely: the others always serve their latest menu, so a poll
+early in the week would pick up the previous week's page. Those are
+polled sparsely and the new week counts as published once the content
+differs from the scrape of the previous week's stored menu."""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import mittagv2.metrics as metrics
+import mittagv2.sources as sources
+import mittagv2.storage as storage
+import mittagv2.utils as utils
+
+POLLS = metrics.REGISTRY.counter("mittag_polls",
+    "Source polls by result (missing, not_modified, unchanged, changed, claimed, error)", ("source", "result"))
+
+DAY = 24 * 3600
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+def content_hash(data):
+    """Hash identifying downloaded content"""
+    return hashlib.sha256(data).hexdigest()
+
+def stored_hash(backend, menu_id):
+    """Content hash of the scrape a stored menu came from, or None"""
+    try:
+        scrape_id = backend.get(storage.MENUS, menu_id).get("scrape_id")
+        if scrape_id is None:
+            return None
+        log = backend.get(storage.SCRAPINGS, scrape_id)
+        if "content_hash" in log:
+            return log["content_hash"]
+        return content_hash(backend.get_blob(storage.SCRAPINGS, scrape_id)[2])
+    except KeyError:
+        return None
+
+def week_start_time(year_week):
+    """Epoch seconds of monday 00:00 (local time) of a week"""
+    return time.mktime(utils.week_start(year_week).timetuple())
+
+def week_offset(timestamp):
+    """Seconds since monday 00:00 (local time) of a RFC3339 UTC timestamp,
+    and the year+week it falls into"""
+    at = datetime.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc).astimezone()
+    year, week, weekday = at.isocalendar()
+    return (weekday - 1) * DAY + at.hour * 3600 + at.minute * 60 + at.second, utils.year_week(year, week)
+
+def publish_offsets(logs):
+    """Publication times learned from scrape_log documents: the week
+    offsets (see week_offset) of the first successful scrape of each week
+    by source name. Scrapes after the week was over (catch-up) tell
+    nothing about publication and are ignored."""
+    first = {}
+    for log in logs:
+        if not log.get("success", False) or "at" not in log or "year_week" not in log:
+            continue
+        key = (log["source_name"], log["year_week"])
+        if key not in first or log["at"] < first[key]:
+            first[key] = log["at"]
+    offsets = {}
+    for (source_name, year_week), at in sorted(first.items()):
+        offset, scraped_week = week_offset(at)
+        if scraped_week == year_week:
+            offsets.setdefault(source_name, []).append(offset)
+    return offsets
+
+class SourceState:
+    """Polling state of a source for the current week"""
+
+    def __init__(self, year_week, published, content_hash=None):
+        self.year_week = year_week
+        self.published = published #: Whether the week's menu is stored
+        self.validators = {"content_hash": content_hash} #: ETag, Last-Modified and hash of the stored content
+        self.next_at = 0
+
+class AdaptivePoller:
+    """Decides when to poll which source. Missing menus are polled every
+    DENSE_INTERVAL within the expected publication window and every
+    SPARSE_INTERVAL outside of it; stored menus are checked for changes
+    every CHECK_INTERVAL until the week is over."""
+
+    DENSE_INTERVAL = 600 #: Polling interval for missing menus within the publication window (seconds)
+    SPARSE_INTERVAL = 3600 #: Polling interval for missing menus outside the window (seconds)
+    CHECK_INTERVAL = 4 * 3600 #: Interval of change checks of stored menus (seconds)
+    WINDOW_MARGIN = 1800 #: Time added before and after the learned window (seconds)
+    DEFAULT_WINDOW = 4 * 3600 #: Window length after the declared schedule without enough history (seconds)
+    MIN_SAMPLES = 3 #: Weeks of history needed to learn a window
+    HISTORY_WEEKS = 12 #: Weeks of history used
+
+    def __init__(self, backend):
+        self.storage = backend
+        self._offsets = {}
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def learn(self):
+        """Learn publication times from the stored scrape logs"""
+        oldest = utils.year_week(*utils.recent_weeks(self.HISTORY_WEEKS)[-1])
+        weekly = set( source.name for source in sources.SOURCES if source.weekly )
+        offsets = publish_offsets(log for log in self.storage.scrape_logs(oldest)
+            if log.get("source_name") in weekly)
+        with self._lock:
+            self._offsets = offsets
+        for source in sources.SOURCES:
+            if not source.weekly:
+                continue
+            logging.info("{} publishes between {} and {}".format(source.name,
+                *( self._format_offset(o) for o in self.window(source) )))
+
+    def window(self, source):
+        """Expected publication window of a source as week offsets in
+        seconds: the 10th to 90th percentile of past publication times, or
+        the declared schedule without enough history"""
+        with self._lock:
+            offsets = sorted(self._offsets.get(source.name, [])[-self.HISTORY_WEEKS:])
+        if len(offsets) < self.MIN_SAMPLES:
+            day, at = source.schedule
+            hours, minutes = at.split(":")
+            start = WEEKDAYS.index(day) * DAY + int(hours) * 3600 + int(minutes) * 60
+            return start, start + self.DEFAULT_WINDOW
+        return offsets[int(0.1 * (len(offsets) - 1))], offsets[int(round(0.9 * (len(offsets) - 1)))]
+
+    def _format_offset(self, offset):
+        return "{} {:02d}:{:02d}".format(WEEKDAYS[int(offset // DAY)], int(offset % DAY // 3600),
+            int(offset % 3600 // 60))
+
+    def state(self, source, now=None):
+        """Polling state of a source for the current week, initialized
+        from storage at the start of a week"""
+        year_week = utils.current_year_week()
+        with self._lock:
+            state = self._states.get(source.name)
+        if state is not None and state.year_week == year_week:
+            return state
+        menu_id = utils.menu_id(source.name, year_week)
+        published = menu_id in self.storage.exists(storage.MENUS, [menu_id])
+        if published:
+            state = SourceState(year_week, True, stored_hash(self.storage, menu_id))
+        elif not source.weekly:
+            # still serving last week's menu until that content changes
+            previous = utils.year_week(*(utils.week_start(year_week) - timedelta(weeks=1)).isocalendar()[:2])
+            state = SourceState(year_week, False, stored_hash(self.storage, utils.menu_id(source.name, previous)))
+        else:
+            state = SourceState(year_week, False)
+        # stored menus are checked right away, missing ones are already
+        # taken care of by the catch-up on startup
+        state.next_at = (now or time.time()) if published else self._next_poll(source, state, now)
+        with self._lock:
+            self._states[source.name] = state
+        return state
+
+    def due(self, now=None):
+        """Sources due for polling, most important first"""
+        now = now or time.time()
+        return [ source for source in sources.by_priority() if self.state(source, now).next_at <= now ]
+
+    def polled(self, source, result, validators=None, now=None):
+        """Record the result of a poll (see POLLS) and schedule the next one.
+        Validators are only given once the content is stored (or known to
+        be); after "claimed" the state is reloaded from storage."""
+        now = now or time.time()
+        POLLS.inc(source=source.name, result=result)
+        if result == "claimed":
+            with self._lock:
+                self._states.pop(source.name, None)
+        state = self.state(source, now)
+        if validators is not None:
+            state.validators = dict(validators)
+        if result == "changed" and not state.published:
+            state.published = True
+            if not source.weekly:
+                state.next_at = self._next_poll(source, state, now)
+                return
+            offset = now - week_start_time(state.year_week)
+            with self._lock:
+                self._offsets.setdefault(source.name, []).append(offset)
+        state.next_at = self._next_poll(source, state, now)
+
+    def _next_poll(self, source, state, now=None):
+        now = now or time.time()
+        if state.published:
+            return now + self.CHECK_INTERVAL
+        if not source.weekly:
+            return now + self.SPARSE_INTERVAL
+        week_start = week_start_time(state.year_week)
+        start, end = self.window(source)
+        start, end = week_start + start - self.WINDOW_MARGIN, week_start + end + self.WINDOW_MARGIN
+        if now < start:
+            return min(now + self.SPARSE_INTERVAL, start)
+        if now <= end:
+            return now + self.DENSE_INTERVAL
+        return now + self.SPARSE_INTERVAL
+
+def open_poller(backend):
+    """Adaptive poller, or None if MITTAG_POLLING is "schedule": sources are
+    then scraped at the schedule they declare (see mittagv2.sources)"""
+    if os.getenv("MITTAG_POLLING", "adaptive") == "schedule":
+        return None
+    return AdaptivePoller(backend)
@@ -0,0 +1,181 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import cProfile
+import io
+import logging
+import marshal
+import os
+import pstats
+import random
+import signal
+import threading
+import time
+from contextlib import contextmanager
+
+_active_lock = threading.Lock()
+
+class Profiler:
+    """Profiles a configurable fraction of calls with cProfile and
+    aggregates the results. Only one call per process is profiled at a
+    time, calls arriving meanwhile are not sampled. With a fraction of 0
+    (the default) profiling costs a random number per call."""
+
+    MAX_DEPTH = 64 #: Maximum stack depth in collapsed stacks
+
+    def __init__(self, name, fraction=0.0):
+        self.name = name
+        self.fraction = fraction
+        self.samples = 0
+        self._stats = None
+        self._lock = threading.Lock()
+
+    def configure(self, fraction):
+        """Set fraction of calls to profile, 0 disables profiling"""
+        if fraction < 0 or fraction > 1:
+            raise ValueError("fraction must be between 0 and 1")
+        self.fraction = fraction
+
+    @contextmanager
+    def profile(self):
+        """Profile the enclosed code, if sampled"""
+        if self.fraction <= 0 or random.random() >= self.fraction or not _active_lock.acquire(False):
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+        finally:
+            _active_lock.release()
+            self._add(profile)
+
+    def _add(self, profile):
+        profile.create_stats()
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self.samples += 1
+
+    def reset(self):
+        with self._lock:
+            self._stats = None
+            self.samples = 0
+
+    def status(self):
+        return {"name": self.name, "fraction": self.fraction, "samples": self.samples}
+
+    def pstats_data(self):
+        """Aggregated stats in pstats file format (see pstats.Stats)"""
+        with self._lock:
+            return marshal.dumps(self._stats.stats if self._stats else {})
+
+    def report(self, sort="cumulative", limit=40):
+        """Aggregated stats as text table"""
+        out = io.StringIO()
+        with self._lock:
+            if self._stats is None:
+                return ""
+            self._stats.stream = out
+            self._stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def collapsed(self):
+        """Aggregated stats as collapsed stacks ("a;b;c microseconds" per
+        line) for flame graph tools. cProfile only records caller/callee
+        pairs, so the time of functions with several callers is split up
+        in proportion to the time spent on behalf of each caller."""
+        with self._lock:
+            stats = dict(self._stats.stats) if self._stats else {}
+        callees = {}
+        for func, (_, _, _, _, callers) in stats.items():
+            for caller, caller_stats in callers.items():
+                callees.setdefault(caller, []).append((func, caller_stats[3]))
+        stacks = {}
+
+        def walk(func, stack, share):
+            _, _, tottime, cumtime, _ = stats[func]
+            own = int(tottime * share * 1e6)
+            if own > 0:
+                key = ";".join(stack)
+                stacks[key] = stacks.get(key, 0) + own
+            if len(stack) >= Profiler.MAX_DEPTH:
+                return
+            for callee, via_cumtime in callees.get(func, []):
+                callee_cumtime = stats[callee][3]
+                name = _label(callee)
+                if callee_cumtime <= 0 or name in stack:
+                    continue
+                walk(callee, stack + [name], share * via_cumtime / callee_cumtime)
+
+        for func, (_, _, _, _, callers) in stats.items():
+            if len(callers) == 0:
+                walk(func, [_label(func)], 1.0)
+        return "".join("{} {}\n".format(stack, value) for stack, value in sorted(stacks.items()))
+
+    def dump(self, directory):
+        """Write aggregated stats as <name>-<timestamp>.pstats and
+        .collapsed files, returns their paths"""
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, "{}-{}".format(self.name, time.strftime("%Y%m%dT%H%M%S")))
+        with open(base + ".pstats", "wb") as fp:
+            fp.write(self.pstats_data())
+        with open(base + ".collapsed", "w") as fp:
+            fp.write(self.collapsed())
+        return [base + ".pstats", base + ".collapsed"]
+
+def _label(func):
+    filename, line, name = func
+    if filename == "~":
+        return name
+    return "{}:{}:{}".format(os.path.basename(filename), line, name)
+
+WEB = Profiler("web") #: Profiler for web requests
+SCRAPER = Profiler("scraper") #: Profiler for scrapes
+PROFILERS = { p.name: p for p in (WEB, SCRAPER) }
+
+def get(name):
+    """Get profiler by name"""
+    return PROFILERS[name]
+
+def default_directory():
+    return os.getenv("MITTAG_PROFILE_DIR", "/tmp/mittagv2-profiles")
+
+def install_signal_handlers(profiler, directory=None, fraction=1.0):
+    """Toggle profiling with SIGUSR1 and dump the aggregated stats with
+    SIGUSR2 (for processes without admin endpoint, i.e. the scraper)"""
+    directory = directory or default_directory()
+
+    def toggle(signum, frame):
+        profiler.configure(0.0 if profiler.fraction > 0 else fraction)
+        logging.info("profiling {}: fraction {}".format(profiler.name, profiler.fraction))
+
+    def dump(signum, frame):
+        logging.info("profiling {}: wrote {}".format(profiler.name, ", ".join(profiler.dump(directory))))
+
+    signal.signal(signal.SIGUSR1, toggle)
+    signal.signal(signal.SIGUSR2, dump)
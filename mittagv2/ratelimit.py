@@ -0,0 +1,181 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import math
+import threading
+import time
+import mittagv2.metrics as metrics
+
+REJECTED = metrics.REGISTRY.counter("mittag_rate_limited_requests",
+    "Requests shed by rate limits by endpoint and reason (client, endpoint, concurrency)",
+    ("endpoint", "reason"))
+BUCKETS = metrics.REGISTRY.gauge("mittag_rate_limit_buckets",
+    "Number of token buckets tracked by limiter", ("limiter",))
+IN_FLIGHT = metrics.REGISTRY.gauge("mittag_admission_in_flight",
+    "Requests currently admitted by concurrency limit", ("limit",))
+
+def retry_after(wait):
+    """Retry-After header value for a wait in seconds"""
+    return str(max(1, int(math.ceil(wait))))
+
+class TokenBucket:
+    """Bucket holding up to burst tokens, refilled with rate tokens per
+    second. Not thread-safe, see RateLimiter."""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def take(self, cost, now):
+        """Take cost tokens. Returns 0 if they were taken, or the time in
+        seconds until enough tokens are available."""
+        self._refill(now)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        # requests costing more than the burst still get through when full
+        if self.tokens >= self.burst:
+            self.tokens -= cost
+            return 0.0
+        return (min(cost, self.burst) - self.tokens) / self.rate
+
+    def give(self, cost):
+        """Return tokens of a request that was shed elsewhere"""
+        self.tokens = min(self.burst, self.tokens + cost)
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+class RateLimiter:
+    """Token buckets by key (client address, endpoint name). Buckets that
+    refilled completely carry no state and are dropped when there are more
+    than max_keys of them."""
+
+    def __init__(self, name, rate, burst, max_keys=10000):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, cost=1, now=None):
+        """Take cost tokens from the bucket of key. Returns 0 if the request
+        is allowed, or the time in seconds after which it would be."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._prune(now)
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, now)
+                BUCKETS.set(len(self._buckets), limiter=self.name)
+            return bucket.take(cost, now)
+
+    def give(self, key, cost=1):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.give(cost)
+
+    def _prune(self, now):
+        self._buckets = { k: b for k, b in self._buckets.items() if not b.full(now) }
+        if len(self._buckets) >= self.max_keys:
+            # everybody is busy: forget the least recently used half
+            recent = sorted(self._buckets.items(), key=lambda item: item[1].updated)
+            self._buckets = dict(recent[len(recent) // 2:])
+
+    def __len__(self):
+        with self._lock:
+            return len(self._buckets)
+
+class ConcurrencyLimit:
+    """Bounded number of concurrently running requests, waiting at most
+    timeout seconds for a slot"""
+
+    def __init__(self, name, limit, timeout=0.5):
+        self.name = name
+        self.limit = limit
+        self.timeout = timeout
+        self._semaphore = threading.BoundedSemaphore(limit)
+
+    def acquire(self):
+        """Take a slot, returns False if none became free in time"""
+        if not self._semaphore.acquire(timeout=self.timeout):
+            return False
+        IN_FLIGHT.inc(limit=self.name)
+        return True
+
+    def release(self):
+        IN_FLIGHT.dec(limit=self.name)
+        self._semaphore.release()
+
+class Admission:
+    """Admission control for requests: a token bucket per client shared by
+    all endpoints, a token bucket per endpoint shared by all clients, and a
+    concurrency limit for heavy endpoints. Expensive endpoints take more
+    tokens (cost) per request."""
+
+    CLIENT_RATE = 5 #: Tokens per second refilled per client
+    CLIENT_BURST = 60 #: Tokens a client can spend at once
+    ENDPOINT_RATE = 50 #: Tokens per second refilled per endpoint
+    ENDPOINT_BURST = 300 #: Tokens an endpoint can spend at once
+    HEAVY_CONCURRENCY = 4 #: Maximum number of heavy requests running at once
+    HEAVY_TIMEOUT = 0.5 #: Time in seconds heavy requests wait for a slot
+
+    def __init__(self, client_rate=None, client_burst=None, endpoint_rate=None, endpoint_burst=None,
+            heavy_concurrency=None, heavy_timeout=None):
+        self.clients = RateLimiter("client", client_rate or Admission.CLIENT_RATE,
+            client_burst or Admission.CLIENT_BURST)
+        self.endpoints = RateLimiter("endpoint", endpoint_rate or Admission.ENDPOINT_RATE,
+            endpoint_burst or Admission.ENDPOINT_BURST)
+        self.heavy = ConcurrencyLimit("heavy", heavy_concurrency or Admission.HEAVY_CONCURRENCY,
+            Admission.HEAVY_TIMEOUT if heavy_timeout is None else heavy_timeout)
+
+    def admit(self, client, endpoint, cost=1, heavy=False, now=None):
+        """Admit a request. Returns None if it may run, or a tuple of
+        (reason, seconds to wait) if it is shed. Admitted heavy requests
+        must call release() when done."""
+        wait = self.clients.take(client, cost, now)
+        if wait > 0:
+            REJECTED.inc(endpoint=endpoint, reason="client")
+            return "client", wait
+        wait = self.endpoints.take(endpoint, cost, now)
+        if wait > 0:
+            self.clients.give(client, cost)
+            REJECTED.inc(endpoint=endpoint, reason="endpoint")
+            return "endpoint", wait
+        if heavy and not self.heavy.acquire():
+            REJECTED.inc(endpoint=endpoint, reason="concurrency")
+            return "concurrency", 1.0
+        return None
+
+    def release(self):
+        self.heavy.release()
@@ -0,0 +1,168 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+"""Read models derived from the weekly menus at write time: a "day/<date>"
+document per calendar day with the menus of all sources, and a
+"week/<year-week>" summary with everything the week bundle needs. Pages
+and API handlers read them with a single key lookup and use their "_rev"
+for cache validation; the scraper rebuilds a week's read models whenever
+one of its weekly menus changes."""
+
+import logging
+from datetime import timedelta
+import mittagv2.sources as sources
+import mittagv2.storage as storage
+import mittagv2.utils as utils
+
+def day_id(date):
+    """Document id of a day's read model, e.g. day/2019-12-09"""
+    return "day/{}".format(date.isoformat())
+
+def week_id(year_week):
+    """Document id of a week's read model, e.g. week/2019-50"""
+    return "week/{}".format(year_week)
+
+def week_menu_ids(year_week):
+    """Ids of the weekly menus of all sources"""
+    return [ utils.menu_id(s.name, year_week) for s in sources.SOURCES ]
+
+def week_sources(year_week, documents):
+    """Menus of a week per source, in source order, from the documents of
+    week_menu_ids(year_week) (see mittagv2.web.Bundle)"""
+    week_number = int(year_week.split("-")[1])
+    entries = []
+    for source, document in zip(sources.SOURCES, documents):
+        entry = {
+            "name": source.name,
+            "title": source.title,
+            "link": source.link_for(week_number)
+        }
+        if document is not None:
+            entry["days"] = [ day["menus"] for day in document["menus"]["days"] ]
+            if "notice" in document["menus"]:
+                entry["notice"] = document["menus"]["notice"]
+        entries.append(entry)
+    return entries
+
+def day_sources(menus, day_number):
+    """Menus of a day by source name, with the week's notice, from weekly
+    menus by source name. Sources without data for the day are missing."""
+    day = {}
+    for name, menu in menus.items():
+        if menu and "days" in menu and day_number < len(menu["days"]):
+            entry = {"menus": menu["days"][day_number]["menus"]}
+            if "notice" in menu:
+                entry["notice"] = menu["notice"]
+            day[name] = entry
+    return day
+
+def build(year_week, documents):
+    """Week and day documents of a week from the documents of
+    week_menu_ids(year_week)"""
+    start = utils.week_start(year_week)
+    week = {
+        "_id": week_id(year_week),
+        "type": "week_summary",
+        "year_week": year_week,
+        "start": start.isoformat(),
+        "sources": week_sources(year_week, documents),
+        "revisions": { d["source_name"]: d.get("revision", 0) for d in documents if d is not None },
+        "days": [],
+    }
+    menus = { d["source_name"]: d["menus"] for d in documents if d is not None }
+    days = []
+    for day_number in range(7):
+        date = start + timedelta(days=day_number)
+        day = day_sources(menus, day_number)
+        days.append({
+            "_id": day_id(date),
+            "type": "day_menus",
+            "date": date.isoformat(),
+            "year_week": year_week,
+            "day": day_number,
+            "sources": day,
+        })
+        week["days"].append({
+            "date": date.isoformat(),
+            "menus": { name: len(entry["menus"]) for name, entry in day.items() },
+        })
+    return [week] + days
+
+def _content(document):
+    return { k: v for k, v in document.items() if k != "_rev" }
+
+class ReadModels:
+    """Day and week read models in storage.READ_MODELS"""
+
+    ATTEMPTS = 3 #: Rebuild attempts when replicas write the same week concurrently
+
+    def __init__(self, backend):
+        self.storage = backend
+
+    def day(self, date):
+        """Read model of a day or None"""
+        return self._get(day_id(date))
+
+    def week(self, year_week):
+        """Read model of a week or None"""
+        return self._get(week_id(year_week))
+
+    def _get(self, doc_id):
+        try:
+            return self.storage.get(storage.READ_MODELS, doc_id)
+        except KeyError:
+            return None
+
+    def rebuild(self, year_week):
+        """Rebuild the read models of a week from its weekly menus, storing
+        only those that changed. Returns the ids of the changed documents."""
+        for attempt in range(ReadModels.ATTEMPTS):
+            documents = build(year_week, self.storage.get_many(storage.MENUS, week_menu_ids(year_week)))
+            current = self.storage.get_many(storage.READ_MODELS, [ d["_id"] for d in documents ])
+            changed = []
+            for document, stored in zip(documents, current):
+                if stored is None:
+                    changed.append(document)
+                elif _content(stored) != document:
+                    document["_rev"] = stored["_rev"]
+                    changed.append(document)
+            if len(changed) == 0:
+                return []
+            results = self.storage.put_many(storage.READ_MODELS, changed)
+            if not any(isinstance(r, storage.Conflict) for r in results):
+                return [ d["_id"] for d in changed ]
+            # another replica stored a source of the same week, start over
+            logging.info("read models of {} changed concurrently, retrying".format(year_week))
+        raise storage.Conflict(week_id(year_week))
+
+    def catch_up(self):
+        """Build read models of all weeks with menus that have none yet,
+        returns the rebuilt weeks"""
+        existing = set(self.storage.ids(storage.READ_MODELS))
+        weeks = set()
+        for menu_id in self.storage.weekly_menu_ids():
+            if "/" in menu_id:
+                weeks.add(menu_id.split("/", 1)[1])
+        missing = sorted(w for w in weeks if week_id(w) not in existing)
+        for year_week in missing:
+            self.rebuild(year_week)
+        return missing
@@ -0,0 +1,237 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+"""Lunch recommendations: ranks a day's menus of all sources for
+preference profiles of users or teams. Menu features (vegetarian, prices,
+calories, text and word sets) are extracted once per day into arrays, and
+a batch of profiles is scored against them with a few matrix operations.
+
+Scores add up, per profile and menu: liked keywords (+1 each) and disliked
+keywords (-1 each) weighted by keyword_weight, a bonus for cheap menus
+below the price ceiling, a penalty for missing the calorie target and a
+penalty for similarity to dishes eaten recently (variety). Menus that are
+not vegetarian for vegetarian profiles or above the price ceiling are
+excluded."""
+
+import re
+import threading
+import numpy as np
+import mittagv2.cache as cache
+import mittagv2.handlers as handlers
+import mittagv2.sources as sources
+import mittagv2.storage as storage
+
+PRICES = ("student", "reduced", "normal")
+WORD = re.compile(r"\w+")
+
+def words(text):
+    """Lower case words of a text, ignoring very short ones"""
+    return set(w for w in WORD.findall(text.lower()) if len(w) > 2)
+
+class Profile:
+    """Preferences of a user or team"""
+
+    def __init__(self, id=None, vegetarian=False, max_price=None, price="student", calories=None,
+            likes=(), dislikes=(), history=(), variety=1.0, keyword_weight=1.0, price_weight=0.5,
+            calorie_weight=0.5):
+        self.id = id
+        self.vegetarian = bool(vegetarian) #: Only vegetarian menus
+        self.max_price = float(max_price) if max_price is not None else None #: Price ceiling in €
+        if price not in PRICES:
+            raise ValueError("price must be one of {}".format(", ".join(PRICES)))
+        self.price = price #: Price category paid
+        self.calories = float(calories) if calories is not None else None #: Calorie target
+        self.likes = [ str(k).lower() for k in likes ] #: Liked keywords (substrings)
+        self.dislikes = [ str(k).lower() for k in dislikes ] #: Disliked keywords
+        self.history = [ str(d) for d in history ] #: Recently eaten dishes, most recent first
+        self.variety = float(variety) #: Weight of the penalty for recently eaten dishes
+        self.keyword_weight = float(keyword_weight)
+        self.price_weight = float(price_weight)
+        self.calorie_weight = float(calorie_weight)
+
+    @classmethod
+    def from_dict(cls, values):
+        """Profile from request data, raises ValueError for invalid ones"""
+        if not isinstance(values, dict):
+            raise ValueError("profile must be an object")
+        try:
+            return cls(**values)
+        except TypeError as ex:
+            raise ValueError(str(ex))
+
+class DayFeatures:
+    """Feature arrays of a day's menus of all sources"""
+
+    def __init__(self, entries):
+        self.entries = entries #: (source name, menu) tuples
+        menus = [ menu for _, menu in entries ]
+        self.vegetarian = np.array([ bool(m.get("vegetarian")) for m in menus ], dtype=bool)
+        self.prices = { kind: np.array([ self._price(m, kind) for m in menus ], dtype=float) for kind in PRICES }
+        self.calories = np.array([ m.get("calories") or np.nan for m in menus ], dtype=float)
+        self.texts = [ " ".join((m.get("menu_type", ""), m["name"], m.get("description", ""))).lower()
+            for m in menus ]
+        menu_words = [ words(m["name"] + " " + m.get("description", "")) for m in menus ]
+        self.vocabulary = { w: i for i, w in enumerate(sorted(set().union(*menu_words))) }
+        self.words = np.zeros((len(menus), len(self.vocabulary)))
+        for row, found in enumerate(menu_words):
+            self.words[row, [ self.vocabulary[w] for w in found ]] = 1
+        self.word_counts = np.maximum(self.words.sum(axis=1), 1)
+        self._keywords = {}
+        self._dishes = {}
+        self._lock = threading.Lock()
+
+    def _price(self, menu, kind):
+        # reduced and student prices fall back to the next higher one
+        for key in PRICES[PRICES.index(kind):]:
+            if menu.get(key + "_price"):
+                return menu[key + "_price"]
+        return np.nan
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keywords(self, keywords):
+        """Matrix of keywords (rows) contained in the menus (columns)"""
+        with self._lock:
+            missing = [ k for k in keywords if k not in self._keywords ]
+            for keyword in missing:
+                self._keywords[keyword] = np.array([ keyword in text for text in self.texts ], dtype=float)
+            rows = [ self._keywords[k] for k in keywords ]
+        if len(rows) == 0:
+            return np.zeros((0, len(self)))
+        return np.vstack(rows)
+
+    def similarity(self, dishes):
+        """Matrix of word overlap (share of the menu's words) of dishes
+        (rows) with the menus (columns)"""
+        unique = sorted(set(dishes))
+        with self._lock:
+            for dish in unique:
+                if dish not in self._dishes:
+                    vector = np.zeros(len(self.vocabulary))
+                    vector[[ self.vocabulary[w] for w in words(dish) if w in self.vocabulary ]] = 1
+                    self._dishes[dish] = (vector @ self.words.T) / self.word_counts
+            rows = np.vstack([ self._dishes[dish] for dish in unique ])
+        index = { dish: i for i, dish in enumerate(unique) }
+        return rows[[ index[dish] for dish in dishes ]]
+
+def _group_max(matrix, counts):
+    """Maximum of rows of a matrix in consecutive groups of the given sizes"""
+    counts = np.asarray(counts)
+    result = np.zeros((len(counts), matrix.shape[1]))
+    nonempty = counts > 0
+    starts = (np.cumsum(counts) - counts)[nonempty]
+    result[nonempty] = np.maximum.reduceat(matrix, starts, axis=0)
+    return result
+
+def score(features, profiles):
+    """Scores of menus (columns) for profiles (rows), -inf for excluded
+    menus"""
+    count = len(profiles)
+    scores = np.zeros((count, len(features)))
+    if len(features) == 0:
+        return scores
+
+    # keywords: +1 per liked, -1 per disliked keyword contained
+    keywords = sorted(set(k for p in profiles for k in p.likes + p.dislikes))
+    if keywords:
+        index = { k: i for i, k in enumerate(keywords) }
+        weights = np.zeros((count, len(keywords)))
+        for row, profile in enumerate(profiles):
+            for keyword in profile.likes:
+                weights[row, index[keyword]] += profile.keyword_weight
+            for keyword in profile.dislikes:
+                weights[row, index[keyword]] -= profile.keyword_weight
+        scores += weights @ features.keywords(keywords)
+
+    # price: bonus for the share of the ceiling left, excluded above it
+    ceilings = np.array([ p.max_price if p.max_price is not None else np.inf for p in profiles ])
+    prices = np.vstack([ features.prices[p.price] for p in profiles ])
+    known = ~np.isnan(prices)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        left = np.where(np.isfinite(ceilings)[:, None] & known, 1 - prices / ceilings[:, None], 0)
+    scores += np.array([ p.price_weight for p in profiles ])[:, None] * left
+    excluded = known & (prices > ceilings[:, None])
+
+    # calories: penalty by relative distance from the target
+    targets = np.array([ p.calories if p.calories else np.nan for p in profiles ])
+    with np.errstate(invalid="ignore"):
+        distance = np.abs(features.calories[None, :] - targets[:, None]) / targets[:, None]
+    scores -= np.array([ p.calorie_weight for p in profiles ])[:, None] * np.nan_to_num(distance)
+
+    # variety: penalty by similarity to the closest recently eaten dish
+    counts = [ len(p.history) for p in profiles ]
+    if sum(counts):
+        similarity = features.similarity([ d for p in profiles for d in p.history ])
+        scores -= np.array([ p.variety for p in profiles ])[:, None] * _group_max(similarity, counts)
+
+    vegetarian = np.array([ p.vegetarian for p in profiles ])
+    excluded |= vegetarian[:, None] & ~features.vegetarian[None, :]
+    scores[excluded] = -np.inf
+    return scores
+
+class Recommender:
+    """Recommendations from stored weekly menus, with menu features cached
+    per day"""
+
+    CACHE_TTL = 60 #: Time in seconds day features are cached
+
+    def __init__(self, backend):
+        self.storage = backend
+        self._cache = cache.TTLCache("recommend_features", Recommender.CACHE_TTL)
+
+    def features(self, year_week, day_number):
+        """Feature arrays of a day's menus"""
+        return self._cache.get((year_week, day_number), lambda: self._build(year_week, day_number))
+
+    def _build(self, year_week, day_number):
+        documents = self.storage.get_many(storage.MENUS, handlers.week_menu_ids(year_week))
+        entries = []
+        for source, document in zip(sources.SOURCES, documents):
+            if document is None:
+                continue
+            days = document["menus"].get("days", [])
+            if day_number < len(days):
+                entries.extend((source.name, menu) for menu in days[day_number]["menus"])
+        return DayFeatures(entries)
+
+    def recommend(self, year_week, day_number, profiles, limit=3):
+        """Best menus for each profile, as lists of {source_name, name,
+        score} in the order of the profiles"""
+        features = self.features(year_week, day_number)
+        scores = score(features, profiles)
+        if limit < scores.shape[1]:
+            best = np.argpartition(-scores, limit, axis=1)[:, :limit]
+        else:
+            best = np.tile(np.arange(scores.shape[1]), (len(profiles), 1))
+        best_scores = np.take_along_axis(scores, best, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        ranked = np.take_along_axis(best, order, axis=1).tolist()
+        ranked_scores = np.round(np.take_along_axis(best_scores, order, axis=1), 4).tolist()
+        results = []
+        for profile, columns, values in zip(profiles, ranked, ranked_scores):
+            results.append({"id": profile.id, "menus": [ {
+                "source_name": features.entries[column][0],
+                "menu": features.entries[column][1],
+                "score": value,
+            } for column, value in zip(columns, values) if value != -np.inf ]})
+        return results
@@ -0,0 +1,286 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+"""Replay stored scrape data through the current parsers.
+
+Streams the raw data attached to scrape logs, parses it across a process
+pool and compares the result with the weekly menu stored for the same
+scrape. Run as
+
+    python -m mittagv2.replay [--source NAME] [--from YYYY-WW] [--to YYYY-WW]
+
+and check the "regressions" of the JSON report. Raw data that retention
+moved to the blob archive (MITTAG_ARCHIVE_DIR) is read from there. With
+--write-back, menus that parse differently now replace the stored ones (if
+they came from the latest scrape of their week), previous revisions go to
+the menu history, and the read models and feeds of their weeks are
+regenerated."""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import mittagv2.feeds as feeds
+import mittagv2.readmodels as readmodels
+import mittagv2.retention as retention
+import mittagv2.revisions as revisions
+import mittagv2.scraper as scraper
+import mittagv2.sources as sources
+import mittagv2.storage as storage
+import mittagv2.utils as utils
+
+BATCH_SIZE = 100 #: Number of documents fetched per request
+MAX_DIFFS = 20 #: Maximum number of differences reported per scrape
+
+def diff_menus(expected, actual):
+    """Compare two weekly menus (the "menus" part of weekly_menu documents)
+    and describe the differences, e.g. "day 2 menu 0 name: 'A' != 'B'"."""
+    differences = []
+    if expected.get("notice") != actual.get("notice"):
+        differences.append("notice: {!r} != {!r}".format(expected.get("notice"), actual.get("notice")))
+    expected_days, actual_days = expected.get("days", []), actual.get("days", [])
+    if len(expected_days) != len(actual_days):
+        differences.append("days: {} != {}".format(len(expected_days), len(actual_days)))
+    for day_index, (expected_day, actual_day) in enumerate(zip(expected_days, actual_days)):
+        expected_menus, actual_menus = expected_day["menus"], actual_day["menus"]
+        if len(expected_menus) != len(actual_menus):
+            differences.append("day {} menus: {} != {}".format(day_index, len(expected_menus), len(actual_menus)))
+        for menu_index, (expected_menu, actual_menu) in enumerate(zip(expected_menus, actual_menus)):
+            for field in sorted(set(expected_menu.keys()) | set(actual_menu.keys())):
+                if expected_menu.get(field) != actual_menu.get(field):
+                    differences.append("day {} menu {} {}: {!r} != {!r}".format(day_index, menu_index,
+                        field, expected_menu.get(field), actual_menu.get(field)))
+    return differences
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a list of samples"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def _parse(job):
+    """Parse raw data of a scrape (runs in worker processes)"""
+    scrape_id, source_name, year_week, blob = job
+    start = time.perf_counter()
+    try:
+        menu = sources.get(source_name).parse(blob, int(year_week.split("-")[1]))
+        result = scraper.Scraper()._menu(source_name, menu, year_week)["menus"]
+        error = None
+    except Exception as ex:
+        result = None
+        error = "{}: {}".format(type(ex).__name__, ex)
+    return scrape_id, result, error, time.perf_counter() - start
+
+def _batches(backend, collection, ids):
+    for i in range(0, len(ids), BATCH_SIZE):
+        for document in backend.get_many(collection, ids[i:i + BATCH_SIZE]):
+            if document is not None:
+                yield document
+
+class Replay:
+    """Replay of scrape data stored in a backend (see module docs)"""
+
+    def __init__(self, backend, source_name=None, first=None, last=None, workers=None,
+            archive=None, feeds=None):
+        self.storage = backend
+        self.source_name = source_name
+        self.first = utils.normalize_year_week(first) if first else None
+        self.last = utils.normalize_year_week(last) if last else None
+        self.workers = workers or os.cpu_count() or 1
+        self.revisions = revisions.MenuRevisions(backend)
+        self.read_models = readmodels.ReadModels(backend)
+        self.archive = archive #: Blob archive of scrape data moved by retention
+        self.feeds = feeds
+        self.bytes = 0
+        self._logs = {}
+        self._references = {}
+
+    def _load_references(self):
+        """Index archived and stored weekly menus and their revisions (see
+        mittagv2.revisions) by scrape id. Later revisions are indexed last,
+        they take precedence over earlier ones of the same scrape."""
+        for document in _batches(self.storage, storage.MENU_ARCHIVE, self.storage.ids(storage.MENU_ARCHIVE)):
+            if document.get("type") == "weekly_menu" and "scrape_id" in document:
+                self._references[document["scrape_id"]] = (storage.MENU_ARCHIVE, document)
+        for current in _batches(self.storage, storage.MENUS, self.storage.ids(storage.MENUS)):
+            if current.get("type") != "weekly_menu":
+                continue
+            try:
+                history = self.revisions.history(current)
+            except KeyError:
+                history = [current]
+            for document in history:
+                if document.get("scrape_id") is not None:
+                    collection = storage.MENUS if document is current else storage.MENU_HISTORY
+                    self._references[document["scrape_id"]] = (collection, document)
+
+    def _selected(self, log, year_week):
+        if log.get("type") != "scrape_log" or year_week is None:
+            return False
+        if len(log.get("_attachments", {})) == 0 and (self.archive is None or len(log.get("archived", {})) == 0):
+            return False
+        if self.source_name and log["source_name"] != self.source_name:
+            return False
+        if self.first and year_week < self.first or self.last and year_week > self.last:
+            return False
+        try:
+            sources.get(log["source_name"])
+        except KeyError:
+            return False
+        return True
+
+    def jobs(self):
+        """Generate (scrape_id, source_name, year_week, blob) of the
+        selected scrapes"""
+        for log in _batches(self.storage, storage.SCRAPINGS, self.storage.ids(storage.SCRAPINGS)):
+            year_week = retention.log_year_week(log)
+            if not self._selected(log, year_week):
+                continue
+            self._logs[log["_id"]] = (log["source_name"], year_week, log.get("success", False),
+                log.get("at", ""))
+            blob = self._blob(log)
+            self.bytes += len(blob)
+            yield log["_id"], log["source_name"], year_week, blob
+
+    def _blob(self, log):
+        if len(log.get("_attachments", {})) > 0:
+            return self.storage.get_blob(storage.SCRAPINGS, log["_id"])[2]
+        return self.archive.load(retention.archived_blob(log)[1])
+
+    def _results(self, jobs):
+        """Parse jobs in a process pool, keeping a bounded number in flight"""
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            in_flight = []
+            limit = 2 * self.workers
+            for job in jobs:
+                in_flight.append(executor.submit(_parse, job))
+                if len(in_flight) >= limit:
+                    yield in_flight.pop(0).result()
+            for future in in_flight:
+                yield future.result()
+
+    def run(self, write_back=False):
+        """Replay and return the report"""
+        self._load_references()
+        counts = {"unchanged": 0, "changed": 0, "failed": 0, "fixed": 0, "still_failing": 0,
+            "unreferenced": 0}
+        regressions = []
+        updates = {}
+        latencies = {}
+        start = time.perf_counter()
+        for scrape_id, result, error, seconds in self._results(self.jobs()):
+            source_name, year_week, success, at = self._logs[scrape_id]
+            latencies.setdefault(sources.get(source_name).parser, []).append(seconds)
+            collection, reference = self._references.get(scrape_id, (None, None))
+            entry = {"scrape_id": scrape_id, "source_name": source_name, "year_week": year_week}
+            if error is not None:
+                outcome = "failed" if reference is not None else "still_failing"
+                entry["error"] = error
+            elif reference is None:
+                outcome = "unreferenced" if success else "fixed"
+            else:
+                differences = diff_menus(reference["menus"], result)
+                outcome = "changed" if differences else "unchanged"
+                entry["differences"] = differences[:MAX_DIFFS]
+            counts[outcome] += 1
+            if outcome in ("failed", "changed"):
+                regressions.append(dict(entry, outcome=outcome))
+            if outcome == "changed" and collection == storage.MENUS:
+                updates[reference["_id"]] = (at, dict(reference, menus=result,
+                    reparsed_at=utils.timestamp_rfc3339()))
+            elif outcome == "fixed":
+                # the latest of a week's failed scrapes wins
+                doc_id = utils.menu_id(source_name, year_week)
+                if doc_id not in updates or updates[doc_id][0] < at:
+                    updates[doc_id] = (at, self._fixed_menu(scrape_id, source_name, year_week, result))
+        elapsed = time.perf_counter() - start
+        replayed = sum(counts.values())
+        report = {
+            "replayed": replayed,
+            "outcomes": counts,
+            "seconds": elapsed,
+            "scrapes_per_second": replayed / elapsed if elapsed > 0 else 0,
+            "bytes_per_second": self.bytes / elapsed if elapsed > 0 else 0,
+            "parsers": { parser: {
+                "count": len(samples),
+                "p50_s": percentile(samples, 0.5),
+                "p90_s": percentile(samples, 0.9),
+                "p99_s": percentile(samples, 0.99),
+            } for parser, samples in latencies.items() },
+            "regressions": regressions,
+        }
+        if write_back:
+            report["written"] = self._write_back([ document for _, document in updates.values()
+                if document is not None ])
+        return report
+
+    def _fixed_menu(self, scrape_id, source_name, year_week, menus):
+        """Menu document for a scrape that failed back then, if there is no
+        menu for its week"""
+        doc_id = utils.menu_id(source_name, year_week)
+        if doc_id in self.storage.exists(storage.MENUS, [doc_id]):
+            return None
+        return {"_id": doc_id, "type": "weekly_menu", "at": utils.timestamp_rfc3339(),
+            "reparsed_at": utils.timestamp_rfc3339(), "source_name": source_name,
+            "scrape_id": scrape_id, "menus": menus}
+
+    def _write_back(self, documents):
+        weeks = set()
+        for i in range(0, len(documents), BATCH_SIZE):
+            batch = documents[i:i + BATCH_SIZE]
+            for document, revision in zip(batch, self.revisions.store_many(batch)):
+                if revision is not None:
+                    weeks.add(document["menus"]["year_week"])
+        for year_week in sorted(weeks):
+            self.read_models.rebuild(year_week)
+            if self.feeds is not None:
+                self.feeds.update(year_week)
+        return len(documents)
+
+def main():
+    parser = argparse.ArgumentParser(description="replay stored scrape data through the parsers")
+    parser.add_argument("--source", "-s", help="only scrapes of this source")
+    parser.add_argument("--from", dest="first", help="first week (YYYY-WW)")
+    parser.add_argument("--to", dest="last", help="last week (YYYY-WW)")
+    parser.add_argument("--workers", "-w", type=int, help="number of parser processes (default: CPUs)")
+    parser.add_argument("--write-back", action="store_true", help="store menus that parse differently now")
+    parser.add_argument("--output", "-o", help="write JSON report to file (default: stdout)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    backend = storage.open_storage()
+    replay = Replay(backend, args.source, args.first, args.last, args.workers,
+        retention.open_archive(), feeds.open_feeds(backend))
+    report = replay.run(write_back=args.write_back)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(output)
+    else:
+        print(output)
+    sys.exit(1 if len(report["regressions"]) > 0 else 0)
+
+if __name__ == "__main__":
+    main()
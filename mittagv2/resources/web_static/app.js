@@ -0,0 +1,138 @@
+// Client side rendering of the menu page from the weekly JSON bundle
+// (/api/v1/bundle/). Switching days needs no server round-trip; the
+// service worker (sw.js) keeps the bundle and page available offline.
+"use strict";
+
+(function () {
+    var BUNDLE_URL = "/api/v1/bundle/";
+    var DAY_NAMES = ["Montag", "Dienstag", "Mittwoch", "Donnerstag", "Freitag", "Samstag", "Sonntag"];
+    var bundle = null;
+
+    function escapeHtml(text) {
+        return String(text).replace(/[&<>"']/g, function (c) {
+            return {"&": "&amp;", "<": "&lt;", ">": "&gt;", "\"": "&quot;", "'": "&#x27;"}[c];
+        });
+    }
+
+    function formatPrice(price) {
+        return price.toFixed(2).replace(".", ",");
+    }
+
+    function currentDay() {
+        return (new Date().getDay() + 6) % 7;
+    }
+
+    function isoDate(date) {
+        var month = ("0" + (date.getMonth() + 1)).slice(-2);
+        var day = ("0" + date.getDate()).slice(-2);
+        return date.getFullYear() + "-" + month + "-" + day;
+    }
+
+    // keep in sync with PageRenderer.menu_to_html (mittagv2/handlers.py)
+    function menuToHtml(menu) {
+        var name = menu.name;
+        if (menu.menu_type) {
+            name = menu.menu_type + ": " + menu.name;
+        }
+        var html = "<p><strong>" + escapeHtml(name) + "</strong></p>";
+        if ("description" in menu) {
+            html += "<p>" + escapeHtml(menu.description).replace(/\n/g, "<br>") + "</p>";
+        }
+        var attributes = [];
+        if ("calories" in menu) {
+            attributes.push(menu.calories + " kcal");
+        }
+        if (menu.vegetarian === true) {
+            attributes.push("vegetarisch");
+        }
+        if (attributes.length > 0) {
+            html += "<p style=\"float: right; font-size: 90%; margin-top: 0;\">" + attributes.join(", ") + "</p>";
+        }
+        html += "<p style=\"float: left; margin-top: 0;\">";
+        if (menu.student_price) {
+            html += formatPrice(menu.student_price) + " € / ";
+        }
+        if (menu.reduced_price) {
+            html += formatPrice(menu.reduced_price) + " € / ";
+        }
+        if (menu.normal_price) {
+            html += formatPrice(menu.normal_price) + " €";
+        }
+        html += "</p><div style=\"clear: both;\"></div>";
+        return html;
+    }
+
+    function dayToHtml(source, dayNumber) {
+        if (!source.days || dayNumber >= source.days.length) {
+            return "<p>Keine Daten vorhanden!</p>";
+        }
+        var html = source.days[dayNumber].map(menuToHtml).join("");
+        if ("notice" in source) {
+            html += "<p>" + escapeHtml(source.notice).replace(/\n/g, "<br>") + "</p>";
+        }
+        return html;
+    }
+
+    function render(dayNumber) {
+        var cells = document.getElementById("menu-cells");
+        if (bundle === null || cells === null) {
+            return false;
+        }
+        cells.innerHTML = bundle.sources.map(function (source) {
+            return "<td valign=\"top\">\n" + dayToHtml(source, dayNumber) + "\n</td>";
+        }).join("\n");
+        var date = new Date(bundle.start + "T12:00:00");
+        date.setDate(date.getDate() + dayNumber);
+        document.getElementById("date-string").textContent = DAY_NAMES[dayNumber] + ", " + isoDate(date);
+        return true;
+    }
+
+    function requestedDay() {
+        var match = /[?&]day=(\d)/.exec(window.location.search);
+        return match ? parseInt(match[1], 10) : currentDay();
+    }
+
+    function loadBundle() {
+        return fetch(BUNDLE_URL, {credentials: "same-origin"}).then(function (response) {
+            if (!response.ok) {
+                throw new Error("bundle request failed: " + response.status);
+            }
+            return response.json();
+        }).then(function (loaded) {
+            bundle = loaded;
+            render(requestedDay());
+        });
+    }
+
+    document.addEventListener("click", function (event) {
+        var link = event.target.closest ? event.target.closest("a[data-day]") : null;
+        if (link === null || bundle === null) {
+            return;
+        }
+        var day = link.getAttribute("data-day");
+        if (render(day === "" ? currentDay() : parseInt(day, 10))) {
+            event.preventDefault();
+            history.pushState(null, "", link.getAttribute("href"));
+        }
+    });
+
+    window.addEventListener("popstate", function () {
+        render(requestedDay());
+    });
+
+    if ("serviceWorker" in navigator) {
+        navigator.serviceWorker.register("/sw.js");
+        // the service worker announces bundles that changed on revalidation
+        navigator.serviceWorker.addEventListener("message", function (event) {
+            if (event.data && event.data.type === "bundle-updated") {
+                loadBundle();
+            }
+        });
+    }
+
+    if ("fetch" in window) {
+        loadBundle().catch(function () {
+            // keep the server rendered page
+        });
+    }
+})();
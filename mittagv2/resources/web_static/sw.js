@@ -0,0 +1,92 @@
+// Service worker: serves the page, its assets and the weekly JSON bundle
+// from cache and revalidates them in the background at most every
+// REVALIDATE_AFTER milliseconds. Clients are told when the bundle changed.
+"use strict";
+
+var CACHE_NAME = "mittagv2-v1";
+var BUNDLE_URL = "/api/v1/bundle/";
+var PRECACHE = ["/", "/style.css", "/app.js", "/manifest.json", BUNDLE_URL];
+var REVALIDATE_AFTER = 10 * 60 * 1000;
+var FETCHED_HEADER = "x-mittagv2-fetched";
+
+self.addEventListener("install", function (event) {
+    event.waitUntil(caches.open(CACHE_NAME).then(function (cache) {
+        return Promise.all(PRECACHE.map(function (url) {
+            return fetchAndStore(cache, url);
+        }));
+    }).then(function () {
+        return self.skipWaiting();
+    }));
+});
+
+self.addEventListener("activate", function (event) {
+    event.waitUntil(caches.keys().then(function (names) {
+        return Promise.all(names.filter(function (name) {
+            return name !== CACHE_NAME;
+        }).map(function (name) {
+            return caches.delete(name);
+        }));
+    }).then(function () {
+        return self.clients.claim();
+    }));
+});
+
+// Fetch url and store a copy stamped with the fetch time; the HTTP cache
+// turns this into a conditional request when the resource has an ETag
+function fetchAndStore(cache, url) {
+    return fetch(url, {credentials: "same-origin"}).then(function (response) {
+        if (!response.ok) {
+            return response;
+        }
+        return response.clone().blob().then(function (body) {
+            var headers = new Headers(response.headers);
+            headers.set(FETCHED_HEADER, String(Date.now()));
+            return cache.put(url, new Response(body, {status: response.status, headers: headers}));
+        }).then(function () {
+            return response;
+        });
+    });
+}
+
+function notifyClients(message) {
+    return self.clients.matchAll().then(function (clients) {
+        clients.forEach(function (client) {
+            client.postMessage(message);
+        });
+    });
+}
+
+function revalidate(cache, url, cached) {
+    var fetched = cached ? parseInt(cached.headers.get(FETCHED_HEADER) || "0", 10) : 0;
+    if (Date.now() - fetched < REVALIDATE_AFTER) {
+        return Promise.resolve();
+    }
+    return fetchAndStore(cache, url).then(function (response) {
+        if (url === BUNDLE_URL && cached && response.ok &&
+                response.headers.get("ETag") !== cached.headers.get("ETag")) {
+            return notifyClients({type: "bundle-updated", version: response.headers.get("ETag")});
+        }
+    });
+}
+
+self.addEventListener("fetch", function (event) {
+    var request = event.request;
+    var url = new URL(request.url);
+    if (request.method !== "GET" || url.origin !== self.location.origin) {
+        return;
+    }
+    // the page for any day is the same document, app.js renders the day
+    var key = url.pathname === "/" ? "/" : url.pathname;
+    if (PRECACHE.indexOf(key) < 0) {
+        return;
+    }
+    event.respondWith(caches.open(CACHE_NAME).then(function (cache) {
+        return cache.match(key).then(function (cached) {
+            if (!cached) {
+                return url.search ? fetch(request) : fetchAndStore(cache, key);
+            }
+            event.waitUntil(revalidate(cache, key, cached).catch(function () {}));
+            return cached;
+        });
+    }));
+});
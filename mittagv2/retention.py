@@ -0,0 +1,172 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import logging
+import os
+import threading
+import zipfile
+from datetime import datetime, timedelta
+import mittagv2.storage as storage
+import mittagv2.utils as utils
+
+BATCH_SIZE = 100 #: Number of scrape logs fetched per request
+
+class BlobArchive:
+    """Compressed archive files on local disk for raw scrape data moved
+    out of the database: one zip file per source and year, with members
+    named <scrape id>/<blob name>."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def store(self, source_name, year, scrape_id, name, data):
+        """Archive data, returns its location (relative path and member)"""
+        path = os.path.join(source_name, "{}.zip".format(year))
+        member = "{}/{}".format(scrape_id, name)
+        full_path = os.path.join(self.directory, path)
+        with self._lock:
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with zipfile.ZipFile(full_path, "a", compression=zipfile.ZIP_DEFLATED) as archive:
+                if member not in archive.namelist():
+                    archive.writestr(member, data)
+        if self.load({"path": path, "member": member}) != data:
+            raise IOError("archived data of {} differs".format(member))
+        return {"path": path, "member": member}
+
+    def load(self, location):
+        """Get archived data by location, raise KeyError if missing"""
+        full_path = os.path.join(self.directory, location["path"])
+        try:
+            with zipfile.ZipFile(full_path) as archive:
+                return archive.read(location["member"])
+        except (IOError, KeyError):
+            raise KeyError(location["member"])
+
+def open_archive():
+    """Open the blob archive configured by MITTAG_ARCHIVE_DIR, or None"""
+    directory = os.getenv("MITTAG_ARCHIVE_DIR")
+    return BlobArchive(directory) if directory else None
+
+def archived_blob(document, name=None):
+    """Get (name, archive location) of an archived blob of a scrape log,
+    the first one if no name is given, or raise KeyError"""
+    archived = document.get("archived", {})
+    if name is None:
+        if len(archived) == 0:
+            raise KeyError(document["_id"])
+        name = sorted(archived.keys())[0]
+    return name, archived[name]
+
+def log_year_week(log):
+    """Year+week of a scrape log, or None. Older logs only name it in their
+    blob, which may be archived."""
+    if "year_week" in log:
+        return utils.normalize_year_week(log["year_week"])
+    for name in list(log.get("_attachments", {})) + list(log.get("archived", {})):
+        if name.endswith(".bin") and "_" in name:
+            try:
+                return utils.normalize_year_week(name[:-len(".bin")].rsplit("_", 1)[1])
+            except ValueError:
+                pass
+    return None
+
+class RetentionPolicy:
+    """What to keep of scrape logs and their raw data"""
+
+    def __init__(self, archive_after_days=180, failures_kept=1):
+        #: Raw data older than this moves to the archive (if there is one)
+        self.archive_after_days = archive_after_days
+        #: Failed scrape logs kept per source and week, the latest ones
+        self.failures_kept = failures_kept
+
+    @classmethod
+    def from_env(cls):
+        return cls(int(os.getenv("MITTAG_ARCHIVE_AFTER_DAYS", "180")),
+            int(os.getenv("MITTAG_FAILURES_KEPT", "1")))
+
+class Retention:
+    """Applies a retention policy to the scrape logs: failed scrapes are
+    downsampled to the latest few per source and week, raw data of old
+    scrapes is moved to the archive, then the storage is compacted."""
+
+    def __init__(self, backend, archive=None, policy=None):
+        self.storage = backend
+        self.archive = archive
+        self.policy = policy if policy else RetentionPolicy()
+
+    def run(self, now=None, compact=True):
+        """Apply the policy, returns counts of what was done"""
+        now = now if now else datetime.utcnow()
+        cutoff = (now - timedelta(days=self.policy.archive_after_days)).isoformat("T") + "Z"
+        stats = {"scanned": 0, "deleted": 0, "archived": 0, "archived_bytes": 0}
+        failures = {}
+        old = []
+        for log in self._logs():
+            stats["scanned"] += 1
+            year_week = log_year_week(log)
+            if not log.get("success", False) and year_week is not None:
+                # logs of unknown weeks are kept
+                failures.setdefault((log.get("source_name"), year_week), []).append(log)
+            if log.get("at", "") < cutoff and len(log.get("_attachments", {})) > 0:
+                old.append(log)
+        deleted = set()
+        for logs in failures.values():
+            logs.sort(key=lambda log: log.get("at", ""), reverse=True)
+            for log in logs[self.policy.failures_kept:]:
+                self.storage.delete(storage.SCRAPINGS, log["_id"], log["_rev"])
+                deleted.add(log["_id"])
+        stats["deleted"] = len(deleted)
+        if self.archive is not None:
+            for log in old:
+                if log["_id"] not in deleted:
+                    stats["archived_bytes"] += self._archive(log)
+                    stats["archived"] += 1
+        if compact:
+            self.storage.compact()
+        logging.info("retention: {}".format(stats))
+        return stats
+
+    def _logs(self):
+        ids = self.storage.ids(storage.SCRAPINGS)
+        for i in range(0, len(ids), BATCH_SIZE):
+            for document in self.storage.get_many(storage.SCRAPINGS, ids[i:i + BATCH_SIZE]):
+                if document is not None and document.get("type") == "scrape_log":
+                    yield document
+
+    def _archive(self, log):
+        """Move raw data of a scrape log to the archive, returns its size.
+        The log records where each blob went before the blob is removed."""
+        year = log["at"][:4]
+        archived = dict(log.get("archived", {}))
+        size = 0
+        for name in log["_attachments"]:
+            _, content_type, data = self.storage.get_blob(storage.SCRAPINGS, log["_id"], name)
+            location = self.archive.store(log.get("source_name", "unknown"), year, log["_id"], name, data)
+            location.update(content_type=content_type, length=len(data))
+            archived[name] = location
+            size += len(data)
+        log["archived"] = archived
+        rev = self.storage.put(storage.SCRAPINGS, log)
+        for name in list(log["_attachments"]):
+            rev = self.storage.delete_blob(storage.SCRAPINGS, log["_id"], rev, name)
+        return size
@@ -0,0 +1,252 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+"""Menu history as structural deltas. The current weekly_menu document
+stays complete in MENUS, with a revision number. Each change to its menus
+is recorded in MENU_HISTORY as a menu_revision document
+("<doc_id>@<revision>") listing the changes at day and menu granularity,
+each with the old and the new value, so that changes apply in both
+directions and any revision is rebuilt from the current document.
+
+The current document carries the changes of its own revision ("changes"
+and "previous"), so they are stored in the same write as the menus. The
+menu_revision document is a copy written right after; a copy missing
+because a writer crashed in between is written by the next store and
+served from the current document meanwhile.
+
+Storing menus that equal the current ones writes nothing, so storage and
+change feed volume follow actual changes rather than scrape frequency."""
+
+import copy
+import mittagv2.storage as storage
+
+_ABSENT = object()
+
+def revision_id(doc_id, revision):
+    """Id of the menu_revision document of a weekly menu revision"""
+    return "{}@{:04d}".format(doc_id, revision)
+
+def _record(document):
+    """menu_revision document of the current revision of a weekly_menu
+    document"""
+    return {
+        "_id": revision_id(document["_id"], document["revision"]),
+        "type": "menu_revision",
+        "doc_id": document["_id"],
+        "revision": document["revision"],
+        "at": document.get("at"),
+        "scrape_id": document.get("scrape_id"),
+        "previous": document["previous"],
+        "changes": document["changes"],
+    }
+
+def _change(path, old, new):
+    change = {"path": path}
+    if old is not _ABSENT:
+        change["old"] = old
+    if new is not _ABSENT:
+        change["new"] = new
+    return change
+
+def diff(old, new):
+    """Changes from one weekly menu to another (the "menus" part of
+    weekly_menu documents, i.e. a serialized model.WeeklyMenu). Paths look
+    like ["notice"], ["days", 2] for whole days (added, removed or with a
+    different number of menus) and ["days", 2, "menus", 0, "normal_price"]
+    for menu fields. Absent values have no "old" or "new"."""
+    changes = []
+    if old.get("notice", _ABSENT) != new.get("notice", _ABSENT):
+        changes.append(_change(["notice"], old.get("notice", _ABSENT), new.get("notice", _ABSENT)))
+    old_days, new_days = old.get("days", []), new.get("days", [])
+    for i in range(max(len(old_days), len(new_days))):
+        old_day = old_days[i] if i < len(old_days) else _ABSENT
+        new_day = new_days[i] if i < len(new_days) else _ABSENT
+        if old_day == new_day:
+            continue
+        if (old_day is _ABSENT or new_day is _ABSENT or old_day.get("day") != new_day.get("day")
+                or len(old_day["menus"]) != len(new_day["menus"])):
+            changes.append(_change(["days", i], old_day, new_day))
+            continue
+        for j, (old_menu, new_menu) in enumerate(zip(old_day["menus"], new_day["menus"])):
+            for field in sorted(set(old_menu.keys()) | set(new_menu.keys())):
+                old_value, new_value = old_menu.get(field, _ABSENT), new_menu.get(field, _ABSENT)
+                if old_value != new_value:
+                    changes.append(_change(["days", i, "menus", j, field], old_value, new_value))
+    return changes
+
+def apply(menus, changes, reverse=False):
+    """Apply changes (see diff) to a weekly menu, or undo them. Returns a
+    new weekly menu; raises ValueError if the menu does not match the
+    state the changes start from."""
+    result = copy.deepcopy(menus)
+    _apply(result, changes, reverse)
+    return result
+
+def _apply(menus, changes, reverse):
+    source, target = ("new", "old") if reverse else ("old", "new")
+    days = menus.setdefault("days", [])
+    for change in changes:
+        path = change["path"]
+        if path[0] == "notice":
+            parent, key = menus, "notice"
+        elif len(path) == 2:
+            # whole days, absent ones are removed below
+            while len(days) <= path[1]:
+                days.append(_ABSENT)
+            if days[path[1]] != change.get(source, _ABSENT):
+                raise ValueError("revision mismatch at {}".format(path))
+            days[path[1]] = change.get(target, _ABSENT)
+            continue
+        else:
+            parent, key = days[path[1]]["menus"][path[3]], path[4]
+        if parent.get(key, _ABSENT) != change.get(source, _ABSENT):
+            raise ValueError("revision mismatch at {}".format(path))
+        if target in change:
+            parent[key] = change[target]
+        else:
+            parent.pop(key, None)
+    menus["days"] = [ day for day in days if day is not _ABSENT ]
+
+class MenuRevisions:
+    """Revisioned weekly_menu documents (see module docs)"""
+
+    RETRIES = 5 #: Attempts to store against concurrent writers
+
+    def __init__(self, backend):
+        self.storage = backend
+
+    def store(self, document):
+        """Store a weekly_menu document as the next revision, unless its
+        menus equal the current ones. Returns the revision number, or None
+        if nothing changed. The current document is replaced by revision
+        check first, so only one of concurrent writers records a revision."""
+        for _ in range(self.RETRIES):
+            try:
+                current = self.storage.get(storage.MENUS, document["_id"])
+            except KeyError:
+                current = None
+            if not self._next(current, document):
+                return None
+            # the current revision's changes are replaced along with it
+            self._archive([current] if current is not None else [])
+            try:
+                self.storage.put(storage.MENUS, document)
+            except storage.Conflict:
+                continue
+            self._archive([document], check=False)
+            return document["revision"]
+        raise storage.Conflict(document["_id"])
+
+    def store_many(self, documents):
+        """Store several weekly_menu documents like store, in bulk requests.
+        Returns their revision numbers, None for unchanged ones."""
+        currents = self.storage.get_many(storage.MENUS, [ document["_id"] for document in documents ])
+        revisions = [None] * len(documents)
+        changed = [ i for i, (current, document) in enumerate(zip(currents, documents))
+            if self._next(current, document) ]
+        self._archive([ currents[i] for i in changed if currents[i] is not None ])
+        stored = []
+        for i, result in zip(changed, self.storage.put_many(storage.MENUS, [ documents[i] for i in changed ])):
+            if isinstance(result, storage.Conflict):
+                # stored concurrently, retry on its own
+                revisions[i] = self.store(documents[i])
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                revisions[i] = documents[i]["revision"]
+                stored.append(documents[i])
+        self._archive(stored, check=False)
+        return revisions
+
+    def _next(self, current, document):
+        """Make a weekly_menu document the revision following the current
+        one (None if there is none). Returns False if its menus are
+        unchanged."""
+        if current is None:
+            for key in ("_rev", "changes", "previous"):
+                document.pop(key, None)
+            document["revision"] = 0
+            return True
+        changes = diff(current["menus"], document["menus"])
+        if len(changes) == 0:
+            return False
+        document.update(_rev=current["_rev"], revision=current.get("revision", 0) + 1, changes=changes,
+            previous={"at": current.get("at"), "scrape_id": current.get("scrape_id")})
+        return True
+
+    def _archive(self, documents, check=True):
+        """Copy the changes of weekly_menu documents' revisions to
+        MENU_HISTORY, unless they are there already"""
+        records = [ _record(document) for document in documents if "changes" in document ]
+        if len(records) == 0:
+            return
+        if check:
+            existing = self.storage.exists(storage.MENU_HISTORY, [ record["_id"] for record in records ])
+            records = [ record for record in records if record["_id"] not in existing ]
+        # conflicts mean a record was copied concurrently
+        self.storage.put_many(storage.MENU_HISTORY, records)
+
+    def records(self, current, since=0):
+        """menu_revision documents of a current weekly_menu document after
+        the given revision, oldest first. Raises KeyError if one is
+        missing."""
+        numbers = range(since + 1, current.get("revision", 0) + 1)
+        records = self.storage.get_many(storage.MENU_HISTORY, [ revision_id(current["_id"], n) for n in numbers ])
+        for i, (number, record) in enumerate(zip(numbers, records)):
+            if record is None and number == current["revision"] and "changes" in current:
+                records[i] = _record(current) # not copied yet
+            elif record is None:
+                raise KeyError(revision_id(current["_id"], number))
+        return records
+
+    def history(self, current, since=0):
+        """Rebuild all revisions of a current weekly_menu document from the
+        given one, oldest first"""
+        records = self.records(current, since)
+        revisions = [current]
+        menus = copy.deepcopy(current["menus"])
+        for record in reversed(records):
+            _apply(menus, record["changes"], reverse=True)
+            document = { k: v for k, v in current.items() if k not in ("_rev", "changes", "previous") }
+            document.update(menus=copy.deepcopy(menus), revision=record["revision"] - 1,
+                at=record["previous"]["at"], scrape_id=record["previous"]["scrape_id"])
+            revisions.append(document)
+        revisions.reverse()
+        return revisions
+
+    def revision(self, doc_id, number):
+        """Rebuild a revision of a weekly menu. Raises KeyError for unknown
+        documents and revisions."""
+        current = self.storage.get(storage.MENUS, doc_id)
+        if number < 0 or number > current.get("revision", 0):
+            raise KeyError(revision_id(doc_id, number))
+        return self.history(current, since=number)[0]
+
+    def changes(self, doc_id, since=0):
+        """What changed in a weekly menu after the given revision: the
+        current revision and a list of revisions with their changes"""
+        current = self.storage.get(storage.MENUS, doc_id)
+        return {
+            "revision": current.get("revision", 0),
+            "revisions": [ { k: record[k] for k in ("revision", "at", "scrape_id", "changes") }
+                for record in self.records(current, max(since, 0)) ],
+        }
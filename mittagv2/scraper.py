@@ -20,7 +20,6 @@
 # THE SOFTWARE.
 #
 
-import io
 import requests
 import schedule
 import time
@@ -28,12 +27,20 @@ import threading
 import traceback
 import logging
 import os
-from cloudant import CouchDB
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import mittagv2.feeds as feeds
+import mittagv2.leases as leases
+import mittagv2.metrics as metrics
 import mittagv2.model as model
-from mittagv2.marli_parser import MarliParser
-from mittagv2.mensa_parser import MensaParser
-from mittagv2.uksh_parser import BistroParser, MfcParser
+import mittagv2.polling as polling
+import mittagv2.profiling as profiling
+import mittagv2.readmodels as readmodels
+import mittagv2.retention as retention
+import mittagv2.revisions as revisions
+import mittagv2.sources as sources
 import mittagv2.utils as utils
+import mittagv2.storage as storage
 
 class ScrapingError(Exception):
     """Scraping error with optional associated data"""
@@ -46,60 +53,112 @@ class Scraper:
 
     MAX_RETRIES = 3 #: Maximum number of retries before giving up
     RETRY_WAIT_TIME = 3600 #: Wait time between retries in seconds
+    CATCH_UP_WEEKS = 4 #: Number of weeks (including the current one) checked on startup
+    CATCH_UP_WORKERS = 4 #: Maximum number of concurrent catch-up scrapes
+    POLL_TICK = 60 #: Interval in seconds the adaptive poller is asked for due sources
 
-    def scrape_bistro(self, week_number=None):
-        """Scrape UKSH bistro data"""
+    def __init__(self, poller=None):
+        self.poller = poller #: Adaptive poller (see mittagv2.polling), replaces the fixed schedule
+        self._slots = {}
+        self._slots_lock = threading.Lock()
+        self._polling = set()
+
+    def _fetch(self, url, timeout=None):
+        """Download raw data"""
+        response = self._request("GET", url, timeout=timeout)
+        response.raise_for_status()
+        return response.content
+
+    def _request(self, method, url, timeout=None, **kwargs):
+        """Send a request and read the response. Records total fetch time,
+        time until the response headers arrived (DNS, connect and server
+        time) and size."""
+        with metrics.stage("fetch"):
+            response = requests.request(method, url, timeout=timeout, **kwargs)
+            data = response.content
+        metrics.record("fetch_ttfb", response.elapsed.total_seconds())
+        metrics.record("fetch_bytes", len(data))
+        return response
+
+    def fetch_if_changed(self, source, week_number, validators):
+        """Download a source's data unless it is unchanged compared to the
+        given validators (ETag, Last-Modified and content hash of earlier
+        content). Known validators are checked with a HEAD request first,
+        then sent along as a conditional GET; content that comes back
+        anyway is compared by hash. Returns (data, validators), data is None
+        if unchanged."""
+        url = source.url_for(week_number)
+        etag, last_modified = validators.get("etag"), validators.get("last_modified")
+        if etag or last_modified:
+            response = self._request("HEAD", url, timeout=source.timeout, allow_redirects=True)
+            if response.ok and ((etag and response.headers.get("ETag") == etag) or
+                    (not etag and last_modified and response.headers.get("Last-Modified") == last_modified)):
+                return None, validators
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        response = self._request("GET", url, timeout=source.timeout, headers=headers)
+        if response.status_code == 304:
+            return None, validators
+        response.raise_for_status()
+        current = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "content_hash": polling.content_hash(response.content),
+        }
+        if current["content_hash"] == validators.get("content_hash"):
+            return None, current
+        return response.content, current
+
+    def scrape(self, source, week_number=None):
+        """Scrape a source (see mittagv2.sources), returns menu and raw data"""
         if not week_number:
             week_number = utils.current_week()
-        url = "https://www.uksh.de/uksh_media/Speisepl%C3%A4ne/L%C3%BCbeck+_+UKSH_Bistro/Speiseplan+Bistro+KW+{:02}.pdf".format(week_number)
-        pdf = requests.get(url).content
+        data = self._fetch(source.url_for(week_number), timeout=source.timeout)
+        return self._parse(source, data, week_number)
+
+    def _parse(self, source, data, week_number):
         try:
-            menu = BistroParser(week_number, io.BytesIO(pdf)).parse()
-            return menu, pdf
+            with metrics.stage("parse"):
+                menu = source.parse(data, week_number)
+            return menu, data
         except Exception as ex:
-            raise ScrapingError(blob=pdf, error=ex)
+            raise ScrapingError(blob=data, error=ex)
+
+    def scrape_bistro(self, week_number=None):
+        """Scrape UKSH bistro data"""
+        return self.scrape(sources.get("uksh-bistro"), week_number)
 
     def scrape_mfc(self, week_number=None):
         """Scrape MFC data"""
-        if not week_number:
-            week_number = utils.current_week()
-        url = "https://www.uksh.de/uksh_media/Speisepl%C3%A4ne/L%C3%BCbeck+_+MFC+Cafeteria/Speiseplan+Cafeteria+MFC+KW+{:02}.pdf".format(week_number)
-        pdf = requests.get(url).content
-        try:
-            menu = MfcParser(week_number, io.BytesIO(pdf)).parse()
-            return menu, pdf
-        except Exception as ex:
-            raise ScrapingError(blob=pdf, error=ex)
+        return self.scrape(sources.get("uksh-cafeteria"), week_number)
 
     def scrape_mensa(self):
         """Scrape Mensa data"""
-        week_number = utils.current_week()
-        url = "https://www.studentenwerk.sh/de/essen/standorte/luebeck/mensa-luebeck/speiseplan.html"
-        data = requests.get(url).content
-        try:
-            menu = MensaParser(week_number).parse(data.decode("UTF-8"))
-            return menu, data
-        except Exception as ex:
-            raise ScrapingError(blob=data, error=ex)
+        return self.scrape(sources.get("swsh-mensa"))
     
     def scrape_marli(self):
         """Scrape Marli data"""
-        week_number = utils.current_week()
-        url = "https://www.marli.de/rs/gastronomie_und_begegnung/mittagsangebote/index.html"
-        data = requests.get(url).content
-        try:
-            menu = MarliParser(week_number).parse(data.decode("UTF-8"))
-            return menu, data
-        except Exception as ex:
-            raise ScrapingError(blob=data, error=ex)
+        return self.scrape(sources.get("marli-sb"))
 
     def scheduled_scraper(self):
-        """Start a scheduling scraper. This schedules scraping for each Monday
-        morning. It also uses a retry mechanism to guard against intermittent
-        failures"""
+        """Start a scheduling scraper. This schedules scraping of each source
+        according to its declared schedule (Monday morning by default), or
+        as the adaptive poller decides. It also uses a retry mechanism to
+        guard against intermittent failures"""
         self.check_scraping_status()
-        schedule.every().monday.at("07:00").do(self._scrape_job)
-        #schedule.every(2).minutes.do(self._scrape_job)
+        if self.poller is not None:
+            self.poller.learn()
+            schedule.every(self.POLL_TICK).seconds.do(self._poll_job)
+        else:
+            schedules = {}
+            for source in sources.by_priority():
+                schedules.setdefault(source.schedule, []).append(source)
+            for (day, at), scheduled in schedules.items():
+                getattr(schedule.every(), day).at(at).do(self._scrape_job, scheduled)
+        self._schedule_maintenance()
         while True:
             schedule.run_pending()
             time.sleep(30)
@@ -107,60 +166,194 @@ class Scraper:
     def check_scraping_status(self):
         """Check scraping status (and fetch if needed)"""
         pass
+
+    def catch_up(self, missing, workers=None):
+        """Scrape missing menus, given as (source, year, week) tuples, through
+        a bounded worker pool. Every menu gets one attempt per round; only
+        the current week is retried in later rounds, as past weeks will not
+        show up anymore. Returns the number of scraped menus."""
+        workers = workers or self.CATCH_UP_WORKERS
+        current = utils.current_year_week()
+        progress = {"done": 0, "scraped": 0, "total": len(missing)}
+        progress_lock = threading.Lock()
+
+        def attempt(item):
+            source, year, week = item
+            year_week = utils.year_week(year, week)
+            success = self._scrape_single(self._scraper_for(source, week), source.name,
+                year_week, retries=1)
+            with progress_lock:
+                progress["done"] += 1
+                progress["scraped"] += int(bool(success))
+                logging.info("catch-up {done}/{total} ({scraped} scraped): {} {} {}".format(
+                    source.name, year_week, "done" if success else "failed", **progress))
+            return success
+
+        pending = list(missing)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for round_number in range(Scraper.MAX_RETRIES):
+                if round_number > 0:
+                    time.sleep(Scraper.RETRY_WAIT_TIME)
+                    progress["total"] += len(pending)
+                results = list(executor.map(attempt, pending))
+                pending = [ item for item, success in zip(pending, results)
+                    if not success and utils.year_week(item[1], item[2]) == current ]
+                if not pending:
+                    break
+        return progress["scraped"]
     
-    def _scrape_job(self):
-        """Start off scraping threads for all menus"""
+    def _schedule_maintenance(self):
+        """Schedule storage maintenance jobs"""
+        pass
+
+    def _scrape_job(self, scheduled=None):
+        """Start off scraping threads for the given sources (default: all),
+        most important first"""
         logging.info("starting scraping")
-        scrapings = (
-            (self.scrape_bistro, "uksh-bistro"),
-            (self.scrape_marli, "marli-sb"),
-            (self.scrape_mensa, "swsh-mensa"),
-            (self.scrape_mfc, "uksh-cafeteria")
-        )
-        for scraper, name in scrapings:
-            self._scrape_single_background(scraper, name)
-    
-    def _scrape_single(self, scraper, name):
-        """Scrape single menu (with retrying)"""
-        logging.info("scraping {}".format(name))
-        for _ in range(Scraper.MAX_RETRIES):
+        if scheduled is None:
+            scheduled = sources.by_priority()
+        for source in scheduled:
+            self._scrape_single_background(self._scraper_for(source), source.name)
+
+    def _scraper_for(self, source, week_number=None):
+        return lambda: self.scrape(source, week_number)
+
+    def _poll_job(self):
+        """Start polling threads for the sources the poller considers due"""
+        for source in self.poller.due():
+            with self._slots_lock:
+                if source.name in self._polling:
+                    continue
+                self._polling.add(source.name)
+            threading.Thread(target=self._poll, args=(source,), daemon=True).start()
+
+    def _poll(self, source):
+        """Poll a source for the current week's menu or changes of it. Only
+        changed content is parsed and stored."""
+        try:
+            week_number = utils.current_week()
+            state = self.poller.state(source)
+            timings = metrics.Timings()
             try:
-                menu, blob = scraper()
-                self._scrape_log(name, True, blob=blob)
-                self._menu(name, menu)
-                break
-            except ScrapingError as ex:
-                self._scrape_log(name, False, blob=ex.blob, error=traceback.format_exc(limit=2))
-                time.sleep(Scraper.RETRY_WAIT_TIME)
+                with metrics.timed(timings):
+                    data, validators = self.fetch_if_changed(source, week_number, state.validators)
             except Exception as ex:
-                self._scrape_log(name, False, error=traceback.format_exc(limit=1))
+                # not yet published, upstream errors are only worth a scrape
+                # log once parsing fails
+                logging.info("polling {} failed: {}".format(source.name, ex))
+                self.poller.polled(source, "missing" if not state.published else "error")
+                return
+            if data is None:
+                self.poller.polled(source, "not_modified" if validators is state.validators else "unchanged",
+                    validators)
+                return
+            logging.info("{} has new content".format(source.name))
+            stored = self._scrape_single(lambda: self._parse(source, data, week_number), source.name,
+                state.year_week, retries=1, timings=timings, content_hash=validators["content_hash"])
+            if stored is None:
+                # scraped by another replica (or just now), see what it stored
+                self.poller.polled(source, "claimed")
+            elif stored:
+                self.poller.polled(source, "changed", validators)
+            else:
+                # validators stay as they are, so the content is parsed again
+                self.poller.polled(source, "error")
+        finally:
+            with self._slots_lock:
+                self._polling.discard(source.name)
+
+    def _source_slots(self, name):
+        """Semaphore limiting concurrent scrapes of a source"""
+        with self._slots_lock:
+            if name not in self._slots:
+                try:
+                    max_parallel = sources.get(name).max_parallel
+                except KeyError:
+                    max_parallel = 1
+                self._slots[name] = threading.BoundedSemaphore(max_parallel)
+            return self._slots[name]
+    
+    def _scrape_single(self, scraper, name, year_week=None, retries=None, timings=None, content_hash=None):
+        """Scrape single menu (with retrying), returns whether it succeeded,
+        or None if it was not claimed (see _claim). Timings of an earlier
+        download can be given to be included in the scrape log, the hash
+        of already downloaded content to claim it (see _claim)."""
+        if not year_week:
+            year_week = utils.current_year_week()
+        if retries is None:
+            retries = Scraper.MAX_RETRIES
+        for attempt in range(retries):
+            if attempt > 0:
+                # the claim is given up while waiting, others may succeed meanwhile
                 time.sleep(Scraper.RETRY_WAIT_TIME)
+            with self._claim(name, year_week, content_hash) as lease:
+                if lease is None:
+                    return None
+                logging.info("scraping {} for {}".format(name, year_week))
+                with metrics.timed(timings if attempt == 0 else None) as timings, profiling.SCRAPER.profile():
+                    try:
+                        with self._source_slots(name):
+                            menu, blob = scraper()
+                        with metrics.stage("serialize"):
+                            document = self._menu(name, menu, year_week)
+                        if lease.lost:
+                            logging.warning("claim on {} for {} lost, not storing".format(name, year_week))
+                            return None
+                        with metrics.stage("store"):
+                            document["scrape_id"] = self._scrape_log(name, year_week, True, blob=blob)
+                            self._store_menu(document)
+                        lease.complete(year_week)
+                        self._store_timings(document["scrape_id"], timings.values)
+                        return True
+                    except ScrapingError as ex:
+                        self._scrape_log(name, year_week, False, blob=ex.blob,
+                            error=traceback.format_exc(limit=2), timings=timings.values)
+                    except Exception as ex:
+                        self._scrape_log(name, year_week, False, error=traceback.format_exc(limit=1),
+                            timings=timings.values)
+        return False
+
+    @contextmanager
+    def _claim(self, name, year_week, content_hash=None):
+        """Claim scraping a source's week for one attempt, yields the lease
+        (see mittagv2.leases.Lease) to work under, or None to skip. Success
+        is recorded with Lease.complete. With a content hash, the week is
+        only skipped if that content is stored already."""
+        yield leases.Lease("source/" + name, None)
     
     def _scrape_single_background(self, scraper, name):
         """Scrape a single menu in background"""
         t = threading.Thread(target=lambda: self._scrape_single(scraper, name))
         t.start()
     
-    def _scrape_log(self, name, success, blob=None, error=None):
-        """Store scraping log - raw data and metadata from scraping"""
+    def _scrape_log(self, name, year_week, success, blob=None, error=None, timings=None):
+        """Store scraping log - raw data and metadata from scraping. Timings
+        are added last (see mittagv2.metrics.ScrapeLogCollector)."""
         document = {
             "type": "scrape_log",
             "source_name": name,
+            "year_week": year_week,
             "at": utils.timestamp_rfc3339(),
             "success": success,
         }
         if error != None:
             document["error"] = str(error)
+        if blob is not None:
+            document["content_hash"] = polling.content_hash(blob)
         logging.info("scraped: {}".format(document))
-        self._store_scrape_log(document, blob)
+        scrape_id = self._store_scrape_log(document, blob)
+        if timings is not None:
+            self._store_timings(scrape_id, timings)
+        return scrape_id
 
-    def _menu(self, name, menu):
-        """Store menu data"""
+    def _menu(self, name, menu, year_week):
+        """Build menu document for storage"""
         weekly = {
-            "year_week": utils.current_year_week(), 
+            "year_week": year_week,
             "days": []
         }
         document = {
+            "_id": utils.menu_id(name, year_week),
             "type": "weekly_menu", 
             "at": utils.timestamp_rfc3339(),
             "source_name": name,
@@ -193,54 +386,188 @@ class Scraper:
             if len(day) > 0:
                 weekly["days"].append(day)
         logging.info("menu received: {}".format(document))
-        self._store_menu(document)
+        return document
 
     def _store_scrape_log(self, document, blob=None):
+        """Store scrape log and return its id"""
         pass
     
     def _store_menu(self, document):
         pass
 
-class CouchScraper(Scraper):
-    """Scraper with CouchDB data storage"""
+    def _store_timings(self, scrape_id, timings):
+        """Add stage timings to a stored scrape log"""
+        pass
 
-    def __init__(self, user=None, auth=None, url=None):
-        self.db = utils.couch_connect(user, auth, url)
-        self.scrapings = self.db.create_database("mv2_scrapings")
-        self.menus = self.db.create_database("mv2_menus")
-        utils.create_couch_views(self.menus)
-        self._last_scrape = None
+class StorageScraper(Scraper):
+    """Scraper with pluggable data storage (see mittagv2.storage). With a
+    lease manager (see mittagv2.leases), several replicas can share the
+    work: each source is scraped by one replica at a time, the others wait
+    and take over if it dies."""
+
+    COMPLETED_WITHIN = 3600 #: Scrapes of a week completed this recently (seconds) are skipped, unless the content changed
+    RETENTION_AT = "03:30" #: Daily time of the retention run (off-peak)
+
+    def __init__(self, backend, leases=None, feeds=None, poller=None):
+        super().__init__(poller)
+        self.storage = backend
+        self.revisions = revisions.MenuRevisions(backend)
+        self.read_models = readmodels.ReadModels(backend)
+        self.leases = leases
+        self.feeds = feeds
+
+    def migrate_menu_ids(self):
+        """Move weekly menus stored under random ids (and with space padded
+        weeks) to their deterministic ids. Where both exist, the newer
+        document wins: a newer legacy document becomes the next revision
+        (see mittagv2.revisions), an older one goes to the menu archive."""
+        for doc_id in self.storage.weekly_menu_ids():
+            if "/" in doc_id:
+                continue
+            legacy = self.storage.get(storage.MENUS, doc_id)
+            year_week = utils.normalize_year_week(legacy["menus"]["year_week"])
+            target = utils.menu_id(legacy["source_name"], year_week)
+            logging.info("migrating menu {} to {}".format(doc_id, target))
+            try:
+                current = self.storage.get(storage.MENUS, target)
+            except KeyError:
+                current = None
+            if current is not None and current["at"] >= legacy["at"]:
+                self.storage.archive(storage.MENU_ARCHIVE, legacy, doc_id=target)
+            else:
+                document = { k: v for k, v in legacy.items() if not k.startswith("_") }
+                document["_id"] = target
+                document["menus"]["year_week"] = year_week
+                self.revisions.store(document)
+            self.storage.delete(storage.MENUS, doc_id, legacy["_rev"])
+
+    def migrate_menu_history(self):
+        """Move complete weekly_menu copies that earlier versions stored in
+        the menu history (ids "<doc_id>@<couchdb revision>") to the menu
+        archive, leaving only menu_revision documents"""
+        doc_ids = [ doc_id for doc_id in self.storage.ids(storage.MENU_HISTORY)
+            if "-" in doc_id.rpartition("@")[2] ]
+        for document in self.storage.get_many(storage.MENU_HISTORY, doc_ids):
+            if document is None or document.get("type") != "weekly_menu":
+                continue
+            logging.info("moving {} to the menu archive".format(document["_id"]))
+            try:
+                self.storage.put(storage.MENU_ARCHIVE, { k: v for k, v in document.items() if k != "_rev" })
+            except storage.Conflict:
+                pass # moved before
+            self.storage.delete(storage.MENU_HISTORY, document["_id"], document["_rev"])
+
+    def plan_catch_up(self, weeks=None):
+        """Find menus missing for the last weeks, as (source, year, week)
+        tuples with the most recent week and most important source first.
+        The status of all of them is resolved in a single request. Sources
+        without a week in their URL can only be scraped for the current
+        week."""
+        candidates = []
+        for offset, (year, week) in enumerate(utils.recent_weeks(weeks or self.CATCH_UP_WEEKS)):
+            for source in sources.by_priority():
+                if offset == 0 or source.weekly:
+                    candidates.append((source, year, week))
+        existing = self.storage.exists(storage.MENUS, [ utils.menu_id(source.name,
+            utils.year_week(year, week)) for source, year, week in candidates ])
+        return [ (source, year, week) for source, year, week in candidates
+            if utils.menu_id(source.name, utils.year_week(year, week)) not in existing ]
+
+    def _schedule_maintenance(self):
+        schedule.every().day.at(self.RETENTION_AT).do(
+            lambda: threading.Thread(target=self.apply_retention, daemon=True).start())
+
+    def apply_retention(self):
+        """Apply the retention policy (see mittagv2.retention) to the scrape
+        logs, on one replica only"""
+        if self.leases is None:
+            return retention.Retention(self.storage, retention.open_archive(),
+                retention.RetentionPolicy.from_env()).run()
+        with self.leases.hold("maintenance/retention") as lease:
+            if lease is not None:
+                return retention.Retention(self.storage, retention.open_archive(),
+                    retention.RetentionPolicy.from_env()).run()
 
     def check_scraping_status(self):
-        sources = {
-            "swsh-mensa": self.scrape_mensa,
-            "marli-sb": self.scrape_marli,
-            "uksh-cafeteria": self.scrape_mfc,
-            "uksh-bistro": self.scrape_bistro
-        }
-        for s in sources.keys():
-            menu_key = "{}/{}".format(s, utils.current_year_week())
-            res = self.menus.get_view_result("_design/views", "bySourceNameYearWeek", key=menu_key).all()
-            if len(res) == 0:
-                logging.info("{} has no menu for current week, trying to scrape".format(s))
-                self._scrape_single_background(sources[s], s)
+        missing = self.plan_catch_up()
+        if len(missing) == 0:
+            return
+        logging.info("missing menus, trying to scrape: {}".format(", ".join(
+            utils.menu_id(source.name, utils.year_week(year, week)) for source, year, week in missing)))
+        t = threading.Thread(target=self.catch_up, args=(missing,), daemon=True)
+        t.start()
+
+    @contextmanager
+    def _claim(self, name, year_week, content_hash=None):
+        if self.leases is None:
+            yield leases.Lease("source/" + name, None)
+            return
+        key = "source/" + name
+        while True:
+            with self.leases.hold(key) as lease:
+                if lease is not None:
+                    yield None if self._recently_completed(lease.document, name, year_week, content_hash) else lease
+                    return
+            document = self.leases.get(key)
+            if document is not None and self._recently_completed(document, name, year_week, content_hash):
+                yield None
+                return
+            logging.info("{} is scraped by {}, waiting".format(name, document and document.get("owner")))
+            time.sleep(self.leases.heartbeat)
 
+    def _recently_completed(self, document, name, year_week, content_hash=None):
+        completed = leases.completed_at(document, year_week)
+        if completed is None or time.time() - completed >= self.COMPLETED_WITHIN:
+            return False
+        if content_hash is not None and polling.stored_hash(self.storage,
+                utils.menu_id(name, year_week)) != content_hash:
+            return False # changed again since, e.g. corrected
+        logging.info("{} already scraped for {}".format(document["_id"], year_week))
+        return True
 
     def _store_scrape_log(self, document, blob=None):
-        doc = self.scrapings.create_document(document)
-        scrape_name = "{}_{}.bin".format(document["source_name"], utils.current_year_week())
+        self.storage.put(storage.SCRAPINGS, document)
+        scrape_name = "{}_{}.bin".format(document["source_name"], document["year_week"])
         if blob != None:
-            doc.put_attachment(scrape_name, "application/octet-stream", blob)
-        self._last_scrape = doc
+            self.storage.put_blob(storage.SCRAPINGS, document["_id"], document["_rev"],
+                scrape_name, "application/octet-stream", blob)
+        return document["_id"]
     
     def _store_menu(self, document):
-        if not self._last_scrape:
-            raise RuntimeError("store scrape first")
-        document["scrape_id"] = self._last_scrape["_id"]
-        self.menus.create_document(document)
-        self._last_scrape = None
+        if self.revisions.store(document) is None:
+            logging.info("menu {} unchanged".format(document["_id"]))
+            return
+        try:
+            changed = self.read_models.rebuild(document["menus"]["year_week"])
+            logging.info("read models updated: {}".format(", ".join(changed)))
+        except Exception:
+            logging.exception("updating read models failed")
+        if self.feeds is not None:
+            try:
+                changed = self.feeds.update(document["menus"]["year_week"])
+                logging.info("feeds updated: {}".format(", ".join(changed)))
+            except Exception:
+                logging.exception("updating feeds failed")
+
+    def _store_timings(self, scrape_id, timings):
+        document = self.storage.get(storage.SCRAPINGS, scrape_id)
+        document["timings"] = dict(timings)
+        self.storage.put(storage.SCRAPINGS, document)
+
+class CouchScraper(StorageScraper):
+    """Scraper with CouchDB data storage"""
+
+    def __init__(self, user=None, auth=None, url=None):
+        from mittagv2.db import CouchClient
+        super().__init__(storage.CouchStorage(CouchClient(user, auth, url)))
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    scraper = CouchScraper()
-    scraper.scheduled_scraper()
\ No newline at end of file
+    profiling.install_signal_handlers(profiling.SCRAPER)
+    backend = storage.open_storage()
+    scraper = StorageScraper(backend, leases=leases.LeaseManager(backend),
+        feeds=feeds.open_feeds(backend), poller=polling.open_poller(backend))
+    scraper.migrate_menu_ids()
+    scraper.migrate_menu_history()
+    scraper.read_models.catch_up()
+    scraper.scheduled_scraper()
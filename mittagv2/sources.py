@@ -0,0 +1,103 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import importlib
+import io
+
+class Source:
+    """Declaration of a canteen menu source.
+
+    The URL may contain a {week} placeholder for sources publishing one
+    document per calendar week. Parsers are given as "module:Class" and
+    only imported when the source is actually parsed."""
+
+    def __init__(self, name, title, url, parser, link=None, kind="html",
+            schedule=("monday", "07:00"), priority=0, timeout=60, max_parallel=1):
+        self.name = name #: Source name used in documents, e.g. "uksh-bistro"
+        self.title = title #: Human readable name
+        self.url = url #: Download URL template
+        self.parser = parser #: Parser class as "module:Class"
+        self.link = link if link else url #: Link for humans, same placeholders as url
+        self.kind = kind #: "html" or "pdf"
+        self.schedule = schedule #: (weekday, time) of regular scraping
+        self.priority = priority #: Lower numbers are scraped first
+        self.timeout = timeout #: Download timeout in seconds
+        self.max_parallel = max_parallel #: Maximum concurrent scrapes
+
+    def __repr__(self):
+        return "Source({!r})".format(self.name)
+
+    @property
+    def weekly(self):
+        """Whether documents for arbitrary weeks can be fetched"""
+        return "{week" in self.url
+
+    def url_for(self, week_number):
+        return self.url.format(week=week_number)
+
+    def link_for(self, week_number):
+        return self.link.format(week=week_number)
+
+    def parser_class(self):
+        module_name, class_name = self.parser.split(":")
+        return getattr(importlib.import_module(module_name), class_name)
+
+    def parse(self, data, week_number):
+        """Parse raw downloaded data into a WeeklyMenu"""
+        parser = self.parser_class()
+        if self.kind == "pdf":
+            return parser(week_number, io.BytesIO(data)).parse()
+        return parser(week_number).parse(data.decode("UTF-8"))
+
+SOURCES = [
+    Source("swsh-mensa", "Mensa",
+        "https://www.studentenwerk.sh/de/essen/standorte/luebeck/mensa-luebeck/speiseplan.html",
+        "mittagv2.mensa_parser:MensaParser", priority=0),
+    Source("uksh-cafeteria", "Cafeteria MFC UKSH",
+        "https://www.uksh.de/uksh_media/Speisepl%C3%A4ne/L%C3%BCbeck+_+MFC+Cafeteria/Speiseplan+Cafeteria+MFC+KW+{week:02}.pdf",
+        "mittagv2.uksh_parser:MfcParser", kind="pdf", priority=1),
+    Source("marli-sb", "Marli Kantine",
+        "https://www.marli.de/rs/gastronomie_und_begegnung/mittagsangebote/index.html",
+        "mittagv2.marli_parser:MarliParser", priority=0),
+    Source("uksh-bistro", "Casino/Bistro UKSH",
+        "https://www.uksh.de/uksh_media/Speisepl%C3%A4ne/L%C3%BCbeck+_+UKSH_Bistro/Speiseplan+Bistro+KW+{week:02}.pdf",
+        "mittagv2.uksh_parser:BistroParser", kind="pdf", priority=1),
+] #: All known sources, in display order
+
+def register(source):
+    """Add a source to the registry, replacing one with the same name"""
+    for i, s in enumerate(SOURCES):
+        if s.name == source.name:
+            SOURCES[i] = source
+            return
+    SOURCES.append(source)
+
+def get(name):
+    """Get source by name, raise KeyError if unknown"""
+    for s in SOURCES:
+        if s.name == name:
+            return s
+    raise KeyError(name)
+
+def by_priority():
+    """All sources, most important first"""
+    return sorted(SOURCES, key=lambda s: s.priority)
@@ -27,6 +27,7 @@ from datetime import date
 import datetime
 from string import Template
 import mittagv2.scraper as scraper
+import mittagv2.sources as sources
 import mittagv2.utils as utils
 
 class StaticSiteGenerator:
@@ -38,26 +39,29 @@ class StaticSiteGenerator:
         self._day = day_number if day_number != None else utils.current_day()
     
     def get_menus(self):
-        """Get menu data"""
-        bistro_menu, _ = self.scraper.scrape_bistro(week_number=self._week)
-        mfc_menu, _ = self.scraper.scrape_mfc(week_number=self._week)
-        marli_menu, _ = self.scraper.scrape_marli()
-        mensa_menu, _ = self.scraper.scrape_mensa()
-        return bistro_menu, mfc_menu, marli_menu, mensa_menu
+        """Get menu data of all sources by source name"""
+        menus = {}
+        for source in sources.SOURCES:
+            week_number = self._week if source.weekly else None
+            menus[source.name], _ = self.scraper.scrape(source, week_number=week_number)
+        return menus
     
     def scrape_all(self):
         """Scrape all current data"""
-        bistro_menu, mfc_menu, marli_menu, mensa_menu = self.get_menus()
-        bistro_html = self.day_to_html(bistro_menu.days[self._day], bistro_menu)
-        marli_html = self.day_to_html(marli_menu.days[self._day], marli_menu)
-        mfc_html = self.day_to_html(mfc_menu.days[self._day], mfc_menu)
-        mensa_html = self.day_to_html(mensa_menu.days[self._day], mensa_menu)
+        menus = self.get_menus()
+        header_cells = []
+        menu_cells = []
+        for source in sources.SOURCES:
+            menu = menus[source.name]
+            header_cells.append("<th>\n<a href=\"{}\" target=\"_blank\">{}</a>\n</th>".format(
+                escape(source.link_for(self._week)), escape(source.title)))
+            menu_cells.append("<td valign=\"top\">\n{}\n</td>".format(
+                self.day_to_html(menu.days[self._day], menu)))
         with open("mittagv2/resources/static_template.html") as template_file:
             template = Template(template_file.read())
-            html = template.substitute(MFC_MENUS=mfc_html, MARLI_MENUS=marli_html,
-                MENSA_MENUS=mensa_html, BISTRO_MENUS=bistro_html,
-                DATE_STRING=datetime.datetime.now().date().isoformat(),
-                WEEK_NUMBER=self._week)
+            html = template.substitute(HEADER_CELLS="\n".join(header_cells),
+                MENU_CELLS="\n".join(menu_cells),
+                DATE_STRING=datetime.datetime.now().date().isoformat())
             print(html)
 
     def day_to_html(self, day, week):
@@ -0,0 +1,685 @@
+#
+# Copyright 2019 Grigori Goronzy <greg@kinoho.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from urllib.parse import quote
+import mittagv2.utils as utils
+from mittagv2.db import doc_path
+
+MENUS = "menus" #: Collection of weekly_menu documents
+SCRAPINGS = "scrapings" #: Collection of scrape_log documents and raw data
+MENU_HISTORY = "menu_history" #: Replaced revisions of weekly_menu documents
+MENU_ARCHIVE = "menu_archive" #: Complete weekly_menu documents outside the revision history (see mittagv2.revisions)
+LEASES = "leases" #: Lease documents coordinating scraper replicas
+READ_MODELS = "read_models" #: Day and week documents derived from weekly menus (see mittagv2.readmodels)
+
+class Conflict(Exception):
+    """Document was changed concurrently (revision mismatch)"""
+
+class Storage(ABC):
+    """Storage backend for menus, scrape logs and raw scrape data.
+
+    Documents are dicts with CouchDB semantics: "_id" and "_rev" are set
+    by the backend, and updates must carry the current "_rev" or fail
+    with Conflict. Raw data is attached to documents as named blobs."""
+
+    @abstractmethod
+    def get(self, collection, doc_id):
+        """Get document by id, raise KeyError if missing"""
+
+    @abstractmethod
+    def get_many(self, collection, doc_ids):
+        """Get several documents at once, None for missing ones"""
+
+    @abstractmethod
+    def exists(self, collection, doc_ids):
+        """Get the subset of doc_ids that exist, in one request"""
+
+    @abstractmethod
+    def ids(self, collection):
+        """Get ids of all documents in a collection"""
+
+    @abstractmethod
+    def put(self, collection, document):
+        """Create or update a document. Sets "_id" and "_rev" on the given
+        document and returns the new revision."""
+
+    @abstractmethod
+    def put_many(self, collection, documents):
+        """Create or update several documents in one request. Sets "_id"
+        and "_rev" on the stored documents and returns, per document, the
+        new revision or the exception (e.g. Conflict) that prevented
+        storing it."""
+
+    @abstractmethod
+    def delete(self, collection, doc_id, rev):
+        """Delete a document"""
+
+    @abstractmethod
+    def put_blob(self, collection, doc_id, rev, name, content_type, data):
+        """Attach raw data to a document and return its new revision"""
+
+    @abstractmethod
+    def get_blob(self, collection, doc_id, name=None):
+        """Get attached data as (name, content_type, data). Returns the
+        first blob if no name is given."""
+
+    @abstractmethod
+    def delete_blob(self, collection, doc_id, rev, name):
+        """Remove attached data from a document and return its new revision"""
+
+    @abstractmethod
+    def compact(self):
+        """Reclaim space of deleted and replaced data and rebuild indexes"""
+
+    @abstractmethod
+    def weekly_menus(self, year_week, source_name=None):
+        """Get weekly_menu documents for a week, optionally of one source"""
+
+    @abstractmethod
+    def weekly_menu_ids(self):
+        """Get ids of all weekly_menu documents, ordered by week"""
+
+    @abstractmethod
+    def scrape_logs(self, first_year_week, last_year_week=None):
+        """Get scrape_log documents of a range of weeks, without raw data"""
+
+    @abstractmethod
+    def changes(self, collection, since=None, timeout=0):
+        """Get changes after sequence "since" as (last_seq, changes), each
+        change a dict with seq, id, rev and deleted. "now" starts after the
+        latest change. Waits up to timeout seconds for the first change."""
+
+    def archive(self, history, document, doc_id=None):
+        """Copy a stored document revision into a history collection. The
+        copy gets the id <doc_id>@<rev>, so archiving is idempotent."""
+        try:
+            self.put(history, self._revision(document, doc_id))
+        except Conflict:
+            pass # already archived
+
+    def _revision(self, document, doc_id=None):
+        """Build history copy of a document revision"""
+        doc_id = doc_id if doc_id else document["_id"]
+        revision = { k: v for k, v in document.items() if not k.startswith("_") }
+        revision["_id"] = "{}@{}".format(doc_id, document["_rev"])
+        revision["doc_id"] = doc_id
+        revision["doc_rev"] = document["_rev"]
+        return revision
+
+    def upsert(self, collection, document, history=None, retries=5):
+        """Create or replace the document with the given "_id", whatever
+        its current revision. The replaced revision is archived to the
+        history collection, if given. Concurrent writers are detected by
+        revision check and retried."""
+        for _ in range(retries):
+            try:
+                current = self.get(collection, document["_id"])
+            except KeyError:
+                current = None
+            if current is not None:
+                if history:
+                    self.archive(history, current)
+                document["_rev"] = current["_rev"]
+            else:
+                document.pop("_rev", None)
+            try:
+                return self.put(collection, document)
+            except Conflict:
+                continue
+        raise Conflict(document["_id"])
+
+    def upsert_many(self, collection, documents, history=None):
+        """Bulk version of upsert: replaced revisions are archived and all
+        documents are written with one request each. Documents changed
+        concurrently fall back to upsert."""
+        currents = self.get_many(collection, [ d["_id"] for d in documents ])
+        if history:
+            archived = [ c for c in currents if c is not None ]
+            self.put_many(history, [ self._revision(c) for c in archived ])
+        for document, current in zip(documents, currents):
+            if current is not None:
+                document["_rev"] = current["_rev"]
+            else:
+                document.pop("_rev", None)
+        results = self.put_many(collection, documents)
+        for i, result in enumerate(results):
+            if isinstance(result, Conflict):
+                results[i] = self.upsert(collection, documents[i], history=history)
+            elif isinstance(result, Exception):
+                raise result
+        return results
+
+def _doc_year_week(document):
+    if "year_week" in document:
+        return document["year_week"]
+    return document.get("menus", {}).get("year_week")
+
+class CouchStorage(Storage):
+    """CouchDB storage. Collections map to databases prefixed with mv2_."""
+
+    VIEWS = {
+        "_id": "_design/views",
+        "views": {
+            "byYearWeek": {
+                "map": "function (doc) {\n  if (doc.type === \"weekly_menu\" && doc.menus.year_week)\n    emit(doc.menus.year_week, doc);\n}"
+            },
+            "bySourceNameYearWeek": {
+                "map": "function (doc) {\n  if (doc.type === \"weekly_menu\" && doc.source_name && doc.menus.year_week)\n    emit(doc.source_name+\"/\"+doc.menus.year_week, doc);\n}"
+            }
+        },
+        "language": "javascript"
+    }
+    SCRAPING_VIEWS = {
+        "_id": "_design/views",
+        "views": {
+            "logsByYearWeek": {
+                "map": "function (doc) {\n  if (doc.type === \"scrape_log\" && doc.year_week)\n    emit(doc.year_week, null);\n}"
+            }
+        },
+        "language": "javascript"
+    }
+
+    def __init__(self, client=None):
+        self.client = client if client else utils.couch_client()
+        for collection in (MENUS, SCRAPINGS, MENU_HISTORY, MENU_ARCHIVE, LEASES, READ_MODELS):
+            self._create_database(collection)
+        self._ensure_views()
+
+    def _database(self, collection):
+        return "mv2_" + collection
+
+    def _create_database(self, collection):
+        try:
+            self.client.request("PUT", self._database(collection))
+        except Exception as ex:
+            if not _is_status(ex, 412):
+                raise
+
+    def _ensure_views(self):
+        for collection, views in ((MENUS, CouchStorage.VIEWS), (SCRAPINGS, CouchStorage.SCRAPING_VIEWS)):
+            design = dict(views)
+            try:
+                current = self.get(collection, design["_id"])
+                if current["views"] == design["views"]:
+                    continue
+                design["_rev"] = current["_rev"]
+            except KeyError:
+                pass
+            try:
+                self.put(collection, design)
+            except Conflict:
+                pass # updated concurrently by another process
+
+    def get(self, collection, doc_id):
+        return self.client.get_document(self._database(collection), doc_id)
+
+    def get_many(self, collection, doc_ids):
+        rows = self.client.all_docs(self._database(collection), keys=list(doc_ids), include_docs=True)
+        return [ row.get("doc") for row in rows ]
+
+    def exists(self, collection, doc_ids):
+        rows = self.client.all_docs(self._database(collection), keys=list(doc_ids))
+        return set(row["key"] for row in rows
+            if "error" not in row and not row.get("value", {}).get("deleted", False))
+
+    def ids(self, collection):
+        rows = self.client.all_docs(self._database(collection))
+        return [ row["id"] for row in rows if not row["id"].startswith("_design/") ]
+
+    def put(self, collection, document):
+        database = self._database(collection)
+        try:
+            if "_id" in document:
+                res = self.client.request("PUT", database, doc_path(document["_id"]), json=document).json()
+            else:
+                res = self.client.request("POST", database, json=document).json()
+        except Exception as ex:
+            if _is_status(ex, 409):
+                raise Conflict(document.get("_id"))
+            raise
+        document["_id"] = res["id"]
+        document["_rev"] = res["rev"]
+        return res["rev"]
+
+    def put_many(self, collection, documents):
+        if len(documents) == 0:
+            return []
+        rows = self.client.request("POST", self._database(collection), "_bulk_docs",
+            json={"docs": documents}).json()
+        results = []
+        for document, row in zip(documents, rows):
+            if "error" in row:
+                if row["error"] == "conflict":
+                    results.append(Conflict(row.get("id")))
+                else:
+                    results.append(RuntimeError("{}: {}".format(row["error"], row.get("reason"))))
+            else:
+                document["_id"] = row["id"]
+                document["_rev"] = row["rev"]
+                results.append(row["rev"])
+        return results
+
+    def delete(self, collection, doc_id, rev):
+        try:
+            self.client.request("DELETE", self._database(collection), doc_path(doc_id), params={"rev": rev})
+        except Exception as ex:
+            if _is_status(ex, 409):
+                raise Conflict(doc_id)
+            raise
+
+    def put_blob(self, collection, doc_id, rev, name, content_type, data):
+        path = "{}/{}".format(doc_path(doc_id), quote(name, safe=""))
+        try:
+            res = self.client.request("PUT", self._database(collection), path, params={"rev": rev},
+                data=data, headers={"Content-Type": content_type}).json()
+        except Exception as ex:
+            if _is_status(ex, 409):
+                raise Conflict(doc_id)
+            raise
+        return res["rev"]
+
+    def get_blob(self, collection, doc_id, name=None):
+        database = self._database(collection)
+        document = self.client.get_document(database, doc_id)
+        attachments = document.get("_attachments", {})
+        if name is None:
+            if len(attachments) == 0:
+                raise KeyError(doc_id)
+            name = list(attachments.keys())[0]
+        if name not in attachments:
+            raise KeyError(name)
+        data = self.client.get_attachment(database, doc_id, name)
+        return name, attachments[name]["content_type"], data
+
+    def delete_blob(self, collection, doc_id, rev, name):
+        path = "{}/{}".format(doc_path(doc_id), quote(name, safe=""))
+        try:
+            res = self.client.request("DELETE", self._database(collection), path, params={"rev": rev}).json()
+        except Exception as ex:
+            if _is_status(ex, 409):
+                raise Conflict(doc_id)
+            raise
+        return res["rev"]
+
+    def compact(self):
+        for collection in (MENUS, SCRAPINGS, MENU_HISTORY, MENU_ARCHIVE, LEASES, READ_MODELS):
+            self.client.request("POST", self._database(collection), "_compact", json={})
+        self.client.request("POST", self._database(MENUS), "_compact/views", json={})
+        self.client.request("POST", self._database(MENUS), "_view_cleanup", json={})
+
+    def weekly_menus(self, year_week, source_name=None):
+        if source_name:
+            rows = self.client.view(self._database(MENUS), "views", "bySourceNameYearWeek",
+                key="{}/{}".format(source_name, year_week))
+        else:
+            rows = self.client.view(self._database(MENUS), "views", "byYearWeek", key=year_week)
+        return [ row["value"] for row in rows ]
+
+    def scrape_logs(self, first_year_week, last_year_week=None):
+        params = {"startkey": first_year_week, "include_docs": True}
+        if last_year_week is not None:
+            params["endkey"] = last_year_week
+        rows = self.client.view(self._database(SCRAPINGS), "views", "logsByYearWeek", **params)
+        return [ row["doc"] for row in rows ]
+
+    def weekly_menu_ids(self):
+        rows = self.client.view(self._database(MENUS), "views", "byYearWeek")
+        return [ row["id"] for row in rows ]
+
+    def changes(self, collection, since=None, timeout=0):
+        params = {"since": since if since is not None else 0}
+        if timeout:
+            params["feed"] = "longpoll"
+            params["timeout"] = int(timeout * 1000)
+        res = self.client.request("GET", self._database(collection), "_changes", params=params).json()
+        changes = []
+        for row in res["results"]:
+            changes.append({
+                "seq": row["seq"],
+                "id": row["id"],
+                "rev": row["changes"][0]["rev"],
+                "deleted": row.get("deleted", False),
+            })
+        return res["last_seq"], changes
+
+def _is_status(ex, status_code):
+    """Check whether exception is a HTTP error with the given status"""
+    response = getattr(ex, "response", None)
+    return response is not None and response.status_code == status_code
+
+class SqliteStorage(Storage):
+    """Embedded SQLite storage (WAL mode) for single-node installs, tests
+    and benchmarks. Pass ":memory:" for a throwaway in-process database.
+    A single connection is shared by all threads and serialized by a lock,
+    which is plenty for reads that take a few microseconds."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS documents (
+            collection TEXT NOT NULL,
+            id TEXT NOT NULL,
+            rev TEXT NOT NULL,
+            type TEXT,
+            source_name TEXT,
+            year_week TEXT,
+            body TEXT NOT NULL,
+            PRIMARY KEY (collection, id)
+        );
+        CREATE INDEX IF NOT EXISTS documents_source_week
+            ON documents (collection, source_name, year_week);
+        CREATE INDEX IF NOT EXISTS documents_week
+            ON documents (collection, year_week);
+        CREATE TABLE IF NOT EXISTS blobs (
+            collection TEXT NOT NULL,
+            id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            content_type TEXT NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (collection, id, name)
+        );
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            collection TEXT NOT NULL,
+            id TEXT NOT NULL,
+            rev TEXT NOT NULL,
+            deleted INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS changes_collection ON changes (collection, seq);
+    """
+
+    POLL_INTERVAL = 0.2 #: Interval for polling changes in seconds
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.RLock()
+        with self._lock:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SqliteStorage.SCHEMA)
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _load(self, collection, doc_id, rev, body, blobs=None):
+        document = json.loads(body)
+        document["_id"] = doc_id
+        document["_rev"] = rev
+        if blobs is None:
+            blobs = self._execute("SELECT name, content_type, length(data) FROM blobs "
+                "WHERE collection = ? AND id = ?", (collection, doc_id))
+        if len(blobs) > 0:
+            document["_attachments"] = {
+                name: {"content_type": content_type, "length": length, "stub": True}
+                for name, content_type, length in blobs
+            }
+        return document
+
+    def _next_rev(self, rev, body):
+        generation = int(rev.split("-")[0]) if rev else 0
+        return "{}-{}".format(generation + 1, hashlib.md5(body.encode("UTF-8")).hexdigest())
+
+    def _bump(self, collection, doc_id, rev, deleted=False):
+        """Record a change, must be called inside a transaction"""
+        self._conn.execute("INSERT INTO changes (collection, id, rev, deleted) VALUES (?, ?, ?, ?)",
+            (collection, doc_id, rev, 1 if deleted else 0))
+
+    def get(self, collection, doc_id):
+        rows = self._execute("SELECT rev, body FROM documents WHERE collection = ? AND id = ?",
+            (collection, doc_id))
+        if len(rows) == 0:
+            raise KeyError(doc_id)
+        return self._load(collection, doc_id, rows[0][0], rows[0][1])
+
+    def get_many(self, collection, doc_ids):
+        doc_ids = list(doc_ids)
+        found = {}
+        blobs = {}
+        for i in range(0, len(doc_ids), 500):
+            chunk = doc_ids[i:i + 500]
+            marks = ", ".join("?" * len(chunk))
+            rows = self._execute("SELECT id, rev, body FROM documents WHERE collection = ? AND id IN ({})".format(
+                marks), [collection] + chunk)
+            found.update((row[0], row[1:]) for row in rows)
+            rows = self._execute("SELECT id, name, content_type, length(data) FROM blobs "
+                "WHERE collection = ? AND id IN ({})".format(marks), [collection] + chunk)
+            for row in rows:
+                blobs.setdefault(row[0], []).append(row[1:])
+        return [ self._load(collection, doc_id, found[doc_id][0], found[doc_id][1], blobs.get(doc_id, []))
+            if doc_id in found else None for doc_id in doc_ids ]
+
+    def exists(self, collection, doc_ids):
+        doc_ids = list(doc_ids)
+        found = set()
+        for i in range(0, len(doc_ids), 500):
+            chunk = doc_ids[i:i + 500]
+            rows = self._execute("SELECT id FROM documents WHERE collection = ? AND id IN ({})".format(
+                ", ".join("?" * len(chunk))), [collection] + chunk)
+            found.update(row[0] for row in rows)
+        return found
+
+    def ids(self, collection):
+        rows = self._execute("SELECT id FROM documents WHERE collection = ? ORDER BY id", (collection,))
+        return [ row[0] for row in rows ]
+
+    def _write(self, collection, document):
+        """Store a document, must be called inside a transaction"""
+        doc_id = document.get("_id", uuid.uuid4().hex)
+        body = json.dumps({ k: v for k, v in document.items() if not k.startswith("_") })
+        rows = self._conn.execute("SELECT rev FROM documents WHERE collection = ? AND id = ?",
+            (collection, doc_id)).fetchall()
+        current = rows[0][0] if len(rows) > 0 else None
+        if current != document.get("_rev"):
+            raise Conflict(doc_id)
+        rev = self._next_rev(current, body)
+        self._conn.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (collection, doc_id, rev, document.get("type"), document.get("source_name"),
+            _doc_year_week(document), body))
+        self._bump(collection, doc_id, rev)
+        return doc_id, rev
+
+    def put(self, collection, document):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                doc_id, rev = self._write(collection, document)
+                self._conn.execute("COMMIT")
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+        document["_id"] = doc_id
+        document["_rev"] = rev
+        return rev
+
+    def put_many(self, collection, documents):
+        results = []
+        stored = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for document in documents:
+                    try:
+                        stored.append((document,) + self._write(collection, document))
+                        results.append(stored[-1][2])
+                    except Conflict as ex:
+                        results.append(ex)
+                self._conn.execute("COMMIT")
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+        for document, doc_id, rev in stored:
+            document["_id"] = doc_id
+            document["_rev"] = rev
+        return results
+
+    def delete(self, collection, doc_id, rev):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute("SELECT rev FROM documents WHERE collection = ? AND id = ?",
+                    (collection, doc_id)).fetchall()
+                if len(rows) == 0:
+                    raise KeyError(doc_id)
+                if rows[0][0] != rev:
+                    raise Conflict(doc_id)
+                self._conn.execute("DELETE FROM documents WHERE collection = ? AND id = ?", (collection, doc_id))
+                self._conn.execute("DELETE FROM blobs WHERE collection = ? AND id = ?", (collection, doc_id))
+                self._bump(collection, doc_id, self._next_rev(rev, ""), deleted=True)
+                self._conn.execute("COMMIT")
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def put_blob(self, collection, doc_id, rev, name, content_type, data):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute("SELECT rev, body FROM documents WHERE collection = ? AND id = ?",
+                    (collection, doc_id)).fetchall()
+                if len(rows) == 0:
+                    raise KeyError(doc_id)
+                if rows[0][0] != rev:
+                    raise Conflict(doc_id)
+                new_rev = self._next_rev(rev, rows[0][1] + name)
+                self._conn.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?)",
+                    (collection, doc_id, name, content_type, data))
+                self._conn.execute("UPDATE documents SET rev = ? WHERE collection = ? AND id = ?",
+                    (new_rev, collection, doc_id))
+                self._bump(collection, doc_id, new_rev)
+                self._conn.execute("COMMIT")
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+        return new_rev
+
+    def get_blob(self, collection, doc_id, name=None):
+        if name is None:
+            rows = self._execute("SELECT name, content_type, data FROM blobs WHERE collection = ? AND id = ? ORDER BY name LIMIT 1",
+                (collection, doc_id))
+        else:
+            rows = self._execute("SELECT name, content_type, data FROM blobs WHERE collection = ? AND id = ? AND name = ?",
+                (collection, doc_id, name))
+        if len(rows) == 0:
+            raise KeyError(name or doc_id)
+        name, content_type, data = rows[0]
+        return name, content_type, bytes(data)
+
+    def delete_blob(self, collection, doc_id, rev, name):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute("SELECT rev, body FROM documents WHERE collection = ? AND id = ?",
+                    (collection, doc_id)).fetchall()
+                if len(rows) == 0:
+                    raise KeyError(doc_id)
+                if rows[0][0] != rev:
+                    raise Conflict(doc_id)
+                deleted = self._conn.execute("DELETE FROM blobs WHERE collection = ? AND id = ? AND name = ?",
+                    (collection, doc_id, name)).rowcount
+                if deleted == 0:
+                    raise KeyError(name)
+                new_rev = self._next_rev(rev, rows[0][1] + "-" + name)
+                self._conn.execute("UPDATE documents SET rev = ? WHERE collection = ? AND id = ?",
+                    (new_rev, collection, doc_id))
+                self._bump(collection, doc_id, new_rev)
+                self._conn.execute("COMMIT")
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+        return new_rev
+
+    def compact(self):
+        with self._lock:
+            # like CouchDB, the feed keeps the latest change of each document
+            self._conn.execute("DELETE FROM changes WHERE seq NOT IN (SELECT MAX(seq) FROM changes GROUP BY collection, id)")
+            if self.path != ":memory:":
+                self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._conn.execute("VACUUM")
+
+    def weekly_menus(self, year_week, source_name=None):
+        if source_name:
+            rows = self._execute("SELECT id, rev, body FROM documents WHERE collection = ? AND source_name = ? AND year_week = ? AND type = 'weekly_menu' ORDER BY id",
+                (MENUS, source_name, year_week))
+        else:
+            rows = self._execute("SELECT id, rev, body FROM documents WHERE collection = ? AND year_week = ? AND type = 'weekly_menu' ORDER BY id",
+                (MENUS, year_week))
+        return [ self._load(MENUS, doc_id, rev, body) for doc_id, rev, body in rows ]
+
+    def weekly_menu_ids(self):
+        rows = self._execute("SELECT id FROM documents WHERE collection = ? AND type = 'weekly_menu' ORDER BY year_week, id",
+            (MENUS,))
+        return [ row[0] for row in rows ]
+
+    def scrape_logs(self, first_year_week, last_year_week=None):
+        rows = self._execute("SELECT id, rev, body FROM documents WHERE collection = ? AND type = 'scrape_log' "
+            "AND year_week >= ? AND year_week <= ? ORDER BY year_week, id",
+            (SCRAPINGS, first_year_week, last_year_week if last_year_week is not None else "9999"))
+        return [ self._load(SCRAPINGS, doc_id, rev, body) for doc_id, rev, body in rows ]
+
+    def changes(self, collection, since=None, timeout=0):
+        if since == "now":
+            since = self._execute("SELECT MAX(seq) FROM changes WHERE collection = ?", (collection,))[0][0]
+        since = int(since) if since else 0
+        deadline = time.monotonic() + timeout
+        while True:
+            rows = self._execute("SELECT seq, id, rev, deleted FROM changes WHERE collection = ? AND seq > ? ORDER BY seq",
+                (collection, since))
+            if len(rows) > 0 or time.monotonic() >= deadline:
+                break
+            time.sleep(SqliteStorage.POLL_INTERVAL)
+        changes = [ {"seq": seq, "id": doc_id, "rev": rev, "deleted": bool(deleted)}
+            for seq, doc_id, rev, deleted in rows ]
+        last_seq = changes[-1]["seq"] if len(changes) > 0 else since
+        return last_seq, changes
+
+def open_storage(url=None):
+    """Open storage backend by URL: "couchdb" (default, configured via the
+    COUCHDB_* environment variables) or "sqlite:///path/to/file.db". The
+    URL defaults to the MITTAG_STORAGE environment variable."""
+    if not url:
+        url = os.getenv("MITTAG_STORAGE", "couchdb")
+    if url == "couchdb":
+        return CouchStorage()
+    if url.startswith("sqlite://"):
+        return SqliteStorage(url[len("sqlite://"):] or ":memory:")
+    raise ValueError("unknown storage {}".format(url))
+
+_shared_storage = None
+_shared_storage_lock = threading.Lock()
+
+def shared_storage():
+    """Get the process-wide storage backend, opened on first use"""
+    global _shared_storage
+    if _shared_storage is None:
+        with _shared_storage_lock:
+            if _shared_storage is None:
+                _shared_storage = open_storage()
+    return _shared_storage
@@ -21,8 +21,11 @@
 #
 
 import os
-from datetime import date, datetime
-from cloudant import CouchDB
+import threading
+from datetime import date, datetime, timedelta
+
+_couch_client = None
+_couch_client_lock = threading.Lock()
 
 def current_year():
     """Get current year (local timezone)"""
@@ -32,9 +35,34 @@ def current_week():
     """Get current week number (local timezone)"""
     return date.today().isocalendar()[1]
 
+def year_week(year, week):
+    """Format year+week identification, zero-padded so that it sorts
+    lexically, e.g. 2019-07"""
+    return "{:04d}-{:02d}".format(year, week)
+
+def normalize_year_week(value):
+    """Normalize year+week identification, including legacy ones padded
+    with spaces ("2019- 7")"""
+    year, week = value.split("-")
+    return year_week(int(year), int(week))
+
+def week_start(year_week):
+    """Get the date of monday of a year+week identification"""
+    return datetime.strptime(normalize_year_week(year_week) + "-1", "%G-%V-%u").date()
+
 def current_year_week():
     """Get current year+week identification"""
-    return "{:4d}-{:2d}".format(current_year(), current_week())
+    return year_week(current_year(), current_week())
+
+def recent_weeks(count):
+    """Get (year, week) of the current and the count - 1 preceding weeks,
+    most recent first"""
+    today = date.today()
+    return [ (today - timedelta(weeks=i)).isocalendar()[:2] for i in range(count) ]
+
+def menu_id(source_name, year_week):
+    """Get document id of a source's weekly menu, e.g. swsh-mensa/2019-07"""
+    return "{}/{}".format(source_name, year_week)
 
 def current_day():
     """Return current week day number, 0 = monday (local timezone)"""
@@ -44,26 +72,26 @@ def timestamp_rfc3339():
     """Generate RC3339 compliant UTC timestamp"""
     return datetime.utcnow().isoformat("T") + "Z"
 
-def couch_connect(user=None, auth=None, url=None):
+def couch_connect(user=None, auth=None, url=None, **kwargs):
+    """Open a new CouchDB session. Additional keyword arguments are passed
+    to the cloudant client."""
+    from cloudant import CouchDB
     if not user:
         user = os.getenv("COUCHDB_USER", "admin")
     if not auth:
         auth = os.getenv("COUCHDB_PASSWORD", "admin")
     if not url:
         url = os.getenv("COUCHDB_URL", "http://127.0.0.1:5984")
-    return CouchDB(user, auth, url=url, connect=True)
+    return CouchDB(user, auth, url=url, connect=True, **kwargs)
 
-def create_couch_views(db):
-    design_doc = {
-        "_id": "_design/views",
-        "views": {
-            "byYearWeek": {
-                "map": "function (doc) {\n  if (doc.type === \"weekly_menu\" && doc.menus.year_week)\n    emit(doc.menus.year_week, doc);\n}"
-            },
-            "bySourceNameYearWeek": {
-                "map": "function (doc) {\n  if (doc.type === \"weekly_menu\" && doc.source_name && doc.menus.year_week)\n    emit(doc.source_name+\"/\"+doc.menus.year_week, doc);\n}"
-            }
-        },
-        "language": "javascript"
-    }
-    db.create_document(design_doc)
\ No newline at end of file
+def couch_client(**kwargs):
+    """Get the process-wide CouchDB client (see mittagv2.db.CouchClient),
+    which connects on first use. Keyword arguments configure the client and
+    only take effect on the first call."""
+    global _couch_client
+    if _couch_client is None:
+        with _couch_client_lock:
+            if _couch_client is None:
+                from mittagv2.db import CouchClient
+                _couch_client = CouchClient(**kwargs)
+    return _couch_client
@@ -20,17 +20,48 @@
 # THE SOFTWARE.
 #
 
+import datetime
+import hmac
+import logging
 import os
-import re
+import threading
 import time
-from string import Template
 import argparse
-from html import escape
-import datetime
+import mittagv2.cache as cache
+import mittagv2.events as events
+import mittagv2.handlers as handlers
+import mittagv2.metrics as metrics
+import mittagv2.profiling as profiling
+import mittagv2.ratelimit as ratelimit
+import mittagv2.readmodels as readmodels
+import mittagv2.retention as retention
+import mittagv2.revisions as revisions
 import mittagv2.utils as utils
+import mittagv2.storage as storage
 import cherrypy
-from cloudant import CouchDB
 
+REQUEST_LATENCY = metrics.REGISTRY.histogram("mittag_http_request_duration_seconds",
+    "HTTP request latency by handler and status", ("handler", "status"))
+
+def http_call(function, *args):
+    """Call a shared handler (see mittagv2.handlers) with its errors as
+    CherryPy HTTP errors"""
+    try:
+        return function(*args)
+    except handlers.HTTPError as ex:
+        raise cherrypy.HTTPError(ex.status, ex.message)
+
+class RetryLater(cherrypy.HTTPError):
+    """HTTP error with a Retry-After header (in seconds), which plain
+    HTTPErrors drop from the response"""
+
+    def __init__(self, status, retry_after, message=None):
+        super().__init__(status, message)
+        self.retry_after = str(retry_after)
+
+    def set_response(self):
+        super().set_response()
+        cherrypy.serving.response.headers["Retry-After"] = self.retry_after
 
 def no_index():
     """Tool to disable slash redirect for indexes"""
@@ -43,198 +74,652 @@ def restrict_methods(methods):
         raise cherrypy.HTTPError(405)
 cherrypy.tools.restrict_methods = cherrypy.Tool('before_handler', restrict_methods)
 
-@cherrypy.popargs("menu_id")
-class Menus:
+def profile_handler():
+    """Tool for profiling a sampled fraction of requests (see
+    mittagv2.profiling.WEB)"""
+    handler = cherrypy.request.handler
+    if handler is None or profiling.WEB.fraction <= 0:
+        return
+    def profiled(*args, **kwargs):
+        with profiling.WEB.profile():
+            return handler(*args, **kwargs)
+    cherrypy.request.handler = profiled
+cherrypy.tools.profile = cherrypy.Tool('before_handler', profile_handler)
+
+def admin_token():
+    """Tool for restricting access to holders of the admin token
+    (MITTAG_ADMIN_TOKEN environment variable, sent as X-Admin-Token). Without
+    a configured token, the resources do not exist."""
+    token = os.getenv("MITTAG_ADMIN_TOKEN")
+    if not token:
+        raise cherrypy.HTTPError(404)
+    if not hmac.compare_digest(cherrypy.request.headers.get("X-Admin-Token", ""), token):
+        raise cherrypy.HTTPError(403)
+cherrypy.tools.admin_token = cherrypy.Tool('on_start_resource', admin_token)
+
+def handler_name():
+    """Name of the handler of the current request, for metrics and limits"""
+    request = cherrypy.request
+    handler = getattr(request.handler, "callable", None)
+    if handler is not None:
+        return getattr(handler, "__qualname__", str(handler))
+    return "static" if request.handler is None else "other"
+
+class RequestMetricsTool(cherrypy.Tool):
+    """Tool for recording request latency per handler"""
+
+    def __init__(self):
+        super().__init__('on_start_resource', self._start, priority=10)
+
+    def _setup(self):
+        super()._setup()
+        cherrypy.request.hooks.attach('on_end_request', self._end, priority=90)
+
+    def _start(self):
+        # runs right after dispatch, before other tools wrap the handler
+        request = cherrypy.request
+        request.metrics_handler = handler_name()
+        request.metrics_start = time.perf_counter()
+
+    def _end(self):
+        request = cherrypy.request
+        if not hasattr(request, "metrics_start"):
+            return
+        status = str(cherrypy.response.status).split(" ")[0]
+        REQUEST_LATENCY.observe(time.perf_counter() - request.metrics_start,
+            handler=request.metrics_handler, status=status)
+cherrypy.tools.request_metrics = RequestMetricsTool()
+
+class RateLimitTool(cherrypy.Tool):
+    """Tool for shedding load with token buckets per client and endpoint and
+    a concurrency limit for heavy endpoints (see mittagv2.ratelimit).
+    Handlers declare what they cost with tools.rate_limit.cost and
+    tools.rate_limit.heavy."""
+
     def __init__(self):
-        self._db = utils.couch_connect()
+        super().__init__('on_start_resource', self._admit, priority=20)
+        self.admission = ratelimit.Admission()
+
+    def _admit(self, cost=1, heavy=False):
+        request = cherrypy.request
+        shed = self.admission.admit(request.remote.ip, handler_name(), cost, heavy)
+        if shed is not None:
+            reason, wait = shed
+            raise RetryLater(429, ratelimit.retry_after(wait), "too many requests ({} limit)".format(reason))
+        if heavy:
+            request.hooks.attach('on_end_request', self.admission.release)
+cherrypy.tools.rate_limit = RateLimitTool()
+
+@cherrypy.popargs("menu_id", "year_week")
+class Menus:
+    def __init__(self, backend=None):
+        self._backend = backend
+
+    @property
+    def _storage(self):
+        return self._backend if self._backend else storage.shared_storage()
     
     @cherrypy.expose()
     @cherrypy.tools.json_out()
     @cherrypy.tools.restrict_methods(methods = ["GET", "HEAD"])
-    def index(self, menu_id=None):
+    def index(self, menu_id=None, year_week=None):
         if menu_id is None:
-            menus = self._db["mv2_menus"].get_view_result("_design/views", "byYearWeek").all()
-            return [ m["id"] for m in menus ]
-        else:
+            return self._storage.weekly_menu_ids()
+        elif year_week is None:
             return self._single(menu_id)
+        else:
+            # ids look like swsh-mensa/2019-07 and span two path segments
+            return self._single(utils.menu_id(menu_id, year_week))
 
     def _single(self, menu_id):
         try:
-            menus = self._db["mv2_menus"][menu_id]
-            del menus["_id"]
-            del menus["_rev"]
-            return menus
+            return handlers.public(self._storage.get(storage.MENUS, menu_id))
+        except KeyError:
+            raise cherrypy.HTTPError(404)
+
+    @cherrypy.expose("_batch")
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.rate_limit(cost=5)
+    @cherrypy.tools.restrict_methods(methods = ["POST"])
+    def batch(self):
+        """Several weekly menus at once (POST /api/v1/menus/_batch), by id
+        or [source_name, year_week], see handlers.parse_batch"""
+        return self.get_batch(cherrypy.request.json)
+
+    def get_batch(self, request):
+        doc_ids, fields = http_call(handlers.parse_batch, request, True)
+        return handlers.batch_rows(doc_ids, self._storage.get_many(storage.MENUS, doc_ids), fields)
+
+    @cherrypy.expose()
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.rate_limit(cost=2)
+    @cherrypy.tools.restrict_methods(methods = ["GET", "HEAD"])
+    def changes(self, menu_id=None, year_week=None, since=None):
+        """What changed in a weekly menu after revision "since" (default:
+        all revisions), see mittagv2.revisions"""
+        since = http_call(handlers.parse_revision, since)
+        try:
+            return revisions.MenuRevisions(self._storage).changes(utils.menu_id(menu_id, year_week), since)
+        except KeyError:
+            raise cherrypy.HTTPError(404)
+
+    @cherrypy.expose()
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.rate_limit(cost=2)
+    @cherrypy.tools.restrict_methods(methods = ["GET", "HEAD"])
+    def revision(self, number=None, menu_id=None, year_week=None):
+        """A weekly menu as of an earlier revision"""
+        number = http_call(handlers.parse_revision, number)
+        try:
+            return handlers.public(revisions.MenuRevisions(self._storage).revision(
+                utils.menu_id(menu_id, year_week), number))
         except KeyError:
             raise cherrypy.HTTPError(404)
 
 @cherrypy.popargs("scraping")
 class Scrapings:
-    def __init__(self):
-        self._db = utils.couch_connect()
+    def __init__(self, backend=None, archive=None):
+        self._backend = backend
+        self._archive = archive if archive else retention.open_archive()
+
+    @property
+    def _storage(self):
+        return self._backend if self._backend else storage.shared_storage()
 
     @cherrypy.expose()
     @cherrypy.tools.json_out()
+    @cherrypy.tools.rate_limit(cost=10, heavy=True)
     @cherrypy.tools.restrict_methods(methods = ["GET", "HEAD"])
     def index(self, scraping=None):
         if scraping is None:
-            scrapings = self._db["mv2_scrapings"]
-            return [ m["_id"] for m in scrapings ]
+            return self._storage.ids(storage.SCRAPINGS)
         else:
             return self._single(scraping)
 
     def _single(self, scraping):
         try:
-            scraped = self._db["mv2_scrapings"][scraping]
-            del scraped["_id"]
-            del scraped["_rev"]
-            return scraped
+            return handlers.public(self._storage.get(storage.SCRAPINGS, scraping))
         except KeyError:
             raise cherrypy.HTTPError(404)
         except:
             raise cherrypy.HTTPError(500)
 
+    @cherrypy.expose("_batch")
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.rate_limit(cost=5)
+    @cherrypy.tools.restrict_methods(methods = ["POST"])
+    def batch(self):
+        """Several scrape logs at once (POST /api/v1/scrapings/_batch), see
+        handlers.parse_batch"""
+        return self.get_batch(cherrypy.request.json)
+
+    def get_batch(self, request):
+        doc_ids, fields = http_call(handlers.parse_batch, request)
+        return handlers.batch_rows(doc_ids, self._storage.get_many(storage.SCRAPINGS, doc_ids), fields)
+
     @cherrypy.expose
+    @cherrypy.tools.rate_limit(cost=10, heavy=True)
     @cherrypy.tools.restrict_methods(methods = ["GET", "HEAD"])
     def attachment(self, scraping=None):
         try:
-            scraped = self._db["mv2_scrapings"][scraping]
-            attachment_name = list(scraped["_attachments"].keys())[0]
-            attachment_meta = scraped["_attachments"][attachment_name]
-            cherrypy.response.headers["Content-Type"] = attachment_meta["content_type"]
+            try:
+                attachment_name, content_type, data = self._storage.get_blob(storage.SCRAPINGS, scraping)
+            except KeyError:
+                attachment_name, content_type, data = self._archived(scraping)
+            cherrypy.response.headers["Content-Type"] = content_type
             cherrypy.response.headers["Content-Disposition"] = "attachment; filename=\"{}\"".format(attachment_name)
-            return scraped.get_attachment(attachment_name)
+            return data
         except KeyError:
             raise cherrypy.HTTPError(404)
         except:
             raise cherrypy.HTTPError(500)
 
+    def _archived(self, scraping):
+        """Get raw data moved to the archive (see mittagv2.retention)"""
+        if self._archive is None:
+            raise KeyError(scraping)
+        attachment_name, location = retention.archived_blob(self._storage.get(storage.SCRAPINGS, scraping))
+        return attachment_name, location["content_type"], self._archive.load(location)
+
+@cherrypy.popargs("year_week")
+class Bundle:
+    """Compact JSON bundle with a week's menus of all sources, which the
+    page renders on the client. Bundles are versioned by a hash of their
+    content: the ETag is the version, and requests that name the current
+    version (?v=...) may be cached forever."""
+
+    CACHE_TTL = 60 #: Time in seconds bundles are cached
+
+    def __init__(self, backend=None):
+        self._backend = backend
+        self._cache = cache.SharedCache("week_bundles", Bundle.CACHE_TTL,
+            encode=Bundle._encode, decode=Bundle._decode)
+
+    @property
+    def _storage(self):
+        return self._backend if self._backend else storage.shared_storage()
+
+    @cherrypy.expose()
+    @cherrypy.tools.restrict_methods(methods = ["GET", "HEAD"])
+    def index(self, year_week=None, v=None):
+        version, body = self.get(http_call(handlers.parse_year_week, year_week))
+        for name, value in handlers.bundle_headers(version, v).items():
+            cherrypy.response.headers[name] = value
+        cherrypy.lib.cptools.validate_etags()
+        return body
+
+    def get(self, year_week):
+        """Get version and serialized bundle of a week"""
+        depends = [ cache.dependency(storage.MENUS, i) for i in handlers.week_menu_ids(year_week) ]
+        depends.append(cache.dependency(storage.READ_MODELS, readmodels.week_id(year_week)))
+        return self._cache.get(year_week, lambda: self._build(year_week), depends)
+
+    @staticmethod
+    def _encode(bundle):
+        version, body = bundle
+        return version.encode("utf-8") + b"\n" + body
+
+    @staticmethod
+    def _decode(data):
+        version, body = data.split(b"\n", 1)
+        return version.decode("utf-8"), body
+
+    def _build(self, year_week):
+        week = readmodels.ReadModels(self._storage).week(year_week)
+        if week is not None:
+            return handlers.week_bundle(week)
+        return handlers.build_bundle(year_week,
+            self._storage.get_many(storage.MENUS, handlers.week_menu_ids(year_week)))
+
+class Events:
+    """Server-Sent Events stream of menu updates and scrape results (see
+    mittagv2.events). Every client holds a server thread, so the number of
+    clients is limited, and connections are closed after a while to be
+    resumed by the client with Last-Event-ID."""
+
+    MAX_CLIENTS = 40 #: Maximum number of connected clients
+    MAX_DURATION = 300 #: Time in seconds after which a connection is closed
+    RETRY = 5000 #: Reconnection delay for clients in milliseconds
+
+    def __init__(self, backend=None):
+        self._backend = backend
+        self._hub = None
+        self._hub_lock = threading.Lock()
+        self._clients = threading.BoundedSemaphore(Events.MAX_CLIENTS)
+
+    @property
+    def hub(self):
+        if self._hub is None:
+            with self._hub_lock:
+                if self._hub is None:
+                    self._hub = events.EventHub(
+                        self._backend if self._backend else storage.shared_storage())
+        return self._hub
+
+    @cherrypy.expose()
+    @cherrypy.tools.restrict_methods(methods = ["GET"])
+    def index(self):
+        if not self._clients.acquire(blocking=False):
+            raise RetryLater(503, Events.RETRY // 1000, "too many event stream clients")
+        try:
+            subscription = self.hub.subscribe(cherrypy.request.headers.get("Last-Event-ID"),
+                duration=Events.MAX_DURATION)
+        except:
+            self._clients.release()
+            raise
+        headers = cherrypy.response.headers
+        headers["Content-Type"] = "text/event-stream"
+        headers["Cache-Control"] = "no-cache"
+        headers["X-Accel-Buffering"] = "no"
+
+        def stream():
+            try:
+                yield "retry: {}\n\n".format(Events.RETRY).encode("utf-8")
+                for event in subscription:
+                    yield event.encode() if event is not None else b": keepalive\n\n"
+            finally:
+                subscription.close()
+                self._clients.release()
+        return stream()
+    index._cp_config = {"response.stream": True}
+
+class Recommend:
+    """Lunch recommendations for preference profiles (see
+    mittagv2.recommend). POST a JSON object with a list of "profiles" and
+    optionally "year_week", "day" and "limit"; GET takes a single profile
+    as query parameters, with comma separated likes and dislikes and
+    repeated history parameters."""
+
+    MAX_PROFILES = 1000 #: Maximum number of profiles per request
+    MAX_LIMIT = 20 #: Maximum number of menus recommended per profile
+
+    def __init__(self, backend=None):
+        self._backend = backend
+        self._recommender = None
+        self._lock = threading.Lock()
+
+    @property
+    def _storage(self):
+        return self._backend if self._backend else storage.shared_storage()
+
+    @cherrypy.expose()
+    @cherrypy.tools.json_in(force=False)
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.rate_limit(cost=5, heavy=True)
+    @cherrypy.tools.restrict_methods(methods = ["GET", "HEAD", "POST"])
+    def index(self, **params):
+        if cherrypy.request.method == "POST":
+            return self.recommend(getattr(cherrypy.request, "json", None))
+        request = { k: params.pop(k) for k in ("year_week", "day", "limit") if k in params }
+        # repeated parameters come as lists
+        for name in ("likes", "dislikes", "history", "vegetarian"):
+            if name in params and not isinstance(params[name], list):
+                params[name] = [params[name]]
+        for name in ("likes", "dislikes"):
+            if name in params:
+                params[name] = [ k.strip() for value in params[name] for k in value.split(",") if k.strip() ]
+        if "vegetarian" in params:
+            params["vegetarian"] = params["vegetarian"][-1].lower() in ("1", "true", "yes")
+        request["profiles"] = [params]
+        return self.recommend(request)
+
+    def recommend(self, request):
+        """Answer a recommendation request (see class docs)"""
+        if not isinstance(request, dict) or not isinstance(request.get("profiles"), list):
+            raise cherrypy.HTTPError(400, "expected an object with a list of profiles")
+        if len(request["profiles"]) > Recommend.MAX_PROFILES:
+            raise cherrypy.HTTPError(400, "too many profiles")
+        if not isinstance(request.get("year_week", ""), str):
+            raise cherrypy.HTTPError(400, "illegal year_week")
+        year_week = http_call(handlers.parse_year_week, request.get("year_week"))
+        day_number = http_call(handlers.parse_day, request.get("day"))
+        from mittagv2.recommend import Profile
+        try:
+            profiles = [ Profile.from_dict(p) for p in request["profiles"] ]
+        except ValueError as ex:
+            raise cherrypy.HTTPError(400, str(ex))
+        try:
+            limit = max(1, min(int(request.get("limit", 3)), Recommend.MAX_LIMIT))
+        except (TypeError, ValueError):
+            raise cherrypy.HTTPError(400, "illegal limit")
+        return {
+            "year_week": year_week,
+            "day": day_number,
+            "recommendations": self._get_recommender().recommend(year_week, day_number, profiles, limit),
+        }
+
+    def _get_recommender(self):
+        if self._recommender is None:
+            with self._lock:
+                if self._recommender is None:
+                    from mittagv2.recommend import Recommender
+                    self._recommender = Recommender(self._storage)
+        return self._recommender
+
+@cherrypy.popargs("dish_id")
+class Dishes:
+    """Dishes recognized across sources and weeks, with clusters of
+    similarly named ones (see mittagv2.dishes)"""
+
+    MAX_LIMIT = 100 #: Maximum number of results per request
+    RETRY_AFTER = 10 #: Time in seconds clients wait while the index is built
+
+    def __init__(self, backend=None):
+        self._backend = backend
+        self._dish_index = None
+        self._lock = threading.Lock()
+
+    @property
+    def _storage(self):
+        return self._backend if self._backend else storage.shared_storage()
+
+    def start(self):
+        """Build the dish index in the background and keep it following the
+        stored menus"""
+        with self._lock:
+            if self._dish_index is None:
+                from mittagv2.dishes import MenuDishIndex
+                self._dish_index = MenuDishIndex(self._storage)
+        self._dish_index.start()
+        return self._dish_index
+
+    def _index(self):
+        index = self.start()
+        if not index.ready.is_set():
+            raise RetryLater(503, Dishes.RETRY_AFTER, "dish index is being built")
+        return index
+
+    def _limit(self, limit):
+        try:
+            return max(1, min(int(limit), Dishes.MAX_LIMIT))
+        except (TypeError, ValueError):
+            raise cherrypy.HTTPError(400, "illegal limit")
+
+    @cherrypy.expose()
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.rate_limit(cost=5, heavy=True)
+    @cherrypy.tools.restrict_methods(methods = ["GET", "HEAD"])
+    def index(self, dish_id=None, limit=100):
+        index = self._index()
+        if dish_id is None:
+            return [ dict(members[0].to_dict(), dishes=[ d.id for d in members ])
+                for members in index.clusters()[:self._limit(limit)] ]
+        try:
+            dish = index.dishes[dish_id]
+        except KeyError:
+            raise cherrypy.HTTPError(404)
+        return dict(dish.to_dict(), served_at=[ {"source_name": s, "year_week": w, "day": d}
+            for s, w, d in dish.served() ], cluster=[ d.id for d in index.cluster(dish_id) ])
+
+    @cherrypy.expose()
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.rate_limit(cost=5, heavy=True)
+    @cherrypy.tools.restrict_methods(methods = ["GET", "HEAD"])
+    def similar(self, dish_id=None, limit=10):
+        index = self._index()
+        try:
+            similar = index.similar(dish_id, self._limit(limit))
+            canonical = index.cluster(dish_id)[0]
+        except KeyError:
+            raise cherrypy.HTTPError(404)
+        return {
+            "dish": index.dishes[dish_id].to_dict(),
+            "canonical": canonical.to_dict(),
+            "similar": [ dict(dish.to_dict(), similarity=value) for dish, value in similar ],
+        }
+
 class V1:
-    def __init__(self):
-        self.menus = Menus()
-        self.scrapings = Scrapings()
+    def __init__(self, backend=None):
+        self.menus = Menus(backend)
+        self.scrapings = Scrapings(backend)
+        self.bundle = Bundle(backend)
+        self.events = Events(backend)
+        self.recommend = Recommend(backend)
+        self.dishes = Dishes(backend)
 
 class Api:
+    def __init__(self, backend=None):
+        self.v1 = V1(backend)
+
+class Profiles:
+    """Runtime control of the profilers of this process (see
+    mittagv2.profiling). The scraper runs in its own process and is
+    controlled with signals instead."""
+
+    def _profiler(self, name):
+        try:
+            return profiling.get(name)
+        except KeyError:
+            raise cherrypy.HTTPError(404, "unknown profiler")
+
+    @cherrypy.expose()
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.restrict_methods(methods = ["GET", "HEAD", "POST"])
+    def index(self, name=None, fraction=None, reset=None):
+        """Get status of all profilers; POST sets the sampled fraction of a
+        profiler or resets its stats"""
+        if cherrypy.request.method == "POST":
+            profiler = self._profiler(name)
+            try:
+                if fraction is not None:
+                    profiler.configure(float(fraction))
+            except (TypeError, ValueError) as ex:
+                raise cherrypy.HTTPError(400, str(ex))
+            if reset:
+                profiler.reset()
+        return [ p.status() for p in profiling.PROFILERS.values() ]
+
+    @cherrypy.expose()
+    @cherrypy.tools.restrict_methods(methods = ["GET", "HEAD"])
+    def pstats(self, name="web"):
+        data = self._profiler(name).pstats_data()
+        cherrypy.response.headers["Content-Type"] = "application/octet-stream"
+        cherrypy.response.headers["Content-Disposition"] = "attachment; filename=\"{}.pstats\"".format(name)
+        return data
+
+    @cherrypy.expose()
+    @cherrypy.tools.restrict_methods(methods = ["GET", "HEAD"])
+    def collapsed(self, name="web"):
+        cherrypy.response.headers["Content-Type"] = "text/plain; charset=UTF-8"
+        return self._profiler(name).collapsed()
+
+    @cherrypy.expose()
+    @cherrypy.tools.restrict_methods(methods = ["GET", "HEAD"])
+    def report(self, name="web", sort="cumulative"):
+        cherrypy.response.headers["Content-Type"] = "text/plain; charset=UTF-8"
+        return self._profiler(name).report(sort)
+
+class Admin:
+    _cp_config = {"tools.admin_token.on": True}
+
     def __init__(self):
-        self.v1 = V1()
+        self.profile = Profiles()
 
 class Root:
-    def __init__(self):
-        self._view_template = Template(open("mittagv2/resources/dynamic_template.html").read())
-        self._db = utils.couch_connect()
-        self.api = Api()
+    MENUS_CACHE_TTL = 60 #: Time in seconds current menus are cached
+    PAGES_CACHE_TTL = 600 #: Time in seconds pages rendered from day read models are kept
+
+    def __init__(self, backend=None):
+        self._renderer = handlers.PageRenderer()
+        self._backend = backend
+        self._menus_cache = cache.SharedCache("weekly_menus", Root.MENUS_CACHE_TTL)
+        self._days_cache = cache.SharedCache("day_read_models", Root.MENUS_CACHE_TTL)
+        self._pages = cache.TTLCache("day_pages", Root.PAGES_CACHE_TTL, max_entries=32)
+        self._scrape_metrics = None
+        self.api = Api(backend)
+        self.admin = Admin()
+
+    @property
+    def _storage(self):
+        return self._backend if self._backend else storage.shared_storage()
 
     @cherrypy.expose()
     @cherrypy.tools.no_index()
+    @cherrypy.tools.rate_limit()
     @cherrypy.tools.restrict_methods(methods = ["GET", "HEAD"])
     def index(self, day=None):
         cherrypy.response.headers["Content-Type"] = "text/html; charset=UTF-8"
         try:
-            return self._get_all(day)
-        except cherrypy.HTTPError as ex:
+            etag, page = self._get_page(day)
+            if etag is not None:
+                cherrypy.response.headers["ETag"] = etag
+                cherrypy.lib.cptools.validate_etags()
+            return page
+        except (cherrypy.HTTPError, cherrypy.HTTPRedirect) as ex:
             raise ex
-        except Exception as ex:
-            print(ex)
+        except Exception:
+            cherrypy.log("rendering menus failed", severity=logging.ERROR, traceback=True)
             raise cherrypy.HTTPError(500)
 
+    def start(self):
+        """Start following scrape logs for the metrics and stored menus for
+        the dish index"""
+        if self._scrape_metrics is None:
+            self._scrape_metrics = metrics.ScrapeLogCollector(self._storage)
+        self.api.v1.dishes.start()
+
+    @cherrypy.expose()
+    @cherrypy.tools.restrict_methods(methods = ["GET", "HEAD"])
+    def metrics(self):
+        """Prometheus metrics"""
+        if self._scrape_metrics is None:
+            self._scrape_metrics = metrics.ScrapeLogCollector(self._storage)
+        self._scrape_metrics()
+        cherrypy.response.headers["Content-Type"] = metrics.Registry.CONTENT_TYPE
+        return metrics.REGISTRY.render()
+
     def _get_menus(self):
-        menus = self._db["mv2_menus"]
-        all_menus = menus.get_view_result("_design/views", "byYearWeek", key=utils.current_year_week(), limit=4).all()
-        marli_menu = None
-        mfc_menu = None
-        bistro_menu = None
-        mensa_menu = None
-        for m in all_menus:
-            v = m["value"]
-            if v["source_name"] == "marli-sb":
-                marli_menu = v["menus"]
-            if v["source_name"] == "uksh-cafeteria":
-                mfc_menu = v["menus"]
-            if v["source_name"] == "uksh-bistro":
-                bistro_menu = v["menus"]
-            if v["source_name"] == "swsh-mensa":
-                mensa_menu = v["menus"]
-        return bistro_menu, mfc_menu, marli_menu, mensa_menu
+        year_week = utils.current_year_week()
+        return self._menus_cache.get(year_week, lambda: self._load_menus(year_week),
+            [ cache.dependency(storage.MENUS, i) for i in handlers.week_menu_ids(year_week) ])
+
+    def _load_menus(self, year_week):
+        """Get weekly menus of all sources by source name"""
+        return handlers.menus_by_source(
+            self._storage.get_many(storage.MENUS, handlers.week_menu_ids(year_week)))
 
     def _get_all(self, day=None):
         """Get all current data"""
-        if day:
-            day_number = int(day)
-        else:
-            day_number = utils.current_day()
-        if day_number < 0 or day_number > 6:
-            raise cherrypy.HTTPError(400, "illegal day number")
-        bistro_menu, mfc_menu, marli_menu, mensa_menu = self._get_menus()
-        if bistro_menu and "days" in bistro_menu and day_number < len(bistro_menu["days"]):
-            bistro_html = self._day_to_html(bistro_menu["days"][day_number], bistro_menu)
-        else:
-            bistro_html = "<p>Keine Daten vorhanden!</p>"
-        if marli_menu and "days" in marli_menu and day_number < len(marli_menu["days"]):
-            marli_html = self._day_to_html(marli_menu["days"][day_number], marli_menu)
-        else:
-            marli_html = "<p>Keine Daten vorhanden!</p>"
-        if mfc_menu and "days" in mfc_menu and day_number < len(mfc_menu["days"]):
-            mfc_html = self._day_to_html(mfc_menu["days"][day_number], mfc_menu)
-        else:
-            mfc_html = "<p>Keine Daten vorhanden!</p>"
-        if mensa_menu and "days" in mensa_menu and day_number < len(mensa_menu["days"]):
-            mensa_html = self._day_to_html(mensa_menu["days"][day_number], mensa_menu)
-        else:
-            mensa_html = "<p>Keine Daten vorhanden!</p>"
-        calculated_day = datetime.datetime.now().date().day - utils.current_day() + day_number
-        day_names = {
-            0: "Montag",
-            1: "Dienstag",
-            2: "Mittwoch",
-            3: "Donnerstag",
-            4: "Freitag",
-            5: "Samstag",
-            6: "Sonntag"
+        return self._get_page(day)[1]
+
+    def _get_day(self, date):
+        """Get read model of a day, from the shared cache if there is one
+        (it is invalidated by the change feed, see mittagv2.cache)"""
+        read_models = readmodels.ReadModels(self._storage)
+        if self._days_cache.store is None:
+            return read_models.day(date)
+        doc_id = readmodels.day_id(date)
+        return self._days_cache.get(doc_id, lambda: read_models.day(date),
+            [cache.dependency(storage.READ_MODELS, doc_id)])
+
+    def _get_page(self, day=None):
+        """Get ETag (None without read model) and page of a day of the
+        current week. Pages are rendered from the day's read model (see
+        mittagv2.readmodels) and validated by its revision."""
+        day_number = http_call(handlers.parse_day, day)
+        date = datetime.date.today() + datetime.timedelta(days=day_number - utils.current_day())
+        document = self._get_day(date)
+        if document is None:
+            return None, self._renderer.render(self._get_menus(), day_number)
+        page = self._pages.get((document["_id"], document["_rev"]),
+            lambda: self._renderer.render_day(document["sources"], date))
+        return "\"{}-{}\"".format(document["_rev"], self._renderer.version), page
+
+def application_config(feeds_directory=None):
+    """Configuration of the web application, serving static files next to
+    the handlers and, if given, the static feeds"""
+    app_config = {
+        '/': {
+            'tools.staticdir.on': True,
+            'tools.staticdir.root': os.path.abspath(os.getcwd()) + "/mittagv2/resources/web_static/",
+            'tools.staticdir.dir': './',
+            'tools.staticdir.index': 'index.html',
+            'tools.request_metrics.on': True,
+            'tools.profile.on': True,
+        },
+        # static files do not count against the rate limits, only handlers
+        # declaring a cost and everything below these
+        '/api': {
+            'tools.rate_limit.on': True,
+        },
+        '/admin': {
+            'tools.rate_limit.on': True,
+        },
+    }
+    if feeds_directory:
+        # static feeds, written by the scraper (see mittagv2.feeds)
+        app_config['/feeds'] = {
+            'tools.staticdir.on': True,
+            'tools.staticdir.dir': os.path.abspath(feeds_directory),
+            'tools.staticdir.content_types': {
+                'json': 'application/feed+json; charset=utf-8',
+                'rss': 'application/rss+xml; charset=utf-8',
+                'ics': 'text/calendar; charset=utf-8',
+            },
         }
-        date_string = "{}, {}".format(day_names[day_number],
-            datetime.datetime.now().date().replace(day=calculated_day).isoformat())
-        with open("mittagv2/resources/dynamic_template.html") as template_file:
-            template = Template(template_file.read())
-            html = template.substitute(MFC_MENUS=mfc_html, MARLI_MENUS=marli_html,
-                MENSA_MENUS=mensa_html, BISTRO_MENUS=bistro_html,
-                DATE_STRING=date_string,
-                WEEK_NUMBER="{:02}".format(utils.current_week()))
-            return html
-
-    def _day_to_html(self, day, week):
-        html = ""
-        for menu in day["menus"]:
-            html += self._menu_to_html(menu)
-        if "notice" in week:
-            html += "<p>{}</p>".format(escape(week["notice"]).replace("\n", "<br>"))
-        return html
-    
-    def _menu_to_html(self, menu):
-        name = menu["name"]
-        if "menu_type" in menu and len(menu["menu_type"]) > 0:
-            name = "{}: {}".format(menu["menu_type"], menu["name"])
-        html = "<p><strong>{}</strong></p>".format(escape(name))
-        if "description" in menu:
-            html_description = escape(menu["description"]).replace("\n", "<br>")
-            html += "<p>{}</p>".format(html_description)
-        attributes = []
-        if "calories" in menu:
-            attributes.append("{:d} kcal".format(menu["calories"]))
-        if "vegetarian" in menu and menu["vegetarian"] == True:
-            attributes.append("vegetarisch")
-        if len(attributes) > 0:
-            html += """<p style="float: right; font-size: 90%; margin-top: 0;">"""
-            html += ", ".join(attributes)
-            html += "</p>"
-        html += """<p style="float: left; margin-top: 0;">"""
-        if "student_price" in menu and menu["student_price"]:
-            html += "{:.2f} € / ".format(menu["student_price"]).replace(".", ",")
-        if "reduced_price" in menu and menu["reduced_price"]:
-            html += "{:.2f} € / ".format(menu["reduced_price"]).replace(".", ",")
-        if "normal_price" in menu and menu["normal_price"]:
-            html += "{:.2f} €".format(menu["normal_price"]).replace(".", ",")
-        html += "</p>"
-        html += """<div style="clear: both;"></div>"""
-        return html
+    return app_config
 
 def start_web():
     """Start web server"""
@@ -244,20 +729,28 @@ def start_web():
 
     root = Root()
 
+    request_threads = 10
     global_config = {
         'server.socket_host': "0.0.0.0",
         'server.socket_port': 1234,
+        # event stream clients hold a thread each
+        'server.thread_pool': request_threads + Events.MAX_CLIENTS,
         'tools.proxy.on': True,
     }
 
-    app_config = {
-        '/': {
-            'tools.staticdir.on': True,
-            'tools.staticdir.root': os.path.abspath(os.getcwd()) + "/mittagv2/resources/web_static/",
-            'tools.staticdir.dir': './',
-            'tools.staticdir.index': 'index.html',
-        },
-    }
+    # one database connection per request thread, so handlers never queue
+    # behind each other on the client side
+    utils.couch_client(pool_size=request_threads)
+
+    # replicas share cached values, which the change feeds invalidate
+    if cache.shared_store() is not None:
+        cache.CacheInvalidator(storage.shared_storage(), cache.shared_store()).start()
+
+    # scrape logs are accounted from startup on, and the dish index covers
+    # the whole menu history, build it before requests ask for it
+    root.start()
+
+    app_config = application_config(os.getenv("MITTAG_FEEDS_DIR"))
     
     if args.debug == False:
         cherrypy.config.update(cherrypy.config.environments["production"])
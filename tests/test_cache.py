@@ -0,0 +1,139 @@
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+import mittagv2.cache as cache
+import mittagv2.storage as storage
+
+class RespHandler(socketserver.StreamRequestHandler):
+    """Minimal stand-in for a Redis server"""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+            self.wfile.write(self.server.command([args[0].decode().upper()] + args[1:]))
+
+class RespServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), RespHandler)
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def _get(self, key):
+        value, expiry = self.data.get(key, (None, 0))
+        return value if expiry > time.time() else None
+
+    def _bulk(self, value):
+        return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def command(self, args):
+        with self.lock:
+            if args[0] == "GET":
+                return self._bulk(self._get(args[1]))
+            if args[0] == "MGET":
+                return b"*%d\r\n" % (len(args) - 1) + b"".join(self._bulk(self._get(k)) for k in args[1:])
+            if args[0] == "SET":
+                if b"NX" in args[3:] and self._get(args[1]) is not None:
+                    return b"$-1\r\n"
+                self.data[args[1]] = (args[2], time.time() + int(args[args.index(b"EX") + 1]))
+                return b"+OK\r\n"
+            if args[0] == "DEL":
+                return b":%d\r\n" % (1 if self.data.pop(args[1], None) else 0)
+            return b"-ERR unknown command\r\n"
+
+class TestStores(unittest.TestCase):
+
+    def check_store(self, store):
+        self.assertEqual(store.get_many(["a", "b"]), [None, None])
+        store.set("a", b"\x00value\r\n", 60)
+        self.assertEqual(store.get("a"), b"\x00value\r\n")
+        self.assertTrue(store.add("lock", b"1", 60))
+        self.assertFalse(store.add("lock", b"1", 60))
+        store.delete("lock")
+        self.assertTrue(store.add("lock", b"1", 60))
+        self.assertEqual(store.get_many(["a", "c"]), [b"\x00value\r\n", None])
+
+    def test_redis(self):
+        server = RespServer()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            self.check_store(cache.open_shared_store("redis://127.0.0.1:{}".format(server.server_address[1])))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_disk(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = cache.open_shared_store("file://" + directory)
+            self.check_store(store)
+            store.set("b", b"x", -1)
+            self.assertIsNone(store.get("b"))
+            self.assertTrue(store.add("b", b"y", 60))
+            store.set("c", b"x", -1)
+            store.purge()
+            self.assertEqual(store.get_many(["a", "b", "c"]), [b"\x00value\r\n", b"y", None])
+
+class TestSharedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = cache.DiskStore(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_replicas(self):
+        backend = storage.SqliteStorage(":memory:")
+        doc = {"_id": "marli-sb/2019-50", "n": 1}
+        backend.put(storage.MENUS, doc)
+        invalidator = cache.CacheInvalidator(backend, self.store)
+        since = invalidator.poll(storage.MENUS, None)
+        depends = [cache.dependency(storage.MENUS, doc["_id"])]
+        replicas = [ cache.SharedCache("test_replicas", 60, self.store) for _ in range(2) ]
+        load = lambda: backend.get(storage.MENUS, doc["_id"])["n"]
+        self.assertEqual(replicas[0].get("2019-50", load, depends), 1)
+        self.assertEqual(replicas[1].get("2019-50", lambda: 1 / 0, depends), 1)
+        doc["n"] = 2
+        backend.put(storage.MENUS, doc)
+        invalidator.poll(storage.MENUS, since)
+        for replica in replicas:
+            replica._versions._local.clear()
+        self.assertEqual(replicas[1].get("2019-50", load, depends), 2)
+        self.assertEqual(replicas[0].get("2019-50", lambda: 1 / 0, depends), 2)
+
+    def test_coalescing(self):
+        shared = cache.SharedCache("test_coalescing", 60, self.store)
+        calls = []
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return {"value": 1}
+        results = []
+        threads = [ threading.Thread(target=lambda: results.append(shared.get("key", compute)))
+            for _ in range(8) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual((len(calls), results), (1, [{"value": 1}] * 8))
+        # another process is computing the value
+        self.store.add("lock:test_coalescing:other@", b"1", 60)
+        threading.Timer(0.1, lambda: self.store.set("test_coalescing:other@", b"2", 60)).start()
+        self.assertEqual(shared.get("other", lambda: 1 / 0), 2)
+
+    def test_unavailable(self):
+        with socketserver.TCPServer(("127.0.0.1", 0), None) as server:
+            port = server.server_address[1]
+        shared = cache.SharedCache("test_unavailable", 60, cache.RedisStore(port=port, timeout=0.5))
+        self.assertEqual(shared.get("key", lambda: 1, ["menus:x"]), 1)
+        self.assertIsNone(cache.SharedCache("test_local", 60, None).store)
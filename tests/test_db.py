@@ -0,0 +1,52 @@
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import requests
+import mittagv2.db as db
+
+class SlowHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        time.sleep(0.2)
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class TestPoolAdapter(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingServer(("127.0.0.1", 0), SlowHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{}/".format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_bounded_pool_waits(self):
+        adapter = db.PoolAdapter(1)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        threads = [ threading.Thread(target=session.get, args=(self.url,)) for _ in range(3) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats = adapter.stats.snapshot()
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(stats["in_use"], 0)
+        self.assertEqual(stats["wait_count"], 2)
+        self.assertGreater(stats["max_wait_seconds"], 0.3)
+
+    def test_encode_params(self):
+        params = db._encode_params({"key": "marli-sb/2019-50", "limit": 4, "include_docs": True})
+        self.assertEqual(params, {"key": "\"marli-sb/2019-50\"", "limit": 4, "include_docs": "true"})
@@ -0,0 +1,67 @@
+import time
+import unittest
+import cherrypy
+import mittagv2.dishes as dishes
+import mittagv2.storage as storage
+import mittagv2.utils as utils
+import mittagv2.web as web
+
+def weekly(source_name, year_week, *names):
+    return {"_id": utils.menu_id(source_name, year_week), "type": "weekly_menu", "source_name": source_name,
+        "menus": {"year_week": year_week, "days": [ {"day": i, "menus": [{"menu_type": "", "name": name}]}
+            for i, name in enumerate(names) ]}}
+
+class TestDishes(unittest.TestCase):
+
+    def test_similarity(self):
+        schnitzel = dishes.signature(dishes.shingles("Schnitzel vom Schwein"))
+        self.assertGreater(dishes.similarity(schnitzel, dishes.signature(dishes.shingles("Schweineschnitzel"))), 0.6)
+        self.assertLess(dishes.similarity(schnitzel, dishes.signature(dishes.shingles("Gemüsecurry"))), 0.2)
+        self.assertEqual(dishes.dish_id({"name": "Gemüse-Curry"}), dishes.dish_id({"name": "gemüse curry"}))
+
+    def test_index(self):
+        backend = storage.SqliteStorage(":memory:")
+        backend.put(storage.MENUS, weekly("marli-sb", "2019-49", "Schnitzel vom Schwein", "Gemüsecurry"))
+        backend.put(storage.MENUS, weekly("swsh-mensa", "2019-50", "Schweineschnitzel", "Fischfilet"))
+        index = dishes.MenuDishIndex(backend)
+        index.refresh()
+        schnitzel = dishes.dish_id({"name": "Schweineschnitzel"})
+        self.assertEqual([ d.name for d, _ in index.similar(schnitzel) ], ["Schnitzel vom Schwein"])
+        self.assertEqual(len(index.clusters()), 3)
+        backend.put(storage.MENUS, weekly("swsh-mensa", "2019-51", "Schweineschnitzel"))
+        index.refresh()
+        self.assertEqual(index.cluster(schnitzel)[0].name, "Schweineschnitzel")
+        self.assertEqual(index.dishes[schnitzel].to_dict()["last_served"]["year_week"], "2019-51")
+
+        handler = web.Dishes(backend)
+        self.assertTrue(handler.start().ready.wait(5))
+        similar = handler.similar(schnitzel)
+        self.assertEqual(similar["canonical"]["id"], schnitzel)
+        self.assertEqual(similar["similar"][0]["name"], "Schnitzel vom Schwein")
+        self.assertEqual(handler.index(schnitzel)["served"], 2)
+        self.assertEqual(handler.index()[0]["dishes"][0], schnitzel)
+        with self.assertRaises(cherrypy.HTTPError):
+            handler.similar("unknown")
+
+    def test_routes(self):
+        backend = storage.SqliteStorage(":memory:")
+        backend.put(storage.MENUS, weekly("marli-sb", "2019-49", "Schnitzel vom Schwein"))
+        backend.put(storage.MENUS, weekly("swsh-mensa", "2019-50", "Schweineschnitzel"))
+        root = web.Root(backend)
+        schnitzel = dishes.dish_id({"name": "Schweineschnitzel"})
+        request = cherrypy.serving.request
+        request.app = cherrypy.Application(root)
+        request.config = {}
+        request.params = {}
+        cherrypy.dispatch.Dispatcher()("/api/v1/dishes/{}/similar".format(schnitzel))
+        self.assertEqual(request.handler.kwargs, {"dish_id": schnitzel})
+        self.assertTrue(root.api.v1.dishes.start().ready.wait(5))
+        self.assertEqual(request.handler()["similar"][0]["name"], "Schnitzel vom Schwein")
+
+        backend.put(storage.MENUS, weekly("swsh-mensa", "2019-51", "Gemüsecurry"))
+        curry = dishes.dish_id({"name": "Gemüsecurry"})
+        for _ in range(50):
+            if curry in root.api.v1.dishes.start().dishes:
+                break
+            time.sleep(0.1)
+        self.assertIn(curry, root.api.v1.dishes.start().dishes)
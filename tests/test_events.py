@@ -0,0 +1,45 @@
+import unittest
+import mittagv2.events as events
+import mittagv2.storage as storage
+
+class TestEventHub(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = storage.SqliteStorage(":memory:")
+        self.hub = events.EventHub(self.backend)
+
+    def test_resume(self):
+        first = self.hub.publish("menu", {"id": "marli-sb/2019-50"})
+        second = self.hub.publish("menu", {"id": "swsh-mensa/2019-50"})
+        self.assertEqual([ e.id for e in self.hub.events_after(first.id) ], [second.id])
+        self.assertEqual(self.hub.events_after(second.id), [])
+        self.assertIsNone(self.hub.events_after("stale-1"))
+        self.assertIn(b"event: menu\ndata: {\"id\":\"swsh-mensa/2019-50\"}", second.encode())
+
+    def test_reset(self):
+        self.hub._started = True # no feed consumers
+        self.hub.publish("menu", {})
+        subscription = self.hub.subscribe("other-1", duration=0)
+        self.assertEqual(next(subscription).kind, "reset")
+        self.assertEqual(list(subscription), [])
+
+    def test_feed(self):
+        self.hub.start()
+        subscription = self.hub.subscribe()
+        self.backend.put(storage.MENUS, {"_id": "marli-sb/2019-50", "type": "weekly_menu"})
+        event = next(e for e in subscription if e is not None)
+        self.assertEqual(event.kind, "menu")
+        self.assertEqual(event.data["year_week"], "2019-50")
+        self.backend.put(storage.SCRAPINGS, {"type": "scrape_log", "source_name": "marli-sb",
+            "success": False})
+        event = next(e for e in subscription if e is not None)
+        self.assertEqual((event.kind, event.data["success"]), ("scrape", False))
+        subscription.close()
+
+    def test_scrape_once(self):
+        doc = {"type": "scrape_log", "source_name": "marli-sb", "success": True}
+        self.backend.put(storage.SCRAPINGS, doc)
+        change = {"id": doc["_id"], "rev": doc["_rev"], "deleted": False}
+        self.hub._scraping_changed(change)
+        self.hub._scraping_changed(change)
+        self.assertEqual([ e.kind for e in self.hub._events ], ["scrape"])
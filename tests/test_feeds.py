@@ -0,0 +1,48 @@
+import json
+import os
+import tempfile
+import unittest
+import mittagv2.feeds as feeds
+import mittagv2.storage as storage
+import mittagv2.utils as utils
+
+class TestFeeds(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = storage.SqliteStorage(":memory:")
+        self.directory = tempfile.TemporaryDirectory()
+        self.generator = feeds.FeedGenerator(self.backend, self.directory.name, "https://example.org")
+        self.year_week = utils.current_year_week()
+        self.backend.put(storage.MENUS, {"_id": utils.menu_id("marli-sb", self.year_week),
+            "type": "weekly_menu", "source_name": "marli-sb", "menus": {"year_week": self.year_week,
+            "days": [{"day": 0, "menus": [{"menu_type": "", "name": "Suppe, scharf", "normal_price": 2.5,
+            "vegetarian": True}]}, {"day": 1, "menus": []}]}})
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _read(self, path):
+        with open(os.path.join(self.directory.name, path), "rb") as fp:
+            return fp.read().decode("utf-8")
+
+    def test_update(self):
+        changed = self.generator.update(self.year_week)
+        self.assertIn(self.year_week + "/marli-sb.json", changed)
+        self.assertIn("all.ics", changed)
+        feed = json.loads(self._read(self.year_week + "/all.json"))
+        self.assertEqual(len(feed["items"]), 1)
+        self.assertEqual(feed["items"][0]["content_text"], "Suppe, scharf – 2,50 € – vegetarisch")
+        self.assertEqual(feed["feed_url"], "https://example.org/feeds/{}/all.json".format(self.year_week))
+        self.assertEqual(json.loads(self._read(self.year_week + "/swsh-mensa.json"))["items"], [])
+        ical = self._read("marli-sb.ics")
+        self.assertIn("DESCRIPTION:Suppe\\, scharf", ical)
+        self.assertEqual(ical.count("BEGIN:VEVENT"), 1)
+        self.assertIn("<guid isPermaLink=\"false\">marli-sb/{}/0</guid>".format(self.year_week),
+            self._read("marli-sb.rss"))
+        self.assertEqual(self.generator.update(self.year_week), [])
+
+    def test_fold(self):
+        line = "DESCRIPTION:" + "ä" * 80
+        folded = feeds._ical_fold(line)
+        self.assertTrue(all(len(part.encode("utf-8")) <= 75 for part in folded.split("\r\n")))
+        self.assertEqual(folded.replace("\r\n ", ""), line)
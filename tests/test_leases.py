@@ -0,0 +1,108 @@
+import threading
+import time
+import unittest
+from unittest import mock
+import mittagv2.leases as leases
+import mittagv2.model as model
+import mittagv2.scraper
+import mittagv2.storage as storage
+
+class TestLeases(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = storage.SqliteStorage(":memory:")
+        self.a = leases.LeaseManager(self.backend, owner="a")
+        self.b = leases.LeaseManager(self.backend, owner="b")
+
+    def test_exclusive(self):
+        with self.a.hold("source/marli-sb") as lease:
+            self.assertIsNotNone(lease)
+            with self.b.hold("source/marli-sb") as other:
+                self.assertIsNone(other)
+            lease.complete("2019-50")
+        document = self.b.acquire("source/marli-sb")
+        self.assertEqual(document["owner"], "b")
+        self.assertIsNotNone(leases.completed_at(document, "2019-50"))
+
+    def test_held_by_own_thread(self):
+        document = self.a.acquire("source/marli-sb")
+        self.assertIsNone(self.a.acquire("source/marli-sb"))
+        self.a.release(document)
+        again = self.a.acquire("source/marli-sb")
+        self.assertNotEqual(again["token"], document["token"])
+
+    def test_expiry(self):
+        short = leases.LeaseManager(self.backend, owner="a", ttl=0.05)
+        document = short.acquire("source/marli-sb")
+        self.assertIsNone(self.b.acquire("source/marli-sb"))
+        time.sleep(0.1)
+        self.assertIsNotNone(self.b.acquire("source/marli-sb"))
+        self.assertFalse(short.renew(document))
+
+    def test_heartbeat(self):
+        short = leases.LeaseManager(self.backend, owner="a", ttl=0.15)
+        with short.hold("source/marli-sb") as lease:
+            time.sleep(0.3)
+            self.assertIsNone(self.b.acquire("source/marli-sb"))
+            self.assertFalse(lease.lost)
+
+    def test_renew_failing(self):
+        short = leases.LeaseManager(self.backend, owner="a", ttl=0.15)
+        def renew(document):
+            raise IOError("storage unavailable")
+        with short.hold("source/marli-sb") as lease:
+            with mock.patch.object(short, "renew", renew):
+                time.sleep(0.1)
+                self.assertFalse(lease.lost) # still within the expiry
+                time.sleep(0.2)
+            self.assertTrue(lease.lost)
+            self.assertIsNotNone(self.b.acquire("source/marli-sb"))
+
+class TestScraperLeases(unittest.TestCase):
+
+    def test_scraped_once(self):
+        backend = storage.SqliteStorage(":memory:")
+        replicas = [ mittagv2.scraper.StorageScraper(backend, leases.LeaseManager(backend, owner=owner, ttl=0.3))
+            for owner in ("a", "b") ]
+        menu = model.WeeklyMenu(1, [model.DailyMenu(0, [])], None)
+        calls = []
+        def scrape():
+            calls.append(1)
+            time.sleep(0.2)
+            return menu, b"data"
+        threads = [ threading.Thread(target=r._scrape_single, args=(scrape, "marli-sb", "2019-50"))
+            for r in replicas ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(backend.weekly_menu_ids(), ["marli-sb/2019-50"])
+
+    def test_lost_lease(self):
+        backend = storage.SqliteStorage(":memory:")
+        replica = mittagv2.scraper.StorageScraper(backend, leases.LeaseManager(backend, owner="a", ttl=0.15))
+        def scrape():
+            # taken over by another replica while scraping
+            document = backend.get(storage.LEASES, "source/marli-sb")
+            document["owner"] = "b"
+            backend.put(storage.LEASES, document)
+            time.sleep(0.2)
+            return model.WeeklyMenu(1, [model.DailyMenu(0, [])], None), b"data"
+        self.assertIsNone(replica._scrape_single(scrape, "marli-sb", "2019-50", retries=1))
+        self.assertEqual(backend.weekly_menu_ids(), [])
+
+    def test_released_while_waiting(self):
+        backend = storage.SqliteStorage(":memory:")
+        replica = mittagv2.scraper.StorageScraper(backend, leases.LeaseManager(backend, owner="a"))
+        other = leases.LeaseManager(backend, owner="b")
+        waits = []
+        def scrape():
+            raise ValueError("not yet published")
+        def sleep(seconds):
+            document = other.acquire("source/marli-sb")
+            waits.append(document is not None)
+            other.release(document)
+        with mock.patch.object(mittagv2.scraper.time, "sleep", sleep):
+            self.assertFalse(replica._scrape_single(scrape, "marli-sb", "2019-50", retries=2))
+        self.assertEqual(waits, [True])
@@ -0,0 +1,75 @@
+import time
+import unittest
+import mittagv2.metrics as metrics
+import mittagv2.model as model
+import mittagv2.scraper
+import mittagv2.storage as storage
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_render(self):
+        registry = metrics.Registry()
+        histogram = registry.histogram("latency_seconds", "Latency", ("handler",), buckets=(0.1, 1))
+        histogram.observe(0.05, handler="index")
+        histogram.observe(0.1, handler="index")
+        histogram.observe(5, handler="index")
+        text = registry.render()
+        self.assertIn("# TYPE latency_seconds histogram", text)
+        self.assertIn('latency_seconds_bucket{handler="index",le="0.1"} 2', text)
+        self.assertIn('latency_seconds_bucket{handler="index",le="1"} 2', text)
+        self.assertIn('latency_seconds_bucket{handler="index",le="+Inf"} 3', text)
+        self.assertIn('latency_seconds_count{handler="index"} 3', text)
+
+    def test_counter_labels(self):
+        registry = metrics.Registry()
+        counter = registry.counter("requests", "Requests", ("result",))
+        counter.inc(result="hit")
+        counter.inc(2, result="hit")
+        self.assertEqual(counter.value(result="hit"), 3)
+        self.assertIn('requests_total{result="hit"} 3', registry.render())
+        with self.assertRaises(ValueError):
+            counter.inc(other="x")
+
+    def test_timings(self):
+        with metrics.stage("ignored"):
+            pass
+        with metrics.timed() as timings:
+            with metrics.stage("parse"):
+                pass
+            metrics.record("fetch_bytes", 10)
+            metrics.record("fetch_bytes", 5)
+        self.assertIn("parse", timings.values)
+        self.assertEqual(timings.values["fetch_bytes"], 15)
+
+class TestScrapeMetrics(unittest.TestCase):
+
+    def test_scrape_log_timings(self):
+        backend = storage.SqliteStorage(":memory:")
+        scraper = mittagv2.scraper.StorageScraper(backend)
+        registry = metrics.Registry()
+        # older scrapes are not replayed
+        scraper._scrape_log("marli-sb", "2019-50", False, blob=b"x", timings={"fetch": 0.1})
+        collector = metrics.ScrapeLogCollector(backend, registry)
+        menu = model.WeeklyMenu(1, [model.DailyMenu(0, [])], None)
+        def scrape():
+            with metrics.stage("parse"):
+                metrics.record("fetch_bytes", 7)
+            return menu, b"data"
+        scraper._scrape_single(scrape, "marli-sb")
+        scraper._scrape_log("marli-sb", "2019-51", False, blob=b"y", timings={"fetch": 0.1})
+        log = backend.get(storage.SCRAPINGS, backend.get(storage.MENUS,
+            backend.weekly_menu_ids()[0])["scrape_id"])
+        self.assertEqual(set(log["timings"].keys()), {"parse", "fetch_bytes", "serialize", "store"})
+        self.assertIn("_attachments", log)
+
+        collector()
+        collector()
+        self.assertEqual(collector.stages.count(source="marli-sb", stage="store"), 1)
+        self.assertEqual(collector.scrapes.value(source="marli-sb", success="true"), 1)
+        self.assertEqual(collector.scrapes.value(source="marli-sb", success="false"), 1)
+        self.assertIn("mittag_scrape_fetch_bytes_bucket", registry.render())
+        # updated later on, e.g. by the retention
+        log["archived"] = True
+        backend.put(storage.SCRAPINGS, log)
+        collector(now=time.time() + collector.MAX_AGE + 60)
+        self.assertEqual(collector.scrapes.value(source="marli-sb", success="true"), 1)
@@ -0,0 +1,227 @@
+import contextlib
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import mittagv2.leases as leases
+import mittagv2.metrics as metrics
+import mittagv2.model as model
+import mittagv2.polling as polling
+import mittagv2.scraper
+import mittagv2.sources as sources
+import mittagv2.storage as storage
+import mittagv2.utils as utils
+
+def rfc3339(epoch):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(epoch))
+
+class TestAdaptivePoller(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = storage.SqliteStorage(":memory:")
+        self.poller = polling.AdaptivePoller(self.backend)
+        self.source = sources.get("uksh-bistro")
+
+    def test_learn(self):
+        # first successful scrapes on tuesday 10:00 of past weeks, catch-up
+        # scrapes of weeks already over do not count
+        for year, week in utils.recent_weeks(5)[1:]:
+            year_week = utils.year_week(year, week)
+            start = polling.week_start_time(year_week)
+            for offset, success in ((polling.DAY + 9 * 3600, False), (polling.DAY + 10 * 3600, True),
+                    (polling.DAY + 11 * 3600, True)):
+                self.backend.put(storage.SCRAPINGS, {"type": "scrape_log", "source_name": "uksh-bistro",
+                    "year_week": year_week, "success": success, "at": rfc3339(start + offset)})
+        self.backend.put(storage.SCRAPINGS, {"type": "scrape_log", "source_name": "marli-sb",
+            "year_week": "2019-50", "success": True, "at": "2019-12-20T09:00:00Z"})
+        self.poller.learn()
+        self.assertEqual(self.poller.window(self.source), (polling.DAY + 10 * 3600,) * 2)
+        self.assertEqual(self.poller.window(sources.get("marli-sb")), (7 * 3600, 11 * 3600))
+
+    def test_schedule(self):
+        week_start = polling.week_start_time(utils.current_year_week())
+        state = self.poller.state(self.source)
+        self.assertFalse(state.published)
+        window_start = week_start + 7 * 3600 - self.poller.WINDOW_MARGIN
+        before, within = window_start - 600, window_start + 600
+        self.assertEqual(self.poller._next_poll(self.source, state, before), window_start)
+        self.assertEqual(self.poller._next_poll(self.source, state, within), within + self.poller.DENSE_INTERVAL)
+        self.assertEqual(self.poller._next_poll(self.source, state, week_start + 3 * polling.DAY),
+            week_start + 3 * polling.DAY + self.poller.SPARSE_INTERVAL)
+        state.next_at = within
+        self.assertIn(self.source, self.poller.due(within))
+        self.poller.polled(self.source, "changed", {"content_hash": "x"}, now=within)
+        self.assertTrue(state.published)
+        self.assertEqual(state.next_at, within + self.poller.CHECK_INTERVAL)
+        self.assertNotIn(self.source, self.poller.due(within))
+
+    def test_open_poller(self):
+        with mock.patch.dict(os.environ, {"MITTAG_POLLING": "schedule"}):
+            self.assertIsNone(polling.open_poller(self.backend))
+        with mock.patch.dict(os.environ, {"MITTAG_POLLING": "adaptive"}):
+            self.assertIsInstance(polling.open_poller(self.backend), polling.AdaptivePoller)
+
+    def test_not_weekly(self):
+        # marli-sb serves its latest menu under a fixed URL: last week's
+        # content does not count as published and nothing is learned
+        source = sources.get("marli-sb")
+        year, week = utils.recent_weeks(2)[1]
+        previous = utils.year_week(year, week)
+        log = {"type": "scrape_log", "source_name": "marli-sb", "year_week": previous, "success": True,
+            "at": rfc3339(polling.week_start_time(previous) + 3600), "content_hash": polling.content_hash(b"old")}
+        self.backend.put(storage.SCRAPINGS, log)
+        self.backend.put(storage.MENUS, {"_id": utils.menu_id("marli-sb", previous), "type": "weekly_menu",
+            "source_name": "marli-sb", "scrape_id": log["_id"], "menus": {"year_week": previous, "days": []}})
+        self.poller.learn()
+        self.assertNotIn("marli-sb", self.poller._offsets)
+        state = self.poller.state(source)
+        self.assertFalse(state.published)
+        self.assertEqual(state.validators["content_hash"], polling.content_hash(b"old"))
+        now = polling.week_start_time(state.year_week) + 8 * 3600
+        self.assertEqual(self.poller._next_poll(source, state, now), now + self.poller.SPARSE_INTERVAL)
+        self.poller.polled(source, "changed", {"content_hash": "new"}, now=now)
+        self.assertTrue(state.published)
+        self.assertNotIn("marli-sb", self.poller._offsets)
+
+class TestPolling(unittest.TestCase):
+
+    def test_poll(self):
+        backend = storage.SqliteStorage(":memory:")
+        poller = polling.AdaptivePoller(backend)
+        scraper = mittagv2.scraper.StorageScraper(backend, poller=poller)
+        source = sources.get("marli-sb")
+        content = {"data": b"v1"}
+        def fetch_if_changed(source, week_number, validators):
+            if polling.content_hash(content["data"]) == validators.get("content_hash"):
+                return None, validators
+            return content["data"], {"content_hash": polling.content_hash(content["data"])}
+        def parse(source, data, week_number):
+            return model.WeeklyMenu(week_number, [model.DailyMenu(0, [model.Menu("", data.decode(),
+                None, None, None, 2.5, None, False)])], None), data
+        scraper.fetch_if_changed = fetch_if_changed
+        scraper._parse = parse
+        menu_id = utils.menu_id("marli-sb", utils.current_year_week())
+        scraper._poll(source)
+        self.assertTrue(poller.state(source).published)
+        scraper._poll(source)
+        self.assertEqual(len(backend.ids(storage.SCRAPINGS)), 1)
+        content["data"] = b"v2"
+        scraper._poll(source)
+        self.assertEqual(backend.get(storage.MENUS, menu_id)["menus"]["days"][0]["menus"][0]["name"], "v2")
+        self.assertEqual(len(backend.ids(storage.SCRAPINGS)), 2)
+        # restarted poller knows the stored content
+        self.assertEqual(polling.AdaptivePoller(backend).state(source).validators["content_hash"],
+            polling.content_hash(b"v2"))
+
+    def test_poll_correction(self):
+        backend = storage.SqliteStorage(":memory:")
+        poller = polling.AdaptivePoller(backend)
+        scraper = mittagv2.scraper.StorageScraper(backend, leases.LeaseManager(backend, owner="a"), poller=poller)
+        source = sources.get("marli-sb")
+        content = {"data": b"v1"}
+        def fetch_if_changed(source, week_number, validators):
+            if polling.content_hash(content["data"]) == validators.get("content_hash"):
+                return None, validators
+            return content["data"], {"content_hash": polling.content_hash(content["data"])}
+        def parse(source, data, week_number):
+            return model.WeeklyMenu(week_number, [model.DailyMenu(0, [model.Menu("", data.decode(),
+                None, None, None, 2.5, None, False)])], None), data
+        scraper.fetch_if_changed = fetch_if_changed
+        scraper._parse = parse
+        menu_id = utils.menu_id("marli-sb", utils.current_year_week())
+        scraper._poll(source)
+        # corrected shortly after the week was completed
+        content["data"] = b"v2"
+        scraper._poll(source)
+        self.assertEqual(backend.get(storage.MENUS, menu_id)["menus"]["days"][0]["menus"][0]["name"], "v2")
+        # stored content is not scraped again, e.g. by another replica
+        scrape = lambda: parse(source, b"v2", utils.current_week())
+        self.assertIsNone(scraper._scrape_single(scrape, "marli-sb", retries=1,
+            content_hash=polling.content_hash(b"v2")))
+        self.assertEqual(len(backend.ids(storage.SCRAPINGS)), 2)
+
+    def test_poll_not_stored(self):
+        backend = storage.SqliteStorage(":memory:")
+        poller = polling.AdaptivePoller(backend)
+        scraper = mittagv2.scraper.StorageScraper(backend, poller=poller)
+        source = sources.get("marli-sb")
+        parsed = []
+        def fetch_if_changed(source, week_number, validators):
+            if polling.content_hash(b"v1") == validators.get("content_hash"):
+                return None, validators
+            return b"v1", {"content_hash": polling.content_hash(b"v1")}
+        def parse(source, data, week_number):
+            parsed.append(data)
+            raise ValueError("unexpected layout")
+        scraper.fetch_if_changed = fetch_if_changed
+        scraper._parse = parse
+        # failed content is parsed again on the next poll
+        scraper._poll(source)
+        scraper._poll(source)
+        self.assertEqual(parsed, [b"v1", b"v1"])
+        self.assertIsNone(poller.state(source).validators["content_hash"])
+        # another replica stored the menu in the meantime
+        self.assertTrue(scraper._scrape_single(lambda: (model.WeeklyMenu(utils.current_week(), [], None), b"v1"),
+            "marli-sb", retries=1))
+        @contextlib.contextmanager
+        def claimed_elsewhere(name, year_week, content_hash=None):
+            yield None
+        scraper._claim = claimed_elsewhere
+        scraper._poll(source)
+        self.assertEqual(len(parsed), 2)
+        state = poller.state(source)
+        self.assertTrue(state.published)
+        self.assertEqual(state.validators["content_hash"], polling.content_hash(b"v1"))
+
+class Handler(BaseHTTPRequestHandler):
+    requests = []
+
+    def _respond(self, body):
+        Handler.requests.append(self.command)
+        if self.headers.get("If-None-Match") == "\"v1\"":
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", "\"v1\"")
+        self.send_header("Content-Length", str(len(b"menu")))
+        self.end_headers()
+        if body:
+            self.wfile.write(b"menu")
+
+    def do_GET(self):
+        self._respond(True)
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def log_message(self, *args):
+        pass
+
+class TestFetchIfChanged(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        Handler.requests = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_conditional(self):
+        source = sources.Source("test", "Test", "http://127.0.0.1:{}/{{week}}".format(self.server.server_port),
+            "mittagv2.marli_parser:MarliParser", timeout=5)
+        scraper = mittagv2.scraper.Scraper()
+        with metrics.timed() as timings:
+            data, validators = scraper.fetch_if_changed(source, 1, {})
+        self.assertEqual((data, validators["etag"]), (b"menu", "\"v1\""))
+        self.assertEqual(timings.values["fetch_bytes"], len(b"menu"))
+        self.assertIn("fetch_ttfb", timings.values)
+        self.assertEqual(scraper.fetch_if_changed(source, 1, validators), (None, validators))
+        self.assertEqual(Handler.requests, ["GET", "HEAD"])
+        data, current = scraper.fetch_if_changed(source, 1, {"content_hash": polling.content_hash(b"menu")})
+        self.assertIsNone(data)
+        self.assertEqual(current["etag"], "\"v1\"")
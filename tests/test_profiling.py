@@ -0,0 +1,42 @@
+import os
+import pstats
+import tempfile
+import unittest
+import mittagv2.profiling as profiling
+
+def busy():
+    return sum(inner(i) for i in range(2000))
+
+def inner(i):
+    return i * i
+
+class TestProfiler(unittest.TestCase):
+
+    def test_sampling(self):
+        profiler = profiling.Profiler("test")
+        with profiler.profile():
+            busy()
+        self.assertEqual(profiler.samples, 0)
+        profiler.configure(1.0)
+        for _ in range(2):
+            with profiler.profile():
+                busy()
+        self.assertEqual(profiler.samples, 2)
+        self.assertIn("busy", profiler.report())
+        with self.assertRaises(ValueError):
+            profiler.configure(2)
+        profiler.reset()
+        self.assertEqual(profiler.collapsed(), "")
+
+    def test_dump(self):
+        profiler = profiling.Profiler("test", fraction=1.0)
+        with profiler.profile():
+            busy()
+        stacks = [ line for line in profiler.collapsed().splitlines() if ":inner" in line ]
+        self.assertEqual(len(stacks), 1)
+        self.assertIn("test_profiling.py:7:busy;", stacks[0])
+        with tempfile.TemporaryDirectory() as directory:
+            paths = profiler.dump(directory)
+            stats = pstats.Stats(paths[0])
+            self.assertTrue(any(func[2] == "inner" for func in stats.stats))
+            self.assertTrue(os.path.getsize(paths[1]) > 0)
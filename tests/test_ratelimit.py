@@ -0,0 +1,61 @@
+import unittest
+import wsgiref.util
+import cherrypy
+import mittagv2.ratelimit as ratelimit
+import mittagv2.storage as storage
+import mittagv2.web as web
+
+class TestRateLimit(unittest.TestCase):
+
+    def test_bucket(self):
+        limiter = ratelimit.RateLimiter("test-client", rate=2, burst=4)
+        self.assertEqual(limiter.take("a", 3, now=0), 0)
+        self.assertEqual(limiter.take("a", 2, now=0), 0.5)
+        self.assertEqual(limiter.take("b", 2, now=0), 0)
+        self.assertEqual(limiter.take("a", 2, now=0.5), 0)
+        # more than the burst is allowed on a full bucket only
+        self.assertEqual(limiter.take("c", 10, now=0), 0)
+        self.assertEqual(limiter.take("c", 10, now=1), 4.0)
+        self.assertEqual(ratelimit.retry_after(0.2), "1")
+
+    def test_prune(self):
+        limiter = ratelimit.RateLimiter("test-prune", rate=1, burst=2, max_keys=2)
+        limiter.take("a", 2, now=0)
+        limiter.take("b", 1, now=0)
+        limiter.take("c", 1, now=10)
+        self.assertEqual(len(limiter), 1)
+
+    def test_admission(self):
+        admission = ratelimit.Admission(client_rate=1, client_burst=10, endpoint_rate=1, endpoint_burst=15,
+            heavy_concurrency=1)
+        admission.heavy.timeout = 0
+        self.assertIsNone(admission.admit("10.0.0.1", "Scrapings.index", cost=10, heavy=True, now=0))
+        self.assertEqual(admission.admit("10.0.0.1", "Scrapings.index", cost=1, now=0), ("client", 1.0))
+        self.assertEqual(admission.admit("10.0.0.2", "Scrapings.index", cost=10, now=0), ("endpoint", 5.0))
+        self.assertEqual(admission.admit("10.0.0.2", "Root.index", cost=10, heavy=True, now=0), ("concurrency", 1.0))
+        admission.release()
+        self.assertIsNone(admission.admit("10.0.0.3", "Root.index", cost=1, heavy=True, now=0))
+        admission.release()
+        self.assertEqual(ratelimit.REJECTED.value(endpoint="Scrapings.index", reason="endpoint"), 1)
+
+    def test_retry_later(self):
+        cherrypy.serving.response = cherrypy._cprequest.Response()
+        web.RetryLater(429, 3, "too many requests").set_response()
+        self.assertEqual(cherrypy.response.headers["Retry-After"], "3")
+        self.assertEqual(cherrypy.response.status, 429)
+
+    def test_static_files(self):
+        app = cherrypy.Application(web.Root(storage.SqliteStorage(":memory:")), "", web.application_config())
+        def status(path):
+            environ = {"PATH_INFO": path}
+            wsgiref.util.setup_testing_defaults(environ)
+            result = []
+            b"".join(app(environ, lambda status, headers, exc_info=None: result.append(status)))
+            return int(result[0].split(" ")[0])
+        admission = cherrypy.tools.rate_limit.admission
+        cherrypy.tools.rate_limit.admission = ratelimit.Admission(client_rate=0.001, client_burst=2)
+        try:
+            self.assertEqual([ status("/style.css") for _ in range(3) ], [200] * 3)
+            self.assertEqual([ status("/api/v1/menus/") for _ in range(3) ][-1], 429)
+        finally:
+            cherrypy.tools.rate_limit.admission = admission
@@ -0,0 +1,66 @@
+import datetime
+import json
+import unittest
+import cherrypy
+import mittagv2.readmodels as readmodels
+import mittagv2.storage as storage
+import mittagv2.utils as utils
+import mittagv2.web as web
+
+class TestReadModels(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = storage.SqliteStorage(":memory:")
+        self.menu = {"_id": utils.menu_id("marli-sb", "2019-50"), "type": "weekly_menu",
+            "source_name": "marli-sb", "revision": 1, "menus": {"year_week": "2019-50", "notice": "Geschlossen",
+            "days": [{"day": 0, "menus": [{"name": "Suppe", "menu_type": "", "normal_price": 2.5}]}]}}
+        self.backend.put(storage.MENUS, self.menu)
+        self.read_models = readmodels.ReadModels(self.backend)
+
+    def test_rebuild(self):
+        self.assertEqual(len(self.read_models.rebuild("2019-50")), 8)
+        day = self.read_models.day(datetime.date(2019, 12, 9))
+        self.assertEqual(day["sources"], {"marli-sb": {"menus": [{"name": "Suppe", "menu_type": "",
+            "normal_price": 2.5}], "notice": "Geschlossen"}})
+        self.assertEqual(self.read_models.day(datetime.date(2019, 12, 10))["sources"], {})
+        week = self.read_models.week("2019-50")
+        self.assertEqual((week["start"], week["revisions"]), ("2019-12-09", {"marli-sb": 1}))
+        self.assertEqual(week["days"][0]["menus"], {"marli-sb": 1})
+        # unchanged weeks are not written again
+        self.assertEqual(self.read_models.rebuild("2019-50"), [])
+        self.menu["menus"]["days"][0]["menus"][0]["name"] = "Eintopf"
+        self.backend.put(storage.MENUS, self.menu)
+        self.assertEqual(self.read_models.rebuild("2019-50"), ["week/2019-50", "day/2019-12-09"])
+        self.assertTrue(self.read_models.day(datetime.date(2019, 12, 9))["_rev"].startswith("2-"))
+
+    def test_bundle(self):
+        self.read_models.rebuild("2019-50")
+        version, body = web.Bundle(self.backend).get("2019-50")
+        self.assertEqual(web.handlers.build_bundle("2019-50",
+            self.backend.get_many(storage.MENUS, readmodels.week_menu_ids("2019-50"))), (version, body))
+        self.assertEqual(json.loads(body.decode("utf-8"))["sources"][2]["days"][0][0]["name"], "Suppe")
+
+    def test_catch_up(self):
+        self.assertEqual(self.read_models.catch_up(), ["2019-50"])
+        self.assertEqual(self.read_models.catch_up(), [])
+
+    def test_page(self):
+        year_week = utils.current_year_week()
+        current = dict(self.menu, _id=utils.menu_id("marli-sb", year_week),
+            menus=dict(self.menu["menus"], year_week=year_week))
+        del current["_rev"]
+        self.backend.put(storage.MENUS, current)
+        root = web.Root(self.backend)
+        self.assertEqual(root._get_page("0")[0], None)
+        self.read_models.rebuild(year_week)
+        etag, page = root._get_page("0")
+        self.assertIn("Suppe", page)
+        self.assertTrue(etag.startswith("\"1-"))
+        cherrypy.serving.response = cherrypy._cprequest.Response()
+        cherrypy.request.headers["If-None-Match"] = etag
+        try:
+            with self.assertRaises(cherrypy.HTTPRedirect) as cm:
+                root.index("0")
+            self.assertEqual(cm.exception.status, 304)
+        finally:
+            del cherrypy.request.headers["If-None-Match"]
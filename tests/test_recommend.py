@@ -0,0 +1,72 @@
+import unittest
+import cherrypy
+import mittagv2.recommend as recommend
+import mittagv2.storage as storage
+import mittagv2.utils as utils
+import mittagv2.web as web
+
+MENUS = {
+    "marli-sb": [{"menu_type": "", "name": "Schweineschnitzel", "description": "mit Pommes",
+        "normal_price": 4.5, "calories": 900}],
+    "swsh-mensa": [
+        {"menu_type": "Menü 1", "name": "Gemüsecurry", "normal_price": 3.5, "student_price": 2.2,
+            "vegetarian": True, "calories": 650},
+        {"menu_type": "Menü 2", "name": "Fischfilet", "description": "mit Kartoffeln", "normal_price": 3.9,
+            "student_price": 2.6, "calories": 700},
+    ],
+}
+
+class TestRecommend(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = storage.SqliteStorage(":memory:")
+        for source_name, menus in MENUS.items():
+            self.backend.put(storage.MENUS, {"_id": utils.menu_id(source_name, "2019-50"), "type": "weekly_menu",
+                "source_name": source_name, "menus": {"year_week": "2019-50",
+                "days": [{"day": 0, "menus": menus}]}})
+        self.recommender = recommend.Recommender(self.backend)
+
+    def names(self, **profile):
+        result = self.recommender.recommend("2019-50", 0, [recommend.Profile(**profile)], limit=3)
+        return [ m["menu"]["name"] for m in result[0]["menus"] ]
+
+    def test_rank(self):
+        self.assertEqual(len(self.recommender.features("2019-50", 0)), 3)
+        self.assertEqual(self.names(vegetarian=True), ["Gemüsecurry"])
+        self.assertEqual(self.names(max_price=4, price="normal"), ["Gemüsecurry", "Fischfilet"])
+        self.assertEqual(self.names(likes=["fisch"])[0], "Fischfilet")
+        self.assertEqual(self.names(dislikes=["curry"], likes=["pommes"])[0], "Schweineschnitzel")
+        self.assertEqual(self.names(likes=["fisch"], history=["Fischfilet mit Reis"], variety=2)[0], "Gemüsecurry")
+        self.assertEqual(self.names(calories=900, calorie_weight=5)[0], "Schweineschnitzel")
+
+    def test_batch(self):
+        profiles = [ recommend.Profile(id=i, vegetarian=i % 2 == 0, history=["Curry"] * (i % 3))
+            for i in range(100) ]
+        scores = recommend.score(self.recommender.features("2019-50", 0), profiles)
+        self.assertEqual(scores.shape, (100, 3))
+        result = self.recommender.recommend("2019-50", 0, profiles, limit=1)
+        self.assertEqual([ r["id"] for r in result ], list(range(100)))
+        self.assertTrue(all(len(r["menus"]) == 1 for r in result))
+
+    def test_api(self):
+        handler = web.Recommend(self.backend)
+        result = handler.recommend({"year_week": "2019-50", "day": 0, "limit": 1,
+            "profiles": [{"id": "team", "likes": ["fisch"]}]})
+        self.assertEqual(result["recommendations"][0]["menus"][0]["menu"]["name"], "Fischfilet")
+        for request in ({}, {"profiles": [{"unknown": 1}]}, {"profiles": [{"price": "free"}]},
+                {"profiles": [], "limit": None}, {"profiles": [], "year_week": 201950},
+                {"profiles": [], "day": [1]}):
+            with self.assertRaises(cherrypy.HTTPError) as context:
+                handler.recommend(request)
+            self.assertEqual(context.exception.status, 400)
+        with self.assertRaises(cherrypy.HTTPError) as context:
+            handler.recommend({"profiles": [{"likes": 1}]})
+        self.assertNotIn("limit", context.exception._message)
+
+    def test_query(self):
+        handler = web.Recommend(self.backend)
+        result = handler.index(year_week="2019-50", day="0", likes=["pommes", "curry,fisch"],
+            vegetarian=["0", "1"])
+        self.assertEqual([ m["menu"]["name"] for m in result["recommendations"][0]["menus"] ], ["Gemüsecurry"])
+        result = handler.index(year_week="2019-50", day="0", likes="fisch", vegetarian="no")
+        self.assertEqual(result["recommendations"][0]["menus"][0]["menu"]["name"], "Fischfilet")
@@ -0,0 +1,73 @@
+import logging
+import os
+import tempfile
+import unittest
+from datetime import datetime
+import mittagv2.feeds as feeds
+import mittagv2.model as model
+import mittagv2.replay as replay
+import mittagv2.retention as retention
+import mittagv2.revisions as revisions
+import mittagv2.scraper
+import mittagv2.storage as storage
+import mittagv2.utils as utils
+
+class TestDiff(unittest.TestCase):
+
+    def test_diff_menus(self):
+        menu = {"name": "Suppe", "menu_type": "", "normal_price": 2.5}
+        expected = {"days": [{"day": 0, "menus": [menu]}]}
+        self.assertEqual(replay.diff_menus(expected, expected), [])
+        actual = {"days": [{"day": 0, "menus": [dict(menu, normal_price=2.8)]}], "notice": "zu"}
+        self.assertEqual(replay.diff_menus(expected, actual),
+            ["notice: None != 'zu'", "day 0 menu 0 normal_price: 2.5 != 2.8"])
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = storage.SqliteStorage(":memory:")
+        scraper = mittagv2.scraper.StorageScraper(self.backend)
+        with open("tests/resources/marli.html", "rb") as fp:
+            blob = fp.read()
+        menu = mittagv2.sources.get("marli-sb").parse(blob, 1)
+        logging.disable(logging.INFO)
+        try:
+            scraper._scrape_single(lambda: (menu, blob), "marli-sb", "2019-01")
+            scraper._scrape_log("uksh-bistro", "2019-01", False, blob=b"broken", error="parse error")
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def test_unchanged(self):
+        report = replay.Replay(self.backend, workers=1).run()
+        self.assertEqual(report["replayed"], 2)
+        self.assertEqual(report["outcomes"]["unchanged"], 1)
+        self.assertEqual(report["outcomes"]["still_failing"], 1)
+        self.assertEqual(report["regressions"], [])
+        self.assertIn("mittagv2.marli_parser:MarliParser", report["parsers"])
+        self.assertEqual(replay.Replay(self.backend, first="2019-02", workers=1).run()["replayed"], 0)
+
+    def test_changed_write_back(self):
+        doc_id = utils.menu_id("marli-sb", "2019-01")
+        stored = self.backend.get(storage.MENUS, doc_id)
+        stored["menus"]["days"][0]["menus"][0]["name"] = "Alt"
+        self.backend.put(storage.MENUS, stored)
+        with tempfile.TemporaryDirectory() as directory:
+            generator = feeds.FeedGenerator(self.backend, directory)
+            report = replay.Replay(self.backend, source_name="marli-sb", workers=1,
+                feeds=generator).run(write_back=True)
+            self.assertTrue(os.path.exists(os.path.join(directory, "2019-01", "marli-sb.json")))
+        self.assertEqual(report["outcomes"]["changed"], 1)
+        self.assertIn("day 0 menu 0 name: 'Alt'", report["regressions"][0]["differences"][0])
+        self.assertEqual(report["written"], 1)
+        self.assertNotEqual(self.backend.get(storage.MENUS, doc_id)["menus"]["days"][0]["menus"][0]["name"], "Alt")
+        self.assertEqual(replay.Replay(self.backend, workers=1).run()["outcomes"]["unchanged"], 1)
+        self.assertEqual(self.backend.get(storage.MENU_HISTORY, revisions.revision_id(doc_id, 1))["revision"], 1)
+
+    def test_archived(self):
+        with tempfile.TemporaryDirectory() as directory:
+            archive = retention.BlobArchive(directory)
+            retention.Retention(self.backend, archive).run(now=datetime.utcnow().replace(year=2100))
+            self.assertEqual(replay.Replay(self.backend, workers=1).run()["replayed"], 0)
+            report = replay.Replay(self.backend, workers=1, archive=archive).run()
+        self.assertEqual(report["replayed"], 2)
+        self.assertEqual(report["outcomes"]["unchanged"], 1)
@@ -0,0 +1,62 @@
+import tempfile
+import unittest
+from datetime import datetime
+import mittagv2.retention as retention
+import mittagv2.storage as storage
+import mittagv2.web as web
+
+class TestRetention(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = storage.SqliteStorage(":memory:")
+        self.directory = tempfile.TemporaryDirectory()
+        self.archive = retention.BlobArchive(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _log(self, at, success, blob):
+        doc = {"type": "scrape_log", "source_name": "marli-sb", "year_week": "2019-01",
+            "at": at, "success": success}
+        self.backend.put(storage.SCRAPINGS, doc)
+        self.backend.put_blob(storage.SCRAPINGS, doc["_id"], doc["_rev"], "marli-sb_2019-01.bin",
+            "application/octet-stream", blob)
+        return doc["_id"]
+
+    def test_run(self):
+        success = self._log("2019-01-01T07:00:00Z", True, b"<html>menu</html>")
+        self._log("2019-01-01T06:00:00Z", False, b"error")
+        latest_failure = self._log("2019-01-01T06:30:00Z", False, b"error")
+        recent = self._log("2019-06-20T07:00:00Z", True, b"<html>recent</html>")
+        stats = retention.Retention(self.backend, self.archive).run(now=datetime(2019, 7, 1))
+        self.assertEqual((stats["scanned"], stats["deleted"], stats["archived"]), (4, 1, 2))
+        self.assertEqual(sorted(self.backend.ids(storage.SCRAPINGS)), sorted([success, latest_failure, recent]))
+        with self.assertRaises(KeyError):
+            self.backend.get_blob(storage.SCRAPINGS, success)
+        self.assertEqual(self.backend.get_blob(storage.SCRAPINGS, recent)[2], b"<html>recent</html>")
+        archived = web.Scrapings(self.backend, self.archive)._archived(success)
+        self.assertEqual(archived, ("marli-sb_2019-01.bin", "application/octet-stream", b"<html>menu</html>"))
+
+    def test_without_archive(self):
+        self._log("2019-01-01T07:00:00Z", True, b"data")
+        stats = retention.Retention(self.backend).run(now=datetime(2019, 7, 1))
+        self.assertEqual(stats["archived"], 0)
+        self.assertEqual(self.backend.get_blob(storage.SCRAPINGS, self.backend.ids(storage.SCRAPINGS)[0])[2], b"data")
+
+    def test_legacy_failures(self):
+        # older scrape logs only name their week in the blob
+        kept = []
+        for name, at in (("marli-sb_2019- 1.bin", "05:00"), ("marli-sb_2019- 1.bin", "06:00"),
+                ("marli-sb_2019- 2.bin", "06:00"), ("marli-sb.bin", "06:00"), ("other.bin", "06:00")):
+            doc = {"type": "scrape_log", "source_name": "marli-sb", "at": "2019-01-01T{}:00Z".format(at),
+                "success": False}
+            self.backend.put(storage.SCRAPINGS, doc)
+            self.backend.put_blob(storage.SCRAPINGS, doc["_id"], doc["_rev"], name,
+                "application/octet-stream", b"error")
+            kept.append(doc["_id"])
+        self.assertEqual(retention.log_year_week(self.backend.get(storage.SCRAPINGS, kept[0])), "2019-01")
+        stats = retention.Retention(self.backend).run(now=datetime(2019, 1, 2))
+        # only the older failure of week 1 goes
+        self.assertEqual(stats["deleted"], 1)
+        kept.pop(0)
+        self.assertEqual(sorted(self.backend.ids(storage.SCRAPINGS)), sorted(kept))
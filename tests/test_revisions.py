@@ -0,0 +1,83 @@
+import unittest
+import cherrypy
+import mittagv2.revisions as revisions
+import mittagv2.storage as storage
+import mittagv2.web as web
+
+def weekly(*days, **extra):
+    menus = {"year_week": "2019-50", "days": [ {"day": i, "menus": [ {"menu_type": "", "name": name,
+        "normal_price": price} for name, price in day ]} for i, day in enumerate(days) ]}
+    menus.update(extra)
+    return menus
+
+class TestDiff(unittest.TestCase):
+
+    def test_roundtrip(self):
+        old = weekly([("Suppe", 2.5), ("Salat", 3.0)], [("Fisch", 4.2)])
+        new = weekly([("Suppe", 2.8), ("Salat", 3.0)], [("Fisch", 4.2), ("Pasta", 3.9)], [("Eintopf", 2.0)],
+            notice="geschlossen")
+        changes = revisions.diff(old, new)
+        self.assertEqual(changes[0], {"path": ["notice"], "new": "geschlossen"})
+        self.assertEqual(changes[1], {"path": ["days", 0, "menus", 0, "normal_price"], "old": 2.5, "new": 2.8})
+        self.assertEqual([ c["path"] for c in changes[2:] ], [["days", 1], ["days", 2]])
+        self.assertEqual(revisions.apply(old, changes), new)
+        self.assertEqual(revisions.apply(new, changes, reverse=True), old)
+        self.assertEqual(revisions.diff(new, new), [])
+        with self.assertRaises(ValueError):
+            revisions.apply(new, changes)
+
+class TestMenuRevisions(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = storage.SqliteStorage(":memory:")
+        self.revisions = revisions.MenuRevisions(self.backend)
+        self.versions = [weekly([("Suppe", 2.5)]), weekly([("Suppe", 2.8)]),
+            weekly([("Suppe", 2.8)], [("Fisch", 4.2)])]
+        for i, menus in enumerate(self.versions):
+            self.revisions.store({"_id": "marli-sb/2019-50", "type": "weekly_menu", "source_name": "marli-sb",
+                "at": "2019-12-0{}T07:00:00Z".format(i + 1), "scrape_id": "s{}".format(i), "menus": menus})
+
+    def test_store(self):
+        self.assertIsNone(self.revisions.store({"_id": "marli-sb/2019-50", "type": "weekly_menu",
+            "scrape_id": "s3", "menus": weekly([("Suppe", 2.8)], [("Fisch", 4.2)])}))
+        current = self.backend.get(storage.MENUS, "marli-sb/2019-50")
+        self.assertEqual((current["revision"], current["scrape_id"]), (2, "s2"))
+        self.assertEqual(len(self.backend.ids(storage.MENU_HISTORY)), 2)
+        for number, menus in enumerate(self.versions):
+            revision = self.revisions.revision("marli-sb/2019-50", number)
+            self.assertEqual((revision["menus"], revision["scrape_id"]), (menus, "s{}".format(number)))
+        with self.assertRaises(KeyError):
+            self.revisions.revision("marli-sb/2019-50", 3)
+
+    def test_store_many(self):
+        documents = [ {"_id": doc_id, "type": "weekly_menu", "scrape_id": "s3", "menus": menus}
+            for doc_id, menus in [("marli-sb/2019-50", weekly([("Suppe", 3.0)], [("Fisch", 4.2)])),
+                ("marli-sb/2019-51", weekly([("Pasta", 3.9)])), ("marli-sb/2019-50", self.versions[2])] ]
+        self.assertEqual(self.revisions.store_many(documents[:2]), [3, 0])
+        self.assertEqual(self.revisions.store_many(documents[2:]), [4])
+        self.assertEqual(len(self.backend.ids(storage.MENU_HISTORY)), 4)
+        for number, menus in enumerate(self.versions):
+            self.assertEqual(self.revisions.revision("marli-sb/2019-50", number)["menus"], menus)
+        self.assertEqual(self.revisions.store_many(documents[2:]), [None])
+
+    def test_missing_record(self):
+        # crashed between storing the menus and copying their changes
+        record = self.backend.get(storage.MENU_HISTORY, revisions.revision_id("marli-sb/2019-50", 2))
+        self.backend.delete(storage.MENU_HISTORY, record["_id"], record["_rev"])
+        self.assertEqual(self.revisions.revision("marli-sb/2019-50", 1)["menus"], self.versions[1])
+        self.revisions.store({"_id": "marli-sb/2019-50", "type": "weekly_menu", "scrape_id": "s3",
+            "menus": weekly([("Suppe", 3.0)], [("Fisch", 4.2)])})
+        self.assertEqual(len(self.backend.ids(storage.MENU_HISTORY)), 3)
+        for number, menus in enumerate(self.versions):
+            self.assertEqual(self.revisions.revision("marli-sb/2019-50", number)["menus"], menus)
+
+    def test_api(self):
+        menus = web.Menus(self.backend)
+        changes = menus.changes("marli-sb", "2019-50", since="1")
+        self.assertEqual(changes["revision"], 2)
+        self.assertEqual([ r["revision"] for r in changes["revisions"] ], [2])
+        self.assertEqual(changes["revisions"][0]["changes"], [{"path": ["days", 1],
+            "new": self.versions[2]["days"][1]}])
+        self.assertEqual(menus.revision("0", "marli-sb", "2019-50")["menus"], self.versions[0])
+        with self.assertRaises(cherrypy.HTTPError):
+            menus.changes("marli-sb", "2019-51")
@@ -0,0 +1,26 @@
+import unittest
+import mittagv2.model as model
+import mittagv2.sources as sources
+
+class TestSources(unittest.TestCase):
+
+    def test_registry(self):
+        self.assertEqual([ s.name for s in sources.SOURCES ],
+            ["swsh-mensa", "uksh-cafeteria", "marli-sb", "uksh-bistro"])
+        self.assertEqual(sources.by_priority()[0].priority, 0)
+        with self.assertRaises(KeyError):
+            sources.get("unknown")
+
+    def test_url(self):
+        bistro = sources.get("uksh-bistro")
+        self.assertTrue(bistro.weekly)
+        self.assertTrue(bistro.url_for(7).endswith("KW+07.pdf"))
+        self.assertFalse(sources.get("marli-sb").weekly)
+
+    def test_parse(self):
+        with open("tests/resources/Speiseplan Bistro KW 50.pdf", "rb") as fp:
+            res = sources.get("uksh-bistro").parse(fp.read(), 50)
+        self.assertEqual(model.find_menu_by_type(res.days[4], "Vegetarisch")[0].name, "Kaiserschmarrn")
+        with open("tests/resources/marli.html", "rb") as fp:
+            res = sources.get("marli-sb").parse(fp.read(), 1)
+        self.assertEqual(len(res.days[0].menus), 1)
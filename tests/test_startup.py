@@ -0,0 +1,38 @@
+import subprocess
+import sys
+import unittest
+
+def import_times(module):
+    """Import a module in a fresh interpreter and return cumulative import
+    times in microseconds, keyed by module name (python -X importtime)"""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import {}".format(module)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    times = {}
+    for line in proc.stderr.decode("UTF-8").splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        times[name.strip()] = int(cumulative)
+    return times
+
+class TestStartup(unittest.TestCase):
+
+    def assertNotImported(self, times, prefixes):
+        loaded = [ m for m in times if m.split(".")[0] in prefixes ]
+        self.assertEqual(loaded, [])
+
+    def test_web_startup(self):
+        times = import_times("mittagv2.web")
+        self.assertIn("mittagv2.web", times)
+        self.assertNotImported(times, ("cloudant", "pdfminer", "lxml", "numpy"))
+
+    def test_scraper_startup(self):
+        times = import_times("mittagv2.scraper")
+        self.assertIn("mittagv2.scraper", times)
+        self.assertNotImported(times, ("cloudant", "pdfminer", "lxml"))
+
+    def test_static_generator_startup(self):
+        times = import_times("mittagv2.static_generator")
+        self.assertNotImported(times, ("cloudant", "pdfminer", "lxml"))
@@ -0,0 +1,169 @@
+import unittest
+import mittagv2.model as model
+import mittagv2.scraper
+import mittagv2.storage as storage
+import mittagv2.utils as utils
+
+class TestSqliteStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = storage.SqliteStorage(":memory:")
+
+    def test_put_get(self):
+        doc = {"type": "scrape_log", "source_name": "marli-sb"}
+        rev = self.storage.put(storage.SCRAPINGS, doc)
+        self.assertTrue(rev.startswith("1-"))
+        stored = self.storage.get(storage.SCRAPINGS, doc["_id"])
+        self.assertEqual(stored["source_name"], "marli-sb")
+        self.assertEqual(stored["_rev"], rev)
+        with self.assertRaises(KeyError):
+            self.storage.get(storage.SCRAPINGS, "missing")
+        self.assertEqual(self.storage.get_many(storage.SCRAPINGS, [doc["_id"], "missing"])[1], None)
+
+    def test_conflict(self):
+        doc = {"_id": "lease", "owner": "a"}
+        rev = self.storage.put(storage.MENUS, doc)
+        with self.assertRaises(storage.Conflict):
+            self.storage.put(storage.MENUS, {"_id": "lease", "owner": "b"})
+        with self.assertRaises(storage.Conflict):
+            self.storage.put(storage.MENUS, {"_id": "lease", "_rev": "1-stale", "owner": "b"})
+        doc["owner"] = "c"
+        self.assertTrue(self.storage.put(storage.MENUS, doc).startswith("2-"))
+        self.assertNotEqual(doc["_rev"], rev)
+
+    def test_blob(self):
+        doc = {"type": "scrape_log"}
+        rev = self.storage.put(storage.SCRAPINGS, doc)
+        new_rev = self.storage.put_blob(storage.SCRAPINGS, doc["_id"], rev, "x.bin", "application/octet-stream", b"\x00data")
+        self.assertNotEqual(rev, new_rev)
+        self.assertEqual(self.storage.get_blob(storage.SCRAPINGS, doc["_id"]),
+            ("x.bin", "application/octet-stream", b"\x00data"))
+        stored = self.storage.get(storage.SCRAPINGS, doc["_id"])
+        self.assertEqual(stored["_attachments"]["x.bin"]["length"], 5)
+
+    def test_weekly_menus(self):
+        for source in ("marli-sb", "swsh-mensa"):
+            self.storage.put(storage.MENUS, {"type": "weekly_menu", "source_name": source,
+                "menus": {"year_week": "2019-50", "days": []}})
+        self.storage.put(storage.MENUS, {"type": "weekly_menu", "source_name": "marli-sb",
+            "menus": {"year_week": "2019-49", "days": []}})
+        self.assertEqual(len(self.storage.weekly_menus("2019-50")), 2)
+        self.assertEqual(len(self.storage.weekly_menus("2019-50", source_name="marli-sb")), 1)
+        self.assertEqual(len(self.storage.weekly_menu_ids()), 3)
+
+    def test_scrape_logs(self):
+        for year_week in ("2019-48", "2019-49", "2019-50"):
+            self.storage.put(storage.SCRAPINGS, {"type": "scrape_log", "source_name": "marli-sb",
+                "year_week": year_week, "success": True})
+        self.storage.put(storage.SCRAPINGS, {"type": "other", "year_week": "2019-50"})
+        self.assertEqual([ log["year_week"] for log in self.storage.scrape_logs("2019-49") ],
+            ["2019-49", "2019-50"])
+        self.assertEqual(len(self.storage.scrape_logs("2019-48", "2019-49")), 2)
+
+    def test_upsert_history(self):
+        doc = {"_id": "marli-sb/2019-50", "type": "weekly_menu", "source_name": "marli-sb",
+            "menus": {"year_week": "2019-50", "days": []}}
+        first = self.storage.upsert(storage.MENUS, doc, history=storage.MENU_HISTORY)
+        replacement = dict(doc, at="later")
+        del replacement["_rev"]
+        self.storage.upsert(storage.MENUS, replacement, history=storage.MENU_HISTORY)
+        self.assertEqual(self.storage.get(storage.MENUS, doc["_id"])["at"], "later")
+        history = self.storage.get(storage.MENU_HISTORY, "marli-sb/2019-50@" + first)
+        self.assertEqual(history["doc_id"], doc["_id"])
+        self.assertNotIn("at", history)
+
+    def test_put_many(self):
+        existing = {"_id": "a", "n": 1}
+        self.storage.put(storage.MENUS, existing)
+        results = self.storage.put_many(storage.MENUS, [{"_id": "a", "n": 2}, {"_id": "b", "n": 1}])
+        self.assertIsInstance(results[0], storage.Conflict)
+        self.assertTrue(results[1].startswith("1-"))
+        self.storage.upsert_many(storage.MENUS, [{"_id": "a", "n": 3}, {"_id": "c"}], history=storage.MENU_HISTORY)
+        self.assertEqual(self.storage.get(storage.MENUS, "a")["n"], 3)
+        self.assertEqual(self.storage.ids(storage.MENU_HISTORY), ["a@" + existing["_rev"]])
+
+    def test_changes(self):
+        last_seq, changes = self.storage.changes(storage.MENUS)
+        self.assertEqual(changes, [])
+        doc = {"type": "weekly_menu"}
+        self.storage.put(storage.MENUS, doc)
+        self.storage.put(storage.SCRAPINGS, {"type": "scrape_log"})
+        last_seq, changes = self.storage.changes(storage.MENUS, since=last_seq)
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0]["id"], doc["_id"])
+        self.assertEqual(self.storage.changes(storage.MENUS, since=last_seq)[1], [])
+
+class TestStorageScraper(unittest.TestCase):
+
+    def test_scrape_single(self):
+        backend = storage.SqliteStorage(":memory:")
+        scraper = mittagv2.scraper.StorageScraper(backend)
+        menu = model.WeeklyMenu(1, [model.DailyMenu(0, [model.Menu("", "Suppe", "Suppe mit Brot",
+            None, None, 2.5, None, True)])], None)
+        scraper._scrape_single(lambda: (menu, b"<html/>"), "marli-sb")
+        scrapings = backend.ids(storage.SCRAPINGS)
+        self.assertEqual(len(scrapings), 1)
+        self.assertEqual(backend.get_blob(storage.SCRAPINGS, scrapings[0])[2], b"<html/>")
+        menus = backend.weekly_menu_ids()
+        self.assertEqual(menus, ["marli-sb/" + utils.current_year_week()])
+        stored = backend.get(storage.MENUS, menus[0])
+        self.assertEqual(stored["scrape_id"], scrapings[0])
+        self.assertEqual(stored["menus"]["days"][0]["menus"][0]["name"], "Suppe")
+        self.assertIn("marli-sb", backend.get(storage.READ_MODELS, "week/" + utils.current_year_week())["revisions"])
+        scraper._scrape_single(lambda: (menu, b"<html/>"), "marli-sb")
+        self.assertEqual(backend.weekly_menu_ids(), menus)
+        # unchanged menus are not stored again
+        self.assertEqual(backend.get(storage.MENUS, menus[0])["scrape_id"], scrapings[0])
+        self.assertEqual(len(backend.ids(storage.MENU_HISTORY)), 0)
+
+    def test_migrate_menu_ids(self):
+        backend = storage.SqliteStorage(":memory:")
+        for doc_id, at, price in (("a", "2019-02-11T07:00:00Z", 2.5), ("b", "2019-02-11T08:00:00Z", 2.8)):
+            backend.put(storage.MENUS, {"_id": doc_id, "type": "weekly_menu", "source_name": "marli-sb", "at": at,
+                "menus": {"year_week": "2019- 7", "days": [{"day": 0, "menus": [{"name": "Suppe",
+                "normal_price": price}]}]}})
+        backend.put(storage.MENUS, {"_id": "c", "type": "weekly_menu", "source_name": "marli-sb",
+            "at": "2019-02-11T06:00:00Z", "menus": {"year_week": "2019-07", "days": []}})
+        scraper = mittagv2.scraper.StorageScraper(backend)
+        scraper.migrate_menu_ids()
+        self.assertEqual(backend.weekly_menu_ids(), ["marli-sb/2019-07"])
+        stored = backend.get(storage.MENUS, "marli-sb/2019-07")
+        self.assertEqual(stored["at"], "2019-02-11T08:00:00Z")
+        self.assertEqual(stored["menus"]["year_week"], "2019-07")
+        # newer documents are revisions, older ones are archived
+        self.assertEqual(stored["revision"], 1)
+        self.assertEqual(len(backend.ids(storage.MENU_HISTORY)), 1)
+        self.assertEqual(len(backend.ids(storage.MENU_ARCHIVE)), 1)
+
+    def test_migrate_menu_history(self):
+        backend = storage.SqliteStorage(":memory:")
+        document = {"_id": "marli-sb/2019-07", "type": "weekly_menu", "source_name": "marli-sb",
+            "menus": {"year_week": "2019-07", "days": []}}
+        backend.put(storage.MENUS, document)
+        backend.archive(storage.MENU_HISTORY, document)
+        backend.put(storage.MENU_HISTORY, {"_id": "marli-sb/2019-07@0001", "type": "menu_revision"})
+        mittagv2.scraper.StorageScraper(backend).migrate_menu_history()
+        self.assertEqual(backend.ids(storage.MENU_HISTORY), ["marli-sb/2019-07@0001"])
+        self.assertEqual(backend.ids(storage.MENU_ARCHIVE), ["marli-sb/2019-07@" + document["_rev"]])
+
+    def test_catch_up(self):
+        backend = storage.SqliteStorage(":memory:")
+        scraper = mittagv2.scraper.StorageScraper(backend)
+        (year, week), (last_year, last_week) = utils.recent_weeks(2)
+        current, previous = utils.year_week(year, week), utils.year_week(last_year, last_week)
+        backend.put(storage.MENUS, {"_id": utils.menu_id("marli-sb", current), "type": "weekly_menu",
+            "source_name": "marli-sb", "menus": {"year_week": current, "days": []}})
+        missing = scraper.plan_catch_up(weeks=2)
+        self.assertEqual([ (source.name, w) for source, _, w in missing ], [
+            ("swsh-mensa", week), ("uksh-cafeteria", week), ("uksh-bistro", week),
+            ("uksh-cafeteria", last_week), ("uksh-bistro", last_week)])
+        menu = model.WeeklyMenu(1, [model.DailyMenu(0, [])], None)
+        def scraper_for(source, week_number=None):
+            if source.name == "uksh-bistro" and week_number == last_week:
+                return lambda: 1 / 0
+            return lambda: (menu, b"data")
+        scraper._scraper_for = scraper_for
+        self.assertEqual(scraper.catch_up(missing, workers=2), 4)
+        self.assertEqual([ source.name for source, _, _ in scraper.plan_catch_up(weeks=2) ], ["uksh-bistro"])
+        self.assertIn(utils.menu_id("uksh-cafeteria", previous), backend.weekly_menu_ids())
+        self.assertEqual(len(backend.ids(storage.SCRAPINGS)), 5)
@@ -0,0 +1,62 @@
+import json
+import unittest
+import cherrypy
+import mittagv2.storage as storage
+import mittagv2.utils as utils
+import mittagv2.web as web
+
+class TestBundle(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = storage.SqliteStorage(":memory:")
+        self.backend.put(storage.MENUS, {"_id": utils.menu_id("marli-sb", "2019-50"),
+            "type": "weekly_menu", "source_name": "marli-sb", "menus": {"year_week": "2019-50",
+            "days": [{"day": 0, "menus": [{"name": "Suppe", "menu_type": "", "normal_price": 2.5}]}]}})
+
+    def test_build(self):
+        version, body = web.Bundle(self.backend).get("2019-50")
+        bundle = json.loads(body.decode("utf-8"))
+        self.assertEqual(bundle["start"], "2019-12-09")
+        self.assertEqual([ s["name"] for s in bundle["sources"] ],
+            ["swsh-mensa", "uksh-cafeteria", "marli-sb", "uksh-bistro"])
+        self.assertEqual(bundle["sources"][2]["days"][0][0]["name"], "Suppe")
+        self.assertNotIn("days", bundle["sources"][0])
+        self.assertEqual(web.Bundle(self.backend).get("2019-50")[0], version)
+
+    def test_etag(self):
+        handler = web.Bundle(self.backend)
+        version, body = handler.get("2019-50")
+        self.assertEqual(handler.index("2019-50", v=version), body)
+        self.assertIn("immutable", cherrypy.response.headers["Cache-Control"])
+        cherrypy.serving.response = cherrypy._cprequest.Response()
+        cherrypy.request.headers["If-None-Match"] = "\"{}\"".format(version)
+        try:
+            with self.assertRaises(cherrypy.HTTPRedirect) as cm:
+                handler.index("2019-50")
+            self.assertEqual(cm.exception.status, 304)
+        finally:
+            del cherrypy.request.headers["If-None-Match"]
+        for year_week in ("latest", "2019-60"):
+            with self.assertRaises(cherrypy.HTTPError) as cm:
+                handler.index(year_week)
+            self.assertEqual(cm.exception.status, 404)
+
+class TestBatch(unittest.TestCase):
+
+    def test_batch(self):
+        backend = storage.SqliteStorage(":memory:")
+        backend.put(storage.MENUS, {"_id": utils.menu_id("marli-sb", "2019-50"), "type": "weekly_menu",
+            "source_name": "marli-sb", "menus": {"year_week": "2019-50", "days": []}})
+        scraping = {"type": "scrape_log", "source_name": "marli-sb"}
+        rev = backend.put(storage.SCRAPINGS, scraping)
+        backend.put_blob(storage.SCRAPINGS, scraping["_id"], rev, "x.html", "text/html", b"<html/>")
+        rows = web.Menus(backend).get_batch({"keys": [{"source_name": "marli-sb", "year_week": "2019-50"},
+            ["swsh-mensa", "2019-50"]], "fields": ["menus.year_week", "missing"]})["rows"]
+        self.assertEqual(rows, [{"id": "marli-sb/2019-50", "doc": {"menus": {"year_week": "2019-50"}}},
+            {"id": "swsh-mensa/2019-50", "error": "not_found"}])
+        rows = web.Scrapings(backend).get_batch({"keys": [scraping["_id"], scraping["_id"]]})["rows"]
+        self.assertEqual([ r["doc"]["_attachments"]["x.html"]["length"] for r in rows ], [7, 7])
+        for request in ({"keys": [["marli-sb", "2019-50"]]}, {"keys": "marli-sb/2019-50"},
+                {"keys": [], "fields": "menus"}):
+            with self.assertRaises(cherrypy.HTTPError):
+                web.Scrapings(backend).get_batch(request)